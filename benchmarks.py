@@ -0,0 +1,503 @@
+"""
+Host-side benchmarks for nodemcuload which do not require any hardware.
+
+Usage:
+
+    $ python benchmarks.py encoding [FILE ...]
+    $ python benchmarks.py compression [FILE ...]
+    $ python benchmarks.py buffering [--port PORT] [FILE ...]
+    $ python benchmarks.py startup
+
+Transfers are made to a :py:class:`SimulatedDevice` which implements just
+enough of the NodeMCU Lua interpreter to accept uploads. Times given are
+modelled from the number of bytes sent each way over a serial link of the
+given baudrate plus a fixed per-command interpreter overhead and the time
+taken to write to flash. The buffering benchmark may instead be run against a
+real device, in which case times are measured.
+
+Startup times are measured for real by running the command line tool in a
+fresh interpreter, stopping at the point where it would open the port.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import marshal
+import random
+import subprocess
+
+from base64 import b64decode
+
+from nodemcuload import NodeMCU, lz_compress, lz_decompress, open_transport
+
+# Host CPU time (Python 2 lacks process_time)
+cpu_time = getattr(time, "process_time", None) or time.clock
+
+
+def _unescape_lua(literal):
+    """Decode a Lua string literal as produced by
+    :py:func:`nodemcuload.lua_bytes`."""
+    def replace(match):
+        escape = match.group(1)
+        if escape.startswith(b"x"):
+            return bytes(bytearray([int(escape[1:], 16)]))
+        return escape
+    return re.sub(br"\\(x[0-9A-Fa-f]{2}|.)", replace, literal[1:-1])
+
+
+class SimulatedDevice(object):
+    """A pretend serial port with a NodeMCU device at the other end.
+
+    Only the commands issued by :py:meth:`NodeMCU.write_file` are understood;
+    any other command is echoed and produces no output. Written files are
+    available in :py:attr:`files`. Compressed data (passed to the _nmlz
+    decompressor) is expanded when the file is closed.
+
+    Each write to flash takes a fixed time plus a time per byte, both of which
+    grow as the file system fills up (as SPIFFS must search further for free
+    pages and garbage collect more often).
+    """
+
+    def __init__(self, baudrate=115200, command_time=0.001, base64=True,
+                 heap=40000, fs_size=3 * 1024 * 1024, fs_used=0,
+                 write_time=0.002, write_byte_time=0.000004,
+                 flush_time=0.004):
+        """
+        Parameters
+        ----------
+        baudrate : int
+            Baudrate of the modelled serial link (10 bits per byte).
+        command_time : float
+            Modelled time taken by the interpreter for each command.
+        base64 : bool
+            Whether the modelled firmware includes the encoder module.
+        heap : int
+            Value returned by node.heap().
+        fs_size : int
+            Size of the file system.
+        fs_used : int
+            Bytes of the file system already used (by a file named "_used").
+        write_time : float
+            Modelled time taken by each write to flash of an empty file
+            system.
+        write_byte_time : float
+            Modelled time taken per byte written to flash of an empty file
+            system.
+        flush_time : float
+            Modelled time taken by each file.flush().
+        """
+        self.baudrate = baudrate
+        self.command_time = command_time
+        self.base64 = base64
+        self.heap = heap
+        self.fs_size = fs_size
+        self.write_time = write_time
+        self.write_byte_time = write_byte_time
+        self.flush_time = flush_time
+
+        self.files = {"_used": b"\0" * fs_used} if fs_used else {}
+        self._open = None
+        self._compressed = b""
+        self._buffer = b""
+
+        # Statistics
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.commands = 0
+        self.flash_writes = 0
+        self.flash_time = 0.0
+
+        # [(command, modelled time taken), ...]
+        self.latencies = []
+
+        self._line = b""
+        self._output = b""
+
+        self._handlers = [
+            (br"=encoder ~= nil and encoder\.fromBase64 ~= nil",
+             lambda m: b"true" if self.base64 else b"false"),
+            (br"file\.close\(\)", self._close),
+            (br"=file\.open\('(.*)', '[wa]'\)", self._open_file),
+            (br"=(file\.write|_nmlz|_nmb[awf])"
+             br"\(encoder\.fromBase64\('(.*)'\)\)",
+             lambda m: self._write_data(m.group(1),
+                                        b64decode(m.group(2)))),
+            (br"=(file\.write|_nmlz|_nmb[awf])\(('.*')\)",
+             lambda m: self._write_data(m.group(1),
+                                        _unescape_lua(m.group(2)))),
+            (br"=file\.list\(\)\['(.*)'\] or 0, file\.fsinfo\(\)",
+             self._fs_info),
+            (br"=node\.heap\(\)",
+             lambda m: str(self.heap).encode("ascii")),
+        ]
+
+    @property
+    def elapsed(self):
+        """The modelled time taken by all commands so far."""
+        return ((self.bytes_sent + self.bytes_received) * 10.0 /
+                self.baudrate) + (self.commands * self.command_time) + \
+            self.flash_time
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
+    @property
+    def in_waiting(self):
+        return len(self._output)
+
+    def read(self, length):
+        data = self._output[:length]
+        self._output = self._output[length:]
+        self.bytes_received += len(data)
+        return data
+
+    def write(self, data):
+        self.bytes_sent += len(data)
+        self._line += data
+        while b"\r\n" in self._line:
+            line, self._line = self._line.split(b"\r\n", 1)
+            output = line + b"\r\n"
+            flash_time = self.flash_time
+            self.commands += 1
+            response = self._execute(line)
+            if response is not None:
+                output += response + b"\r\n"
+            self._output += output
+            self.latencies.append((line, (
+                (len(line) + 2 + len(output)) * 10.0 / self.baudrate +
+                self.command_time + self.flash_time - flash_time)))
+        return len(data)
+
+    def _execute(self, line):
+        for pattern, handler in self._handlers:
+            match = re.match(pattern + b"$", line)
+            if match:
+                return handler(match)
+
+        # Several statements (see NodeMCU.run_batch)
+        if b"; " in line:
+            output = []
+            for statement in line.split(b"; "):
+                match = re.match(br"print\((.*)\)$", statement)
+                if match:
+                    statement = b"=" + match.group(1)
+                response = self._execute(statement)
+                if response is not None:
+                    output.append(response)
+            return b"\r\n".join(output) if output else None
+        return None
+
+    def _close(self, match):
+        if self._compressed:
+            # The decompressor writes (roughly) every 256 bytes
+            data = lz_decompress(self._compressed)
+            for offset in range(0, len(data), 256):
+                self._flash_write(data[offset:offset + 256])
+            self._compressed = b""
+        self._open = None
+
+    def _open_file(self, match):
+        self._open = match.group(1).decode("utf-8")
+        self.files[self._open] = b""
+        return b"true"
+
+    def _write_data(self, function, data):
+        if self._open is None:
+            return b"nil"
+        elif function == b"_nmlz":
+            # Flash writes are modelled in 256 byte chunks on close
+            self._compressed += data
+        elif function.startswith(b"_nmb"):
+            self._buffer += data
+            if function != b"_nmba":
+                self._flash_write(self._buffer)
+                self._buffer = b""
+            if function == b"_nmbf":
+                self.flash_time += self.flush_time
+        else:
+            self._flash_write(data)
+        return b"true"
+
+    def _flash_write(self, data):
+        """Append to the open file, modelling the time taken."""
+        fill = sum(map(len, self.files.values())) / float(self.fs_size)
+        self.flash_writes += 1
+        self.flash_time += ((self.write_time +
+                             len(data) * self.write_byte_time) *
+                            (1.0 + 3.0 * fill))
+        self.files[self._open] += data
+
+    def _fs_info(self, match):
+        existing = len(self.files.get(match.group(1).decode("utf-8"), b""))
+        used = sum(map(len, self.files.values()))
+        return "{}\t{}\t{}\t{}".format(existing, self.fs_size - used, used,
+                                       self.fs_size).encode("ascii")
+
+
+def sample_data(filenames):
+    """Get the data to benchmark as [(name, bytes), ...].
+
+    The built-in samples are text (this package's source), markup (its
+    README), JSON, bytecode and random data. Lua bytecode can't be generated
+    without luac so a marshalled Python code object (a similar mix of
+    opcodes, small integers and constant strings) stands in for it; pass real
+    .lc files to measure those instead.
+    """
+    if filenames:
+        samples = []
+        for filename in filenames:
+            with open(filename, "rb") as f:
+                samples.append((os.path.basename(filename), f.read()))
+        return samples
+
+    import nodemcuload
+    with open(nodemcuload.__file__.replace(".pyc", ".py"), "rb") as f:
+        source = f.read()
+    with open(os.path.join(os.path.dirname(nodemcuload.__file__),
+                           "README.md"), "rb") as f:
+        readme = f.read()
+    rng = random.Random(0)
+    records = [{"id": i,
+                "name": "sensor-{}".format(rng.randint(0, 99)),
+                "enabled": rng.random() < 0.5,
+                "reading": round(rng.uniform(-40, 85), 2)}
+               for i in range(512)]
+    return [
+        ("text", source[:32768]),
+        ("markup", readme[:32768]),
+        ("json", json.dumps(records, indent=1).encode("ascii")[:32768]),
+        ("bytecode", marshal.dumps(compile(source, "nodemcuload.py",
+                                           "exec"))[:32768]),
+        ("random", bytes(bytearray(rng.getrandbits(8)
+                                   for _ in range(32768)))),
+    ]
+
+
+def upload(data, baudrate, heap_aware=False, **kwargs):
+    """Upload data to a :py:class:`SimulatedDevice` with the given
+    :py:meth:`NodeMCU.write_file` arguments, returning the device and the host
+    CPU time taken."""
+    device = SimulatedDevice(baudrate)
+    n = NodeMCU(device)
+    start = cpu_time()
+    n.write_file("bench", data, heap_aware=heap_aware, **kwargs)
+    end = cpu_time()
+    assert device.files["bench"] == data
+    return device, end - start
+
+
+def bench_encoding(args):
+    """Compare the escaped string and base64 transfer encodings."""
+    print("{:<12} {:>7} {:<7} {:>6} {:>8} {:>6} {:>8} {:>7}".format(
+        "sample", "bytes", "enc", "cmds", "sent", "ratio", "time/s",
+        "cpu/s"))
+    for name, data in sample_data(args.files):
+        for encoding in NodeMCU.ENCODINGS:
+            device, cpu = upload(data, args.baudrate,
+                                 heap_aware=args.heap_aware,
+                                 block_size=args.block_size,
+                                 encoding=encoding)
+            print("{:<12} {:>7} {:<7} {:>6} {:>8} {:>6.2f} {:>8.2f} "
+                  "{:>7.3f}".format(
+                      name[:12], len(data), encoding, device.commands,
+                      device.bytes_sent, device.bytes_sent / float(len(data)),
+                      device.elapsed, cpu))
+
+
+def bench_compression(args):
+    """Compare compressed and uncompressed transfers."""
+    print("{:<12} {:>7} {:<7} {:>5} {:>8} {:>8} {:>7} {:>7}".format(
+        "sample", "bytes", "enc", "ratio", "sent", "time/s", "B/s",
+        "cpu/s"))
+    for name, data in sample_data(args.files):
+        ratio = len(lz_compress(data)) / float(len(data))
+        for encoding in ("escape", "auto"):
+            for compress in (False, True):
+                device, cpu = upload(data, args.baudrate,
+                                     heap_aware=args.heap_aware,
+                                     block_size=args.block_size,
+                                     encoding=encoding, compress=compress)
+                print("{:<12} {:>7} {:<7} {:>5} {:>8} {:>8.2f} {:>7.0f} "
+                      "{:>7.3f}".format(
+                          name[:12], len(data), encoding,
+                          "{:.2f}".format(ratio) if compress else "-",
+                          device.bytes_sent, device.elapsed,
+                          len(data) / device.elapsed, cpu))
+
+
+class TimedNodeMCU(NodeMCU):
+    """A :py:class:`NodeMCU` which records the wall-clock time taken by each
+    command (from sending it until the first line of its result is read) in
+    :py:attr:`latencies` as [(command, seconds), ...]."""
+
+    def __init__(self, *args, **kwargs):
+        NodeMCU.__init__(self, *args, **kwargs)
+        self.latencies = []
+        self._sent = None
+
+    def send_command(self, cmd):
+        # NB: The echo is absorbed using read_line
+        self._sent = None
+        start = time.time()
+        NodeMCU.send_command(self, cmd)
+        self._sent = (cmd, start)
+
+    def read_line(self, *args, **kwargs):
+        line = NodeMCU.read_line(self, *args, **kwargs)
+        if self._sent is not None:
+            cmd, start = self._sent
+            self.latencies.append((cmd, time.time() - start))
+            self._sent = None
+        return line
+
+
+def bench_buffering(args):
+    """Compare upload rate and per-command latency for various device-side
+    write buffer sizes."""
+    print("{:<12} {:>7} {:>6} {:>6} {:>6} {:>8} {:>7} {:>7} {:>7} "
+          "{:>7}".format("sample", "bytes", "buffer", "cmds", "writes",
+                         "time/s", "B/s", "blk/ms", "wrt/ms", "max/ms"))
+    for name, data in sample_data(args.files):
+        for write_buffer in args.sizes:
+            if args.port:
+                device = open_transport(args.port, args.baudrate)
+                n = TimedNodeMCU(device)
+            else:
+                device = SimulatedDevice(
+                    args.baudrate,
+                    fs_used=int(args.fill * 3 * 1024 * 1024))
+                n = NodeMCU(device)
+            with n:
+                if args.port:
+                    n.get_version()
+                start = time.time()
+                n.write_file("bench", data, block_size=args.block_size,
+                             heap_aware=args.heap_aware,
+                             write_buffer=write_buffer,
+                             flush_interval=args.flush_interval)
+                if args.port:
+                    elapsed = time.time() - start
+                    latencies = n.latencies
+                    n.remove_file("bench")
+                else:
+                    elapsed = device.elapsed
+                    latencies = device.latencies
+
+            # Block commands, and those of them which wrote to flash
+            blocks = [t for cmd, t in latencies
+                      if re.match(br"=(file\.write|_nmb[awf])\(", cmd)]
+            writes = [t for cmd, t in latencies
+                      if re.match(br"=(file\.write|_nmb[wf])\(", cmd)]
+            print("{:<12} {:>7} {:>6} {:>6} {:>6} {:>8.2f} {:>7.0f} "
+                  "{:>7.1f} {:>7.1f} {:>7.1f}".format(
+                      name[:12], len(data), write_buffer, len(latencies),
+                      len(writes), elapsed, len(data) / elapsed,
+                      1000 * sum(blocks) / max(len(blocks), 1),
+                      1000 * sum(writes) / max(len(writes), 1),
+                      1000 * max(blocks or [0])))
+
+
+# Runs nodemcuload's command line interface but exits successfully as soon as
+# it tries to open a port.
+STARTUP_SCRIPT = """
+import sys
+import nodemcuload
+
+def open_transport(*args, **kwargs):
+    sys.exit(0)
+
+nodemcuload.open_transport = open_transport
+sys.exit(nodemcuload.main(sys.argv[1:]))
+"""
+
+
+def bench_startup(args):
+    """Time command line invocations from process start until the port is
+    opened."""
+    cases = [
+        ("interpreter", ["-c", "pass"]),
+        ("--help", ["-c", STARTUP_SCRIPT, "--help"]),
+        ("--port", ["-c", STARTUP_SCRIPT, "--port", "/dev/ttyUSB0",
+                    "--list"]),
+        ("auto-detect", ["-c", STARTUP_SCRIPT, "--list"]),
+    ]
+    directory = os.path.dirname(os.path.abspath(__file__))
+    print("{:<12} {:>8} {:>8}".format("invocation", "min/ms", "mean/ms"))
+    with open(os.devnull, "wb") as devnull:
+        for name, argv in cases:
+            times = []
+            for _ in range(args.repeat):
+                start = time.time()
+                subprocess.call([sys.executable] + argv, cwd=directory,
+                                stdout=devnull, stderr=devnull)
+                times.append(time.time() - start)
+            print("{:<12} {:>8.1f} {:>8.1f}".format(
+                name, min(times) * 1000, sum(times) * 1000 / len(times)))
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark nodemcuload against a simulated device.")
+    parser.add_argument("--baudrate", "-b", type=int, default=115200,
+                        help="Modelled baudrate (default = %(default)d).")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    # Arguments common to upload benchmarks
+    files = argparse.ArgumentParser(add_help=False)
+    files.add_argument("files", nargs="*", metavar="FILE",
+                       help="Files to upload (default: built-in samples).")
+    files.add_argument("--block-size", type=int, default=64,
+                       help="Bytes per block (default = %(default)d).")
+    files.add_argument("--heap-aware", action="store_true",
+                       help="Use heap-aware (line filling) block sizes.")
+
+    encoding = subparsers.add_parser(
+        "encoding", parents=[files],
+        help="Compare file transfer encodings.")
+    encoding.set_defaults(func=bench_encoding)
+
+    compression = subparsers.add_parser(
+        "compression", parents=[files],
+        help="Compare compressed and uncompressed transfers.")
+    compression.set_defaults(func=bench_compression)
+
+    buffering = subparsers.add_parser(
+        "buffering", parents=[files],
+        help="Compare device-side write buffer sizes.")
+    buffering.add_argument("--sizes", type=int, nargs="+",
+                           default=[0, 256, 1024, 4096], metavar="BYTES",
+                           help="Write buffer sizes to try "
+                                "(default = %(default)s).")
+    buffering.add_argument("--flush-interval", type=int, metavar="N",
+                           help="Flush after every N writes to flash.")
+    buffering.add_argument("--fill", type=float, default=0.0,
+                           help="Fraction of the simulated file system "
+                                "already used (default = %(default)s).")
+    buffering.add_argument("--port", "-p",
+                           help="Upload to a real device on this port "
+                                "instead of a simulated one, measuring "
+                                "times.")
+    buffering.set_defaults(func=bench_buffering)
+
+    startup = subparsers.add_parser(
+        "startup", help="Time command line tool startup.")
+    startup.add_argument("--repeat", type=int, default=20,
+                         help="Runs of each invocation "
+                              "(default = %(default)d).")
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
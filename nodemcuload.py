@@ -5,6 +5,19 @@ A command-line interface to the file system operations of the NodeMCU Lua
 interpreter.
 """
 
+import collections
+import functools
+import heapq
+import os
+import re
+import select
+import threading
+import time
+import zlib
+
+from base64 import b64encode
+from binascii import hexlify, unhexlify
+
 
 def lua_bytes(text):
     """Convert some bytes into an escaped lua string literal."""
@@ -28,6 +41,26 @@ def lua_bytes(text):
     return b"'" + out + b"'"
 
 
+def lua_bytes_length(data, offset=0, max_length=None):
+    """Find how many bytes, starting from offset, can be encoded by
+    :py:func:`lua_bytes` in a literal of at most max_length characters
+    (including quotes). At least one byte is always included.
+
+    If max_length is None, returns the length of the literal for all of data.
+    """
+    length = 2
+    for num_bytes, byte in enumerate(bytearray(data[offset:])):
+        if byte in (ord("\\"), ord("'")):
+            length += 2
+        elif 0x20 <= byte < 0x7F:
+            length += 1
+        else:
+            length += 4
+        if max_length is not None and length > max_length:
+            return max(num_bytes, 1)
+    return length if max_length is None else len(data) - offset
+
+
 def lua_string(text):
     """Convert a Python string into a byte-encoded escaped lua string
     literal.
@@ -35,10 +68,1097 @@ def lua_string(text):
     return lua_bytes(text.encode("utf-8"))
 
 
+def adler32(data):
+    """Compute the (unsigned) Adler-32 checksum of some bytes.
+
+    This is the hash computed on the device by :py:meth:`NodeMCU.file_hash`.
+    """
+    return zlib.adler32(data) & 0xFFFFFFFF
+
+
+class FileCache(object):
+    """An on-disk cache of file contents with least-recently-used eviction.
+
+    Entries are identified by a key tuple (e.g. device ID, filename, size and
+    hash) and stored in files named after a hash of the key. Use times are
+    tracked using the file modification times.
+    """
+
+    def __init__(self, directory, max_bytes=16 * 1024 * 1024):
+        """
+        Parameters
+        ----------
+        directory : str
+            Directory to store cached files in (created if required).
+        max_bytes : int
+            The total size of cached data after which the least recently used
+            entries are evicted.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        # Allows a cache to be shared by several devices being accessed
+        # concurrently
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        import hashlib
+        key = u"\0".join(map(u"{}".format, key)).encode("utf-8")
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        """Get the cached data for a key or None if not cached."""
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except (IOError, OSError):
+                return None
+            os.utime(path, None)
+            return data
+
+    def put(self, key, data):
+        """Add an entry to the cache, evicting old entries as required."""
+        if len(data) > self.max_bytes:
+            return
+
+        path = self._path(key)
+        with self._lock:
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.rename(path + ".tmp", path)
+            os.utime(path, None)
+
+            # Evict least recently used entries (other than the new one)
+            entries = []
+            for name in os.listdir(self.directory):
+                if name != os.path.basename(path):
+                    stat = os.stat(os.path.join(self.directory, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+            entries.sort()
+            total = len(data) + sum(size for _, size, _ in entries)
+            while total > self.max_bytes:
+                _, size, name = entries.pop(0)
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+
+
+_LUA_LONG_BRACKET = re.compile(r"\[(=*)\[")
+
+
+def _lua_needs_space(before, after):
+    """Must whitespace be kept between two adjacent Lua characters?"""
+    def word(c):
+        return c.isalnum() or c == "_"
+    return ((word(before) and word(after)) or
+            (before == "-" and after == "-") or
+            ("." in (before, after) and
+             (before.isdigit() or after.isdigit() or before == after)) or
+            (before == "[" and after in "[=") or
+            (after == "=" and before in "=<>~"))
+
+
+def minify_lua(source, cache=None):
+    """Strip comments and redundant whitespace from some Lua source.
+
+    String literals and long brackets are left intact. Line breaks are
+    preserved (though blank lines are removed) since these can be significant
+    in Lua, e.g. to separate a statement from a following parenthesised
+    expression.
+
+    Parameters
+    ----------
+    source : bytes
+    cache : :py:class:`FileCache` or None
+        If given, minified output is cached keyed by a hash of the source.
+
+    Returns
+    -------
+    The minified source as bytes.
+    """
+    if cache is not None:
+        import hashlib
+        key = ("minify_lua", hashlib.sha1(source).hexdigest())
+        minified = cache.get(key)
+        if minified is None:
+            minified = minify_lua(source)
+            cache.put(key, minified)
+        return minified
+
+    # Work with a str where each character is one byte
+    s = source.decode("latin-1")
+    out = []
+
+    # Whitespace seen since the last token: None, " " or "\n"
+    space = None
+
+    i = 0
+    while i < len(s):
+        c = s[i]
+        long_bracket = _LUA_LONG_BRACKET.match(s, i)
+        if s.startswith("--", i):
+            # Comments are treated like whitespace
+            long_bracket = _LUA_LONG_BRACKET.match(s, i + 2)
+            if long_bracket:
+                close = "]{}]".format(long_bracket.group(1))
+                end = s.find(close, long_bracket.end())
+                end = len(s) if end < 0 else end + len(close)
+                if "\n" in s[i:end]:
+                    space = "\n"
+                else:
+                    space = space or " "
+                i = end
+            else:
+                end = s.find("\n", i)
+                i = len(s) if end < 0 else end
+            continue
+        elif c in " \t\r\n\f\v":
+            if c == "\n":
+                space = "\n"
+            else:
+                space = space or " "
+            i += 1
+            continue
+        elif c in "'\"":
+            end = i + 1
+            while end < len(s) and s[end] not in (c, "\n"):
+                end += 2 if s[end] == "\\" else 1
+            token = s[i:end + 1]
+        elif long_bracket:
+            close = "]{}]".format(long_bracket.group(1))
+            end = s.find(close, long_bracket.end())
+            token = s[i:] if end < 0 else s[i:end + len(close)]
+        else:
+            token = c
+
+        if out and space == "\n":
+            out.append("\n")
+        elif out and space and _lua_needs_space(out[-1][-1], token[0]):
+            out.append(" ")
+        space = None
+        out.append(token)
+        i += len(token)
+
+    return "".join(out).encode("latin-1")
+
+
+class ConsoleMonitor(object):
+    """Collects unsolicited output from a device (e.g. from its running
+    scripts) in a background thread.
+
+    Output is only read while the device is otherwise idle (i.e. while its
+    lock is free) so other operations may continue to use the same
+    connection. Output arriving during an operation is consumed by that
+    operation.
+    """
+
+    def __init__(self, nodemcu, callback=None, buffer_size=4096,
+                 interval=0.05):
+        """
+        Parameters
+        ----------
+        nodemcu : :py:class:`NodeMCU`
+        callback : f(data) or None
+            Called (from the monitor thread) with each chunk of output.
+        buffer_size : int
+            The number of most recent bytes of output retained for
+            :py:meth:`read`.
+        interval : float
+            Polling interval (in seconds) when no output is waiting.
+        """
+        self.nodemcu = nodemcu
+        self.callback = callback
+        self.buffer_size = buffer_size
+        self.interval = interval
+
+        self._buffer = collections.deque()
+        self._buffered = 0
+        self._buffer_lock = threading.Lock()
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.stop()
+
+    def start(self):
+        """Start monitoring in a background thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop monitoring and wait for the background thread to exit (if
+        started)."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def read(self):
+        """Get (and remove) the buffered output."""
+        with self._buffer_lock:
+            data = b"".join(self._buffer)
+            self._buffer.clear()
+            self._buffered = 0
+        return data
+
+    def poll(self):
+        """Read any waiting output, if the device is idle.
+
+        Returns
+        -------
+        The output read (possibly empty).
+        """
+        data = b""
+        if self.nodemcu.lock.acquire(False):
+            try:
+                waiting = self.nodemcu.serial.in_waiting
+                if waiting:
+                    data = self.nodemcu.read(waiting)
+            finally:
+                self.nodemcu.lock.release()
+
+        if data:
+            with self._buffer_lock:
+                self._buffer.append(data)
+                self._buffered += len(data)
+                while self._buffered > self.buffer_size:
+                    excess = self._buffered - self.buffer_size
+                    if len(self._buffer[0]) <= excess:
+                        self._buffered -= len(self._buffer.popleft())
+                    else:
+                        self._buffer[0] = self._buffer[0][excess:]
+                        self._buffered -= excess
+            if self.callback is not None:
+                self.callback(data)
+        return data
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self.poll():
+                self._stop.wait(self.interval)
+
+
+def _walk_files(directory):
+    """Find the files within a directory (recursively), skipping hidden files
+    and directories and editor backups (names starting with '.' or ending
+    with '~').
+
+    Yields
+    ------
+    (path, name)
+        The path of each file and its name relative to the directory, using
+        '/' as the separator.
+    """
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for filename in filenames:
+            if filename.startswith(".") or filename.endswith("~"):
+                continue
+            path = os.path.join(dirpath, filename)
+            yield (path,
+                   os.path.relpath(path, directory).replace(os.sep, "/"))
+
+
+class DirectoryWatcher(object):
+    """Detects changed files in a directory by polling their modification
+    times and sizes.
+
+    Changes are debounced: a batch of changes is only reported once no
+    further changes have been seen for a short time (e.g. while an editor
+    saves several files). Hidden files and directories and editor backups
+    are ignored (as by :py:func:`read_directory`), as are deletions.
+    """
+
+    def __init__(self, directory, debounce=0.3):
+        """
+        Parameters
+        ----------
+        directory : str
+        debounce : float
+            The time (in seconds) without changes before a batch of changes
+            is reported.
+        """
+        self.directory = directory
+        self.debounce = debounce
+
+        self._state = self.scan()
+        self._changed = set()
+        self._last_change = None
+
+    def scan(self):
+        """Get the modification time and size of every file.
+
+        Returns
+        -------
+        {filename: (mtime, size), ...}
+            Filenames are relative and use '/' as the separator.
+        """
+        state = {}
+        for path, name in _walk_files(self.directory):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Deleted while scanning
+                continue
+            state[name] = (stat.st_mtime, stat.st_size)
+        return state
+
+    def poll(self):
+        """Check for changes.
+
+        Returns
+        -------
+        A sorted list of changed (or new) files once the directory has
+        settled, otherwise an empty list.
+        """
+        state = self.scan()
+        changed = set(name for name, info in state.items()
+                      if self._state.get(name) != info)
+        self._state = state
+
+        now = time.time()
+        if changed:
+            self._changed.update(changed)
+            self._last_change = now
+        elif self._changed and now - self._last_change >= self.debounce:
+            changed = sorted(self._changed)
+            self._changed.clear()
+            return changed
+        return []
+
+
+def _compilable(filename):
+    """Should --compile compile a file? init.lua is always left as source
+    since the firmware runs it at boot."""
+    return filename.endswith(".lua") and filename != "init.lua"
+
+
+def _lua_stem(filename):
+    """Strip the '.lua' extension from a filename."""
+    if not filename.endswith(".lua"):
+        raise ValueError("Only '.lua' files can be compiled.")
+    return filename[:-len(".lua")]
+
+
+def pack_archive(files):
+    """Pack a number of files into a single archive which can be unpacked on
+    the device by :py:meth:`NodeMCU.write_files`.
+
+    The archive begins with a header consisting of the number of files
+    followed by the length of each filename, its size and the filename
+    itself. The contents of the files follow, concatenated, in the same
+    order.
+
+    Parameters
+    ----------
+    files : [(filename, data), ...]
+
+    Returns
+    -------
+    The archive as bytes.
+    """
+    header = "{}\n".format(len(files)).encode("ascii")
+    for filename, data in files:
+        filename = filename.encode("utf-8")
+        header += "{} {}\n".format(len(filename), len(data)).encode("ascii")
+        header += filename
+    return header + b"".join(data for _, data in files)
+
+
+def read_directory(directory):
+    """Read every file within a directory (recursively).
+
+    Returns
+    -------
+    [(filename, data), ...]
+        Filenames are relative to the directory and use '/' as the separator.
+        The list is sorted by filename. Hidden files and directories and
+        editor backups (names starting with '.' or ending with '~', e.g.
+        '.git' or 'init.lua~') are skipped.
+    """
+    files = []
+    for path, name in _walk_files(directory):
+        with open(path, "rb") as f:
+            files.append((name, f.read()))
+    return sorted(files)
+
+
+def read_manifest(filename):
+    """Read a deployment manifest: a JSON object mapping each device (port)
+    to a list of local paths of files or directories (relative to the
+    manifest) to write to it.
+
+    Returns
+    -------
+    {device: [(filename, data), ...], ...}
+        Files are named after their basename and the contents of directories
+        are named relative to the directory (see :py:func:`read_directory`).
+
+    Raises
+    ------
+    ValueError
+        If several files for one device would have the same name.
+    """
+    import json
+
+    with open(filename) as f:
+        manifest = json.load(f)
+
+    directory = os.path.dirname(filename)
+    devices = {}
+    for device, paths in manifest.items():
+        files = devices[device] = []
+        for path in paths:
+            path = os.path.join(directory, path)
+            if os.path.isdir(path):
+                files.extend(read_directory(path))
+            else:
+                with open(path, "rb") as f:
+                    files.append((os.path.basename(path), f.read()))
+        names = [name for name, _ in files]
+        for name in sorted(set(names)):
+            if names.count(name) > 1:
+                raise ValueError("Several files named {} for {}.".format(
+                    repr(name), device))
+    return devices
+
+
+# Lua source (one line per command) defining a function `_nmunpack(archive,
+# buffer_size)` which unpacks an archive produced by :py:func:`pack_archive`,
+# deletes the archive and returns the number of files unpacked. Since only one
+# file may be open at once, the contents are copied via a buffer of up to
+# buffer_size bytes.
+UNPACK_ARCHIVE_LUA = [
+    b"function _nmunpack(a, b)",
+    b" file.open(a, 'r')",
+    b" local n, e = tonumber(file.readline()), {}",
+    b" for i = 1, n do",
+    b"  local l, s = file.readline():match('(%d+) (%d+)')",
+    b"  e[i] = {file.read(tonumber(l)), tonumber(s)}",
+    b" end",
+    b" local o = file.seek('cur')",
+    b" file.close()",
+    b" for i = 1, n do",
+    b"  local f, s = e[i][1], e[i][2]",
+    b"  file.open(f, 'w')",
+    b"  file.close()",
+    b"  while s > 0 do",
+    b"   file.open(a, 'r')",
+    b"   file.seek('set', o)",
+    b"   local d = file.read(math.min(s, b))",
+    b"   file.close()",
+    b"   file.open(f, 'a')",
+    b"   file.write(d)",
+    b"   file.close()",
+    b"   o, s = o + #d, s - #d",
+    b"  end",
+    b" end",
+    b" file.remove(a)",
+    b" return n",
+    b"end",
+]
+
+
+# Lua source defining a function `_nmhash(filename)` which returns the size and
+# the two halves of the Adler-32 checksum (see :py:func:`adler32`) of a file,
+# or nil if it does not exist. The halves are combined on the host since the
+# checksum overflows the integers of integer firmware builds.
+HASH_FILE_LUA = [
+    b"function _nmhash(f)",
+    b" file.close()",
+    b" local s, a, b = file.list()[f], 1, 0",
+    b" if not s or not file.open(f, 'r') then return nil end",
+    b" local d = file.read(256)",
+    b" while d do",
+    b"  for i = 1, #d do",
+    b"   a = (a + d:byte(i)) % 65521",
+    b"   b = (b + a) % 65521",
+    b"  end",
+    b"  tmr.wdclr()",
+    b"  d = file.read(256)",
+    b" end",
+    b" file.close()",
+    b" return s, b, a",
+    b"end",
+]
+
+
+# Lua source defining a function `_nminv()` which prints the values of
+# node.info(), then node.chipid(), node.heap() and file.fsinfo(), then the
+# number of files followed by the length and name of each file, and its size
+# and checksum (using `_nmhash`, see :py:data:`HASH_FILE_LUA`). Filenames are
+# written using uart.write in case they contain newlines (or print, followed by
+# a newline, for print-only consoles, see :py:attr:`NodeMCU.print_only`).
+INVENTORY_LUA = [
+    b"function _nminv()",
+    b" print(node.info())",
+    b" print(node.chipid(), node.heap(), file.fsinfo())",
+    b" local l, n = file.list(), 0",
+    b" for f in pairs(l) do n = n + 1 end",
+    b" print(n)",
+    b" for f in pairs(l) do",
+    b"  print(#f)",
+    b"  uart.write(0, f)",
+    b"  print(_nmhash(f))",
+    b" end",
+    b"end",
+]
+
+
+# Lua source defining functions which buffer file data on the device before
+# writing it to flash (see :py:meth:`NodeMCU.write_file`). `_nmba(s)` appends s
+# to the buffer, `_nmbw(s)` also writes the buffered data to the open file and
+# `_nmbf(s)` then flushes the file too. Each returns true on success. The
+# buffer, `_nmb`, must be set to {} before the first call.
+WRITE_BUFFER_LUA = [
+    b"function _nmba(s)",
+    b" _nmb[#_nmb + 1] = s",
+    b" return true",
+    b"end",
+    b"function _nmbw(s)",
+    b" _nmba(s)",
+    b" local r = file.write(table.concat(_nmb))",
+    b" _nmb = {}",
+    b" return r",
+    b"end",
+    b"function _nmbf(s)",
+    b" local r = _nmbw(s)",
+    b" file.flush()",
+    b" return r",
+    b"end",
+]
+
+
+# The number of previously decompressed bytes which compressed data may refer
+# back to (and which the device must keep in memory).
+LZ_WINDOW_SIZE = 1024
+
+# The shortest and longest repeats encoded by :py:func:`lz_compress`.
+LZ_MIN_MATCH = 4
+LZ_MAX_MATCH = LZ_MIN_MATCH + 0x7F
+
+# The longest run of literal bytes encoded by :py:func:`lz_compress`.
+LZ_MAX_LITERALS = 0x80
+
+
+def lz_compress(data, window_size=LZ_WINDOW_SIZE, max_chain=16):
+    """Compress data using a simple LZ77 scheme which is cheap to decode on
+    the device (see :py:data:`LZ_DECOMPRESS_LUA`).
+
+    The compressed data is a sequence of tokens, each starting with a control
+    byte, c. If c < 0x80, c + 1 literal bytes follow. Otherwise the token is
+    followed by two bytes (big endian) giving a distance, d, and the
+    (c - 0x80 + LZ_MIN_MATCH) bytes starting d + 1 bytes before the end of the
+    output so far are repeated (the repeat may overlap itself).
+
+    Parameters
+    ----------
+    data : bytes
+    window_size : int
+        The furthest back (in bytes) a repeat may start (at most 65536).
+    max_chain : int
+        The number of earlier candidate positions tried for each repeat.
+        Larger values compress better but more slowly.
+    """
+    data = bytearray(data)
+    out = bytearray()
+    literals = bytearray()
+
+    # {prefix: [position, ...], ...} for recent positions
+    chains = {}
+
+    i = 0
+    while i < len(data):
+        best_length = best_distance = 0
+        for j in reversed(chains.get(bytes(data[i:i + LZ_MIN_MATCH]), ())):
+            if i - j > window_size:
+                break
+            length = 0
+            while (length < LZ_MAX_MATCH and i + length < len(data) and
+                   data[j + length] == data[i + length]):
+                length += 1
+            if length > best_length:
+                best_length, best_distance = length, i - j
+
+        if best_length < LZ_MIN_MATCH:
+            best_length = 1
+            literals.append(data[i])
+        if literals and (best_length > 1 or
+                         len(literals) == LZ_MAX_LITERALS or
+                         i + 1 == len(data)):
+            out.append(len(literals) - 1)
+            out += literals
+            literals = bytearray()
+        if best_length > 1:
+            out += bytearray([0x80 | (best_length - LZ_MIN_MATCH),
+                              (best_distance - 1) >> 8,
+                              (best_distance - 1) & 0xFF])
+
+        for _ in range(best_length):
+            chain = chains.setdefault(bytes(data[i:i + LZ_MIN_MATCH]), [])
+            chain.append(i)
+            del chain[:-max_chain]
+            i += 1
+
+    return bytes(out)
+
+
+def lz_decompress(data):
+    """Decompress data produced by :py:func:`lz_compress`."""
+    data = bytearray(data)
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        c = data[i]
+        if c < 0x80:
+            out += data[i + 1:i + c + 2]
+            i += c + 2
+        else:
+            distance = (data[i + 1] << 8 | data[i + 2]) + 1
+            for _ in range(c - 0x80 + LZ_MIN_MATCH):
+                out.append(out[-distance])
+            i += 3
+    return bytes(out)
+
+
+# Lua source defining a function `_nmlz(data)` which decompresses the next part
+# of the output of :py:func:`lz_compress` into the open file, returning true on
+# success. Tokens split between calls are carried over in `_nmlzp` and the
+# decompressor's window is kept in `_nmlzw`: both must be set to '' before the
+# first call. At most the window and 256 bytes of decompressed data are held in
+# memory at once (beyond the compressed data itself).
+LZ_DECOMPRESS_LUA = [
+    b"function _nmlz(s)",
+    b" s = _nmlzp .. s",
+    b" local i, n, w, o, m, r = 1, #s, _nmlzw, {}, 0, true",
+    b" while i <= n do",
+    b"  local c, t = s:byte(i)",
+    b"  if c < 128 then",
+    b"   if i + c + 1 > n then break end",
+    b"   t, i = s:sub(i + 1, i + c + 1), i + c + 2",
+    b"  else",
+    b"   if i + 2 > n then break end",
+    "   local d, l = s:byte(i + 1) * 256 + s:byte(i + 2) + 1, "
+    "c - {}".format(0x80 - LZ_MIN_MATCH).encode("ascii"),
+    b"   t = w:sub(#w - d + 1, #w - d + l)",
+    b"   t, i = t:rep(math.ceil(l / #t)):sub(1, l), i + 3",
+    b"  end",
+    "  w = (w .. t):sub(-{})".format(LZ_WINDOW_SIZE).encode("ascii"),
+    b"  o[#o + 1], m = t, m + #t",
+    b"  if m >= 256 then",
+    b"   r, o, m = file.write(table.concat(o)) and r, {}, 0",
+    b"  end",
+    b" end",
+    b" _nmlzp, _nmlzw = s:sub(i), w",
+    b" return file.write(table.concat(o)) and r",
+    b"end",
+]
+
+
+class TCPSerial(object):
+    """A serial-port-like connection to a NodeMCU Lua console over TCP.
+
+    This allows file operations to be performed at network speeds on devices
+    running a (raw, i.e. no option negotiation) telnet server which relays
+    the Lua console, including the echo of input, just like the UART does.
+    The connection has Nagle's algorithm disabled and TCP keepalive enabled.
+
+    Such consoles usually relay the output of the interpreter using
+    node.output, which does not see data written directly to the UART (using
+    uart.write) and so :py:class:`NodeMCU` only uses print to return results
+    (see :py:attr:`print_only`).
+    """
+
+    DEFAULT_PORT = 23
+
+    # Results must be returned using print (see NodeMCU)
+    print_only = True
+
+    def __init__(self, host, port=DEFAULT_PORT, timeout=2.0):
+        """Connect to a Lua console.
+
+        Parameters
+        ----------
+        host : str
+        port : int
+        timeout : float
+            Timeout (in seconds) for connecting and for each read.
+        """
+        import socket
+        self.timeout = timeout
+        self.socket = socket.create_connection((host, port), timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        # Data received but not yet read
+        self._buffer = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def close(self):
+        self.socket.close()
+
+    def _recv(self, timeout):
+        """Receive whatever is available, waiting at most timeout seconds.
+        Returns False if nothing arrived."""
+        if not select.select([self.socket], [], [], max(timeout, 0))[0]:
+            return False
+        data = self.socket.recv(4096)
+        self._buffer += data
+        return bool(data)
+
+    @property
+    def in_waiting(self):
+        while self._recv(0):
+            pass
+        return len(self._buffer)
+
+    def read(self, length):
+        """Read length bytes, returning short if the timeout expires."""
+        deadline = time.time() + self.timeout
+        while (len(self._buffer) < length and
+               self._recv(deadline - time.time())):
+            pass
+        data = self._buffer[:length]
+        self._buffer = self._buffer[length:]
+        return data
+
+    def write(self, data):
+        self.socket.sendall(data)
+        return len(data)
+
+
+def open_transport(port, baudrate, timeout=2.0, rtscts=False,
+                   xonxoff=False):
+    """Open a connection to a device.
+
+    Parameters
+    ----------
+    port : str
+        Either a serial port name/path or a URL of the form
+        ``tcp://host[:port]`` to connect via :py:class:`TCPSerial`.
+    baudrate : int
+        Baudrate (ignored for TCP connections).
+    timeout : float
+    rtscts : bool
+        Enable RTS/CTS hardware flow control (serial ports only).
+    xonxoff : bool
+        Enable XON/XOFF software flow control (serial ports only).
+    """
+    if port.startswith("tcp://"):
+        host, _, tcp_port = port[len("tcp://"):].partition(":")
+        return TCPSerial(host, int(tcp_port or TCPSerial.DEFAULT_PORT),
+                         timeout=timeout)
+    else:
+        import serial
+        flow_control = {}
+        if rtscts:
+            flow_control["rtscts"] = True
+        if xonxoff:
+            flow_control["xonxoff"] = True
+        return serial.Serial(port, baudrate, timeout=timeout, **flow_control)
+
+
+class SerialRecorder(object):
+    """Wraps a serial port, recording a timestamped transcript of all data
+    sent and received.
+
+    The transcript is a series of ASCII lines of the form::
+
+        <seconds since start> <direction> <hex data>
+
+    Where direction is ">" for data sent to the device and "<" for data
+    received from it. Consecutive transfers in the same direction which occur
+    within `merge_interval` seconds of each other are merged into a single
+    line to keep the transcript compact (e.g. the byte-at-a-time reads made by
+    :py:meth:`NodeMCU.read_line`).
+    """
+
+    # The number of characters' transfer time (at the port's baudrate) used
+    # as the default merge_interval, allowing for delays between reads
+    MERGE_CHARACTERS = 4
+
+    def __init__(self, serial, transcript, merge_interval=None):
+        """
+        Parameters
+        ----------
+        serial : :py:class:`serial.Serial`
+            The serial port to wrap.
+        transcript : file
+            A (binary) file into which the transcript will be written.
+        merge_interval : float or None
+            Maximum gap (in seconds) between consecutive transfers in the same
+            direction for them to be merged into one transcript line. If None,
+            the time taken to transfer a few characters at the port's
+            baudrate, or 1 ms if that is shorter or the baudrate is unknown.
+        """
+        self.serial = serial
+        self.transcript = transcript
+        if merge_interval is None:
+            merge_interval = 0.001
+            baudrate = getattr(serial, "baudrate", None)
+            if isinstance(baudrate, (int, float)) and baudrate:
+                # 10 bits (including start and stop bits) per character
+                merge_interval = max(
+                    merge_interval, self.MERGE_CHARACTERS * 10.0 / baudrate)
+        self.merge_interval = merge_interval
+
+        self._start = time.time()
+
+        # [direction, start time, time of last transfer, data] of the
+        # transcript line not yet written out.
+        self._pending = None
+
+    def __enter__(self):
+        return self.serial.__enter__()
+
+    def __exit__(self, *args, **kwargs):
+        self.flush_transcript()
+        return self.serial.__exit__(*args, **kwargs)
+
+    @property
+    def in_waiting(self):
+        return self.serial.in_waiting
+
+    @property
+    def print_only(self):
+        return getattr(self.serial, "print_only", False)
+
+    def _record(self, direction, data):
+        if not data:
+            return
+
+        now = time.time() - self._start
+        if (self._pending is not None and
+                self._pending[0] == direction and
+                now - self._pending[2] <= self.merge_interval):
+            self._pending[2] = now
+            self._pending[3] += data
+        else:
+            self.flush_transcript()
+            self._pending = [direction, now, now, data]
+
+    def flush_transcript(self):
+        """Write out any transcript line which is still being accumulated."""
+        if self._pending is not None:
+            direction, start, _, data = self._pending
+            self.transcript.write("{:.6f} {} {}\n".format(
+                start, direction, hexlify(data).decode("ascii")
+            ).encode("ascii"))
+            self._pending = None
+
+    def read(self, length):
+        data = self.serial.read(length)
+        self._record("<", data)
+        return data
+
+    def write(self, data):
+        written = self.serial.write(data)
+        self._record(">", data[:written])
+        return written
+
+
+def read_transcript(stream):
+    """Parse a transcript produced by :py:class:`SerialRecorder`.
+
+    Returns
+    -------
+    [(time, direction, data), ...]
+    """
+    transcript = []
+    for line in stream:
+        line = line.strip()
+        if line:
+            time_, direction, data = line.decode("ascii").split(" ")
+            transcript.append((float(time_), direction, unhexlify(data)))
+    return transcript
+
+
+class SerialReplay(object):
+    """A pretend serial port which plays back a transcript recorded by
+    :py:class:`SerialRecorder`.
+
+    Data received from the device is made available with the same latency
+    (relative to the preceding write) as in the original recording, scaled by
+    `time_scale`. This allows protocol and host-side changes to be benchmarked
+    against a real session without any hardware attached.
+    """
+
+    def __init__(self, transcript, time_scale=1.0, strict=True):
+        """
+        Parameters
+        ----------
+        transcript : [(time, direction, data), ...]
+            A transcript, e.g. as returned by :py:func:`read_transcript`.
+        time_scale : float
+            Factor by which recorded latencies are multiplied. 0 replays as
+            fast as possible.
+        strict : bool
+            If True, data written must match the recording exactly, otherwise
+            an IOError is raised. If False, writes are only counted.
+        """
+        self.time_scale = time_scale
+        self.strict = strict
+
+        # [(time, data), ...]
+        self._outbound = []
+        # [(time, data, index of preceding outbound transfer or -1), ...]
+        self._inbound = []
+        for time_, direction, data in transcript:
+            if direction == ">":
+                self._outbound.append((time_, data))
+            else:
+                self._inbound.append((time_, data, len(self._outbound) - 1))
+
+        # Position in the outbound transfers and the wall-clock time at which
+        # each was completed.
+        self._out_index = 0
+        self._out_offset = 0
+        self._written_at = []
+
+        # Position in the inbound transfers
+        self._in_index = 0
+        self._in_offset = 0
+
+        self._start = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
+    def _ready_time(self, index):
+        """Get the wall-clock time at which the given inbound transfer becomes
+        available or None if the writes it follows have not yet happened."""
+        time_, _, ref = self._inbound[index]
+        if ref < 0:
+            return self._start + (time_ * self.time_scale)
+        elif ref < len(self._written_at):
+            return (self._written_at[ref] +
+                    ((time_ - self._outbound[ref][0]) * self.time_scale))
+        else:
+            return None
+
+    @property
+    def in_waiting(self):
+        now = time.time()
+        waiting = 0
+        offset = self._in_offset
+        for index in range(self._in_index, len(self._inbound)):
+            ready = self._ready_time(index)
+            if ready is None or ready > now:
+                break
+            waiting += len(self._inbound[index][1]) - offset
+            offset = 0
+        return waiting
+
+    def read(self, length):
+        """Read up to length bytes, waiting as long as the recording did. If
+        the recording has no more data before the next write, returns short
+        (as a real port would on timeout)."""
+        data = b""
+        while len(data) < length and self._in_index < len(self._inbound):
+            ready = self._ready_time(self._in_index)
+            if ready is None:
+                break
+            delay = ready - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            event = self._inbound[self._in_index][1]
+            chunk = event[self._in_offset:
+                          self._in_offset + length - len(data)]
+            data += chunk
+            self._in_offset += len(chunk)
+            if self._in_offset == len(event):
+                self._in_index += 1
+                self._in_offset = 0
+        return data
+
+    def write(self, data):
+        remaining = data
+        while remaining and self._out_index < len(self._outbound):
+            event = self._outbound[self._out_index][1]
+            expected = event[self._out_offset:]
+            n = min(len(expected), len(remaining))
+            if self.strict and remaining[:n] != expected[:n]:
+                raise IOError(
+                    "Replay diverged from transcript "
+                    "(got {} not {}).".format(repr(remaining[:n]),
+                                              repr(expected[:n])))
+            remaining = remaining[n:]
+            self._out_offset += n
+            if self._out_offset == len(event):
+                self._written_at.append(time.time())
+                self._out_index += 1
+                self._out_offset = 0
+
+        if remaining and self.strict:
+            raise IOError("Replay has no further writes.")
+
+        return len(data)
+
+
+def _locked(method):
+    """Decorator for :py:class:`NodeMCU` methods which holds the device's lock
+    for the duration of the call."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class NodeMCU(object):
-    """Utilities which allow basic control of an ESP8266 running NodeMCU."""
+    """Utilities which allow basic control of an ESP8266 running NodeMCU.
+
+    Instances may be shared between threads: each method holds
+    :py:attr:`lock` while it runs. Code which issues several low-level
+    commands (e.g. :py:meth:`send_command` followed by :py:meth:`read_line`)
+    should hold the lock itself to keep them together.
+    """
+
+    # The longest prompt which may precede the echo of a command.
+    MAX_PROMPT_LENGTH = len(b">> ")
+
+    # The longest line accepted by the Lua interpreter.
+    MAX_LINE_LENGTH = 255
+
+    # For heap-aware transfers, the fraction of the free heap which may be used
+    # by the data transferred in a single command.
+    HEAP_FRACTION = 16
 
-    def __init__(self, serial, verbose_stream=None):
+    # For heap-aware transfers, the number of blocks after which the free heap
+    # is checked again.
+    HEAP_PROBE_INTERVAL = 32
+
+    # For heap-aware transfers, the smallest usable per-command budget (below
+    # which the device is considered to be out of heap).
+    MIN_HEAP_BUDGET = 16
+
+    # For heap-aware reads, the largest block read at once.
+    MAX_READ_BLOCK_SIZE = 1024
+
+    # Encodings supported by :py:meth:`write_file`.
+    ENCODINGS = ("escape", "base64", "auto")
+
+    def __init__(self, serial, verbose_stream=None, max_outstanding=None,
+                 max_retries=0, print_only=None):
         """Connect to a device at the end of a specific serial port.
 
         Parameters
@@ -49,9 +1169,57 @@ class NodeMCU(object):
         verbose_stream : file or None
             If not None, the data received via serial is written into the
             provided (binary) file.
+        max_outstanding : int or None
+            If not None, commands are sent in chunks of at most this many
+            bytes, waiting for each chunk to be echoed back before sending the
+            next. This prevents overrunning the device's small UART receive
+            buffer at high baudrates while it is busy.
+        max_retries : int
+            The number of times a failed block of a file write is retried
+            (after resynchronising with the interpreter, see
+            :py:meth:`resync`) before giving up. After any retry, the size of
+            the written file is checked and if it is wrong (since a failed
+            block may have written past the end), it is written again (up to
+            max_retries times).
+        print_only : bool or None
+            If True, raw data (e.g. file contents) is returned by the device
+            using print rather than uart.write, for consoles which only relay
+            printed output. If None, the serial port's `print_only` attribute
+            is used, if it has one (see :py:class:`TCPSerial`).
         """
         self.serial = serial
         self.verbose_stream = verbose_stream
+        self.max_outstanding = max_outstanding
+        self.max_retries = max_retries
+        if print_only is None:
+            print_only = getattr(serial, "print_only", False) is True
+        self.print_only = print_only
+
+        # Number of corrupted command echoes seen (e.g. due to UART overruns)
+        self.overruns = 0
+
+        # Number of failed blocks which have been retried
+        self.retries = 0
+
+        # Totals over all calls to write_file: the bytes of file data, the
+        # bytes actually sent (after any compression) and the time taken
+        self.bytes_written = 0
+        self.bytes_sent = 0
+        self.write_time = 0.0
+
+        # Used to make resynchronisation tokens unique
+        self._sync_count = 0
+
+        # Held while communicating with the device
+        self.lock = threading.RLock()
+
+        # Whether the device has encoder.fromBase64 (None if unknown)
+        self._has_base64 = None
+
+        # Names of the helper functions defined on the device
+        self._defined = set()
+
+        self._chip_id = None
 
     def __enter__(self):
         """Close the serial port using a context manager."""
@@ -79,6 +1247,23 @@ class NodeMCU(object):
             raise IOError("Timeout.")
         return written
 
+    def _raw_output(self, expression):
+        """Lua code which outputs the string value of an expression exactly,
+        to be read using :py:meth:`_read_raw`."""
+        if self.print_only:
+            return b"print(" + expression + b")"
+        else:
+            return b"uart.write(0, " + expression + b")"
+
+    def _read_raw(self, length):
+        """Read data output using :py:meth:`_raw_output`."""
+        data = self.read(length)
+        if self.print_only:
+            # Absorb the newline added by print
+            self.read_line()
+        return data
+
+    @_locked
     def read_line(self, line_ending=b"\r\n"):
         """Read from the port until the given terminator string is found.
 
@@ -97,20 +1282,145 @@ class NodeMCU(object):
             data += self.read(1)
         return data[:-len(line_ending)]
 
+    @_locked
     def flush(self):
         """Dispose of anything remaining in the input buffer."""
         while self.serial.in_waiting:
             self.read(self.serial.in_waiting)
 
+    @_locked
     def send_command(self, cmd):
         """Send a single-line Lua command.
 
-        Also absorbs the echo back and newline.
+        Also absorbs the echo back and newline. If the echo does not match the
+        command (e.g. due to a UART overrun), :py:attr:`overruns` is
+        incremented and an IOError is raised. When sending in paced chunks
+        (see `max_outstanding`), this happens before the (corrupt) command is
+        completed and executed.
+        """
+        if self.max_outstanding:
+            echo = b""
+            for offset in range(0, len(cmd), self.max_outstanding):
+                chunk = cmd[offset:offset + self.max_outstanding]
+                self.write(chunk)
+                echo += self.read(len(chunk))
+                # The first chunk's echo may be preceded by a prompt (if
+                # nothing more arrives, the echo was simply corrupt)
+                try:
+                    while (offset == 0 and not echo.endswith(chunk) and
+                           len(echo) < len(chunk) + self.MAX_PROMPT_LENGTH):
+                        echo += self.read(1)
+                except IOError:
+                    pass
+                if not echo.endswith(cmd[:offset + len(chunk)]):
+                    self.overruns += 1
+                    raise IOError("Command echo corrupted (overrun?)!")
+            self.write(b"\r\n")
+            echo += self.read_line()
+        else:
+            self.write(cmd + b"\r\n")
+            # Absorb the print-back
+            echo = self.read_line()
+
+        if not echo.endswith(cmd):
+            self.overruns += 1
+            raise IOError("Command echo corrupted (overrun?)!")
+
+    @_locked
+    def resync(self, attempts=3):
+        """Bring the interpreter back into a known state after an error.
+
+        Any pending input is discarded and any partial line sent to the device
+        is terminated. A command printing a unique token is then sent until
+        the token is seen.
+
+        Parameters
+        ----------
+        attempts : int
+            The number of times to send the token before giving up with an
+            IOError.
+        """
+        for _ in range(attempts):
+            self.flush()
+            self._sync_count += 1
+            token = "nmsync{}".format(self._sync_count).encode("ascii")
+            # NB: The token is split so that the echo does not contain it
+            self.write(b"\r\nprint('" + token[:3] + b"' .. '" +
+                       token[3:] + b"')\r\n")
+            try:
+                self.read_line(token)
+                self.read_line()
+                return
+            except IOError:
+                pass
+        raise IOError("Could not resynchronise with the interpreter!")
+
+    @_locked
+    def run_batch(self, statements, separator=b"; "):
+        """Run several Lua statements, packed into as few commands as the
+        interpreter's line length allows.
+
+        Each command is only sent once the results of the previous one have
+        been read. Note that if a statement fails, the rest of its command is
+        not run and the error message is returned in place of the next
+        result (if any).
+
+        Parameters
+        ----------
+        statements : [bytes, ...]
+            Lua statements. Those beginning with '=' (as in the interactive
+            interpreter) are expressions whose values are printed on a single
+            line.
+        separator : bytes
+            Placed between statements packed into one command. Use b" " to
+            pack the lines of a multi-line statement (e.g. a function
+            definition).
+
+        Returns
+        -------
+        [bytes, ...]
+            The printed values of each expression, in order.
+        """
+        # [(command, number of results), ...]
+        commands = []
+        for statement in statements:
+            results = 0
+            if statement.startswith(b"="):
+                statement = b"print(" + statement[1:] + b")"
+                results = 1
+            if (commands and
+                    len(commands[-1][0] + separator + statement) <=
+                    self.MAX_LINE_LENGTH):
+                command, num_results = commands[-1]
+                commands[-1] = (command + separator + statement,
+                                num_results + results)
+            else:
+                commands.append((statement, results))
+
+        results = []
+        for command, num_results in commands:
+            self.send_command(command)
+            results.extend(self.read_line() for _ in range(num_results))
+        return results
+
+    @_locked
+    def define(self, name, lua):
+        """Define a Lua helper function on the device, if not already defined
+        during this session.
+
+        Parameters
+        ----------
+        name : str
+            Name of the function (used only to track what has been defined).
+        lua : [bytes, ...]
+            The lines of Lua source of the definition, sent using as few
+            commands as possible (see :py:meth:`run_batch`).
         """
-        self.write(cmd + b"\r\n")
-        # Absorb the print-back
-        self.read_line()
+        if name not in self._defined:
+            self.run_batch([line.strip() for line in lua], b" ")
+            self._defined.add(name)
 
+    @_locked
     def get_version(self):
         """Get the version number of the remote device.
 
@@ -122,7 +1432,98 @@ class NodeMCU(object):
         info = list(map(int, self.read_line().split(b"\t")))
         return (info[0], info[1])
 
-    def write_file(self, filename, data, block_size=64):
+    @_locked
+    def get_heap(self):
+        """Get the number of bytes of free heap on the device."""
+        self.send_command(b"=node.heap()")
+        return int(self.read_line())
+
+    @_locked
+    def get_fs_info(self):
+        """Get information about the flash filesystem.
+
+        Returns
+        -------
+        (remaining, used, total)
+            In bytes.
+        """
+        self.send_command(b"=file.fsinfo()")
+        return tuple(map(int, self.read_line().split(b"\t")))
+
+    def _heap_budget(self):
+        """Get the number of bytes which a single transfer command may use
+        given the currently free heap."""
+        heap = self.get_heap()
+        budget = heap // self.HEAP_FRACTION
+        if budget < self.MIN_HEAP_BUDGET:
+            raise IOError("Not enough free heap! ({} bytes)".format(heap))
+        return budget
+
+    @_locked
+    def has_base64(self):
+        """Test whether the device can decode base64 (using
+        encoder.fromBase64). The result is cached for the session."""
+        if self._has_base64 is None:
+            self.send_command(
+                b"=encoder ~= nil and encoder.fromBase64 ~= nil")
+            self._has_base64 = self.read_line() == b"true"
+        return self._has_base64
+
+    def _write_block_command(self, data, offset, block_size, encodings,
+                             max_length=None, function=b"file.write"):
+        """Build the command to write the next block of data.
+
+        Parameters
+        ----------
+        data : bytes
+        offset : int
+            The start of the block within data.
+        block_size : int
+            The number of bytes to write (if max_length is None).
+        encodings : [str, ...]
+            The encodings which may be used. The one giving the shortest
+            command is chosen or, if max_length is given, the one which
+            fits the most data.
+        max_length : int or None
+            If given, the block is as large as possible while the encoded
+            data is at most this many characters long.
+        function : bytes
+            The Lua function the block is passed to.
+
+        Returns
+        -------
+        (command, num_bytes)
+        """
+        candidates = []
+        if "escape" in encodings:
+            prefix, suffix = b"=" + function + b"(", b")"
+            if max_length is not None:
+                block_size = lua_bytes_length(
+                    data, offset,
+                    min(max_length,
+                        self.MAX_LINE_LENGTH - len(prefix + suffix)))
+            block = data[offset:offset + block_size]
+            candidates.append((prefix + lua_bytes(block) + suffix,
+                               len(block)))
+        if "base64" in encodings:
+            prefix = b"=" + function + b"(encoder.fromBase64('"
+            suffix = b"'))"
+            if max_length is not None:
+                length = min(max_length - 2,
+                             self.MAX_LINE_LENGTH - len(prefix + suffix))
+                # At least one base64 group so that the write progresses
+                block_size = 3 * max(1, length // 4)
+            block = data[offset:offset + block_size]
+            candidates.append((prefix + b64encode(block) + suffix,
+                               len(block)))
+        return min(candidates,
+                   key=lambda c: (-c[1], len(c[0])) if max_length else
+                   len(c[0]))
+
+    @_locked
+    def write_file(self, filename, data, block_size=64, heap_aware=False,
+                   encoding="escape", compress=False, write_buffer=0,
+                   flush_interval=None):
         """Write a file to the device's flash.
 
         Parameters
@@ -133,22 +1534,443 @@ class NodeMCU(object):
             The data to write into the file.
         block_size : int
             The number of bytes to write at a time.
+        heap_aware : bool
+            If True, the write is refused up-front if it will not fit in the
+            remaining flash and the block size is chosen (and periodically
+            revised) according to the device's free heap and the interpreter's
+            maximum line length, ignoring block_size.
+        encoding : "escape", "base64" or "auto"
+            How data is sent to the device. "escape" uses escaped Lua string
+            literals (up to 4 characters per byte for binary data). "base64"
+            uses base64 (4 characters per 3 bytes) decoded on the device by
+            encoder.fromBase64 which must be available. "auto" picks whichever
+            gives the shorter command for each block, using base64 only if
+            the device supports it.
+        compress : bool
+            If True, data is compressed using :py:func:`lz_compress` and
+            decompressed on the device (unless this would not reduce the
+            amount of data sent). If a block fails, the whole file is sent
+            again, up to max_retries times in total.
+        write_buffer : int
+            If non-zero, blocks are accumulated in a buffer on the device and
+            only written to flash once at least this many bytes are buffered
+            (and at the end of the file). Fewer, larger writes are faster and
+            cause less flash wear. The device must have enough free heap for
+            the buffer plus one block. If a block fails, everything since the
+            last write to flash is sent again, up to max_retries times in
+            total between writes to flash. Ignored for compressed data, which
+            the decompressor writes in chunks of 256 bytes.
+        flush_interval : int or None
+            With write_buffer, flush the file (file.flush) after every this
+            many writes to flash. The file is always flushed after the final
+            write.
+
+        Returns
+        -------
+        True if the data was sent compressed, False otherwise. The sizes
+        before and after compression and the time taken are also added to
+        :py:attr:`bytes_written`, :py:attr:`bytes_sent` and
+        :py:attr:`write_time`.
         """
-        self.send_command(b"file.close()")
-        self.send_command(b"=file.open(" + lua_string(filename) + b", 'w')")
-        if self.read_line() != b"true":
-            raise IOError("Could not open file for writing!")
-        while data:
-            block = data[:block_size]
-            data = data[block_size:]
-            self.send_command(b"=file.write(" + lua_bytes(block) + b")")
-            response = self.read_line()
-            if response != b"true":
-                raise IOError("Write failed! (Return value: {})".format(
-                    repr(response)))
-        self.send_command(b"file.close()")
+        start = time.time()
+        if encoding not in self.ENCODINGS:
+            raise ValueError("Unknown encoding {}".format(repr(encoding)))
+        elif encoding == "escape":
+            encodings = ["escape"]
+        elif encoding == "base64":
+            if not self.has_base64():
+                raise IOError("Device does not support base64!")
+            encodings = ["base64"]
+        elif self.has_base64():
+            encodings = ["escape", "base64"]
+        else:
+            encodings = ["escape"]
+
+        if heap_aware:
+            self.send_command(b"=file.list()[" + lua_string(filename) +
+                              b"] or 0, file.fsinfo()")
+            existing, remaining, _, _ = map(int,
+                                            self.read_line().split(b"\t"))
+            if len(data) > remaining + existing:
+                raise IOError(
+                    "Not enough space! ({} bytes needed, {} free)".format(
+                        len(data), remaining + existing))
+
+        length = len(data)
+        function = b"file.write"
+        if compress:
+            compressed = lz_compress(data)
+
+            # Compare the characters sent with and without compression
+            # (including defining the decompressor)
+            def cost(data, function):
+                return sum(len(self._write_block_command(
+                    data, offset, block_size, encodings, None, function)[0])
+                    for offset in range(0, len(data), block_size))
+            overhead = (sum(map(len, LZ_DECOMPRESS_LUA))
+                        if "_nmlz" not in self._defined else 0)
+            if (cost(compressed, b"_nmlz") + overhead <
+                    cost(data, b"file.write")):
+                self.define("_nmlz", LZ_DECOMPRESS_LUA)
+                data, function = compressed, b"_nmlz"
+
+        buffering = bool(write_buffer) and function == b"file.write"
+        if buffering:
+            self.define("_nmba", WRITE_BUFFER_LUA)
+            function = b"_nmba"
+
+        def open_for_write():
+            opened, = self.run_batch(
+                [b"file.close()",
+                 b"=file.open(" + lua_string(filename) + b", 'w')"] +
+                ([b"_nmlzp, _nmlzw = '', ''"]
+                 if function == b"_nmlz" else []) +
+                ([b"_nmb = {}"] if buffering else []))
+            if opened != b"true":
+                raise IOError("Could not open file for writing!")
+
+        open_for_write()
+        offset = 0
+        # Data before this offset is no longer buffered on the device
+        written = 0
+        num_blocks = 0
+        num_writes = 0
+        failures = 0
+        retried = False
+        rewrites = 0
+        max_length = None
+        while offset < len(data):
+            if heap_aware and num_blocks % self.HEAP_PROBE_INTERVAL == 0:
+                max_length = self._heap_budget()
+            command, num_bytes = self._write_block_command(
+                data, offset, block_size, encodings, max_length, function)
+            end = offset + num_bytes
+            write = (buffering and
+                     (end == len(data) or end - written >= write_buffer))
+            if write:
+                flush = end == len(data) or (
+                    flush_interval and (num_writes + 1) % flush_interval == 0)
+                # The function names are the same length so the block is too
+                command, num_bytes = self._write_block_command(
+                    data, offset, block_size, encodings, max_length,
+                    b"_nmbf" if flush else b"_nmbw")
+            try:
+                self.send_command(command)
+                response = self.read_line()
+                if response != b"true":
+                    raise IOError("Write failed! (Return value: {})".format(
+                        repr(response)))
+            except IOError:
+                failures += 1
+                if failures > self.max_retries:
+                    raise
+                self.retries += 1
+                retried = True
+                self.resync()
+                if function == b"_nmlz":
+                    # The decompressor's state is unknown: start again
+                    offset = 0
+                    self._reopen_for_write(filename, offset)
+                    self.send_command(b"_nmlzp, _nmlzw = '', ''")
+                elif buffering:
+                    # The buffered data may have been lost
+                    offset = written
+                    self._reopen_for_write(filename, offset)
+                    self.send_command(b"_nmb = {}")
+                else:
+                    self._reopen_for_write(filename, offset)
+                continue
+            if function == b"file.write" or write:
+                # Compressed data is always resent from the start and
+                # buffered data from the last write to flash so until then,
+                # failures are counted together
+                failures = 0
+            offset += num_bytes
+            num_blocks += 1
+            if write:
+                written = offset
+                num_writes += 1
+            if offset == len(data) and retried:
+                # Reopening the file to retry a block cannot truncate it so a
+                # failed block may have left data beyond the end: if so, write
+                # the file again from scratch
+                size, = self.run_batch([
+                    b"file.close()",
+                    b"=file.list()[" + lua_string(filename) + b"]"])
+                if size != str(length).encode("ascii"):
+                    rewrites += 1
+                    if rewrites > self.max_retries:
+                        raise IOError("Wrong file size after retrying write!")
+                    self.retries += 1
+                    retried = False
+                    open_for_write()
+                    offset = written = num_blocks = num_writes = 0
+        self.run_batch([b"file.close()"] +
+                       ([b"_nmlzp, _nmlzw = nil, nil"]
+                        if function == b"_nmlz" else []) +
+                       ([b"_nmb = nil"] if buffering else []))
+
+        self.bytes_written += length
+        self.bytes_sent += len(data)
+        self.write_time += time.time() - start
+        return function == b"_nmlz"
+
+    def _reopen_for_write(self, filename, offset):
+        """Reopen a partially written file, ready to write at offset."""
+        position, = self.run_batch([
+            b"file.close()",
+            b"=file.open(" + lua_string(filename) +
+            ", 'r+') and file.seek('set', {})".format(offset).encode("ascii")])
+        if position != str(offset).encode("ascii"):
+            raise IOError("Could not reopen file to retry write!")
+
+    # Name of the temporary file used by :py:meth:`write_files`.
+    ARCHIVE_FILENAME = "_nmcul.pak"
+
+    @_locked
+    def write_files(self, files, block_size=64, buffer_size=256,
+                    heap_aware=False, encoding="escape", compress=False,
+                    write_buffer=0, flush_interval=None):
+        """Write many files to the device's flash as a single archive.
+
+        This is much faster than calling :py:meth:`write_file` for many small
+        files. The archive is uploaded as a single file and then unpacked on
+        the device. Note that enough flash to hold both the archive and the
+        unpacked files is required.
+
+        Parameters
+        ----------
+        files : [(filename, data), ...]
+        block_size : int
+            The number of bytes to write at a time when uploading.
+        buffer_size : int
+            The number of bytes copied at a time when unpacking on the device.
+        heap_aware : bool
+            See :py:meth:`write_file`. Note that only space for the archive
+            is checked up-front.
+        encoding : str
+            See :py:meth:`write_file`.
+        compress, write_buffer, flush_interval
+            See :py:meth:`write_file`.
+
+        Returns
+        -------
+        True if the archive was sent compressed, False otherwise.
+        """
+        compressed = self.write_file(
+            self.ARCHIVE_FILENAME, pack_archive(files), block_size,
+            heap_aware, encoding, compress, write_buffer, flush_interval)
+
+        self.run_batch([line.strip() for line in UNPACK_ARCHIVE_LUA], b" ")
+        response, = self.run_batch([
+            "=_nmunpack({}, {})".format(
+                lua_string(self.ARCHIVE_FILENAME).decode("ascii"),
+                buffer_size).encode("ascii"),
+            b"_nmunpack = nil"])
+        if response != str(len(files)).encode("ascii"):
+            raise IOError("Unpacking failed! (Return value: {})".format(
+                repr(response)))
+        return compressed
+
+    @_locked
+    def compiled_is_current(self, filename, data, remove_source=False,
+                            files=None):
+        """Check whether a Lua source file has already been written and
+        compiled (see :py:meth:`compile_file`) with the given contents.
 
-    def read_file(self, filename, block_size=64):
+        Parameters
+        ----------
+        filename : str
+            The name of the '.lua' file.
+        data : bytes
+            The source code.
+        remove_source : bool
+            Whether the source was removed after compilation (in which case
+            the stamp file left by :py:meth:`compile_file` is checked).
+        files : {filename: size, ...} or None
+            The result of :py:meth:`list_files` if already known.
+        """
+        if files is None:
+            files = self.list_files()
+        stem = _lua_stem(filename)
+        if stem + ".lc" not in files:
+            return False
+        elif remove_source:
+            return (stem + ".lch" in files and
+                    self.read_file(stem + ".lch") ==
+                    "{} {}".format(len(data), adler32(data)).encode("ascii"))
+        else:
+            return (filename in files and
+                    self.file_hash(filename) == (len(data), adler32(data)))
+
+    @_locked
+    def compile_file(self, filename, remove_source=False):
+        """Compile a Lua file in flash into bytecode using node.compile.
+
+        Parameters
+        ----------
+        filename : str
+            The '.lua' file to compile into a '.lc' file.
+        remove_source : bool
+            If True, the '.lua' file is removed after compilation, leaving a
+            small '.lch' stamp file recording its size and hash.
+        """
+        stem = _lua_stem(filename)
+
+        # Remove any old bytecode to be sure that the compiler produced some
+        response, size = self.run_batch([
+            b"file.remove(" + lua_string(stem + ".lc") + b")",
+            b"=pcall(node.compile, " + lua_string(filename) + b")",
+            b"=file.list()[" + lua_string(stem + ".lc") + b"]"])
+        if response != b"true":
+            raise IOError("Compile failed! (Return value: {})".format(
+                repr(response)))
+        try:
+            int(size)
+        except ValueError:
+            raise IOError("Compile failed! (No bytecode produced)")
+
+        if remove_source:
+            size, hash_ = self.file_hash(filename)
+            self.write_file(stem + ".lch",
+                            "{} {}".format(size, hash_).encode("ascii"))
+            self.send_command(b"file.remove(" + lua_string(filename) + b")")
+        else:
+            self.send_command(b"file.remove(" +
+                              lua_string(stem + ".lch") + b")")
+
+    @_locked
+    def write_compiled(self, filename, data, block_size=64,
+                       remove_source=False, heap_aware=False,
+                       encoding="escape", compress=False, write_buffer=0,
+                       flush_interval=None):
+        """Write a Lua source file to flash and compile it (see
+        :py:meth:`compile_file`), unless it is already present and compiled.
+        See :py:meth:`write_file` for heap_aware, encoding, compress,
+        write_buffer and flush_interval.
+
+        Returns
+        -------
+        True if the file was written and compiled, False if it was skipped.
+
+        Raises
+        ------
+        ValueError
+            If the file is not a '.lua' file or is init.lua (which must be
+            kept as source to be run at boot). Nothing is written.
+        """
+        if not _compilable(filename):
+            raise ValueError(
+                "Only '.lua' files other than init.lua can be compiled.")
+        if self.compiled_is_current(filename, data, remove_source):
+            return False
+        self.write_file(filename, data, block_size, heap_aware, encoding,
+                        compress, write_buffer, flush_interval)
+        self.compile_file(filename, remove_source)
+        return True
+
+    @_locked
+    def measure_link(self, size=128, repeats=3):
+        """Measure the speed of the connection to the device.
+
+        Short and long (no-op) commands are timed. The long commands' extra
+        characters (which are echoed back) give the throughput and the time
+        taken by the short ones gives the per-command latency.
+
+        Parameters
+        ----------
+        size : int
+            The extra characters in each long command.
+        repeats : int
+            The number of each command to time.
+
+        Returns
+        -------
+        (latency, char_rate)
+            The time (in seconds) taken by a minimal command and the number
+            of extra command characters which take one more second.
+        """
+        times = []
+        for cmd in (b"=0", b"=#'" + b"x" * size + b"'"):
+            start = time.time()
+            for _ in range(repeats):
+                self.send_command(cmd)
+                self.read_line()
+            times.append((time.time() - start) / repeats)
+        latency, long_time = times
+        return (latency, size / max(long_time - latency, 1e-6))
+
+    @_locked
+    def get_chip_id(self):
+        """Get the (cached) chip ID of the device."""
+        if self._chip_id is None:
+            self.send_command(b"=node.chipid()")
+            self._chip_id = int(self.read_line())
+        return self._chip_id
+
+    @_locked
+    def file_hash(self, filename):
+        """Get the size and Adler-32 checksum of a file in flash.
+
+        The checksum is computed on the device and so only a single round trip
+        is needed (after the first call in a session).
+
+        Returns
+        -------
+        (size, hash)
+        """
+        self.define("_nmhash", HASH_FILE_LUA)
+        self.send_command(b"=_nmhash(" + lua_string(filename) + b")")
+        try:
+            size, high, low = map(int, self.read_line().split(b"\t"))
+        except ValueError:
+            raise IOError("File does not exist!")
+        return (size, (high << 16) | low)
+
+    @_locked
+    def get_inventory(self):
+        """Get a description of the device's firmware, memory and files.
+
+        The information is gathered in a single round trip (after the first
+        call in a session).
+
+        Returns
+        -------
+        {"version": "major.minor.dev", "info": [int, ...], "chip_id": int,
+         "heap": int, "fs_remaining": int, "fs_used": int, "fs_total": int,
+         "files": {filename: {"size": int, "hash": int}, ...}}
+            "info" holds all of the values returned by node.info(). Hashes are
+            as computed by :py:meth:`file_hash`.
+        """
+        self.define("_nmhash", HASH_FILE_LUA)
+        self.define("_nminv", [
+            line.replace(b"uart.write(0, f)", self._raw_output(b"f"))
+            for line in INVENTORY_LUA])
+        self.send_command(b"_nminv()")
+        info = list(map(int, self.read_line().split(b"\t")))
+        chip_id, heap, remaining, used, total = map(
+            int, self.read_line().split(b"\t"))
+        files = {}
+        for _ in range(int(self.read_line())):
+            filename = self._read_raw(int(self.read_line())).decode("utf-8")
+            size, high, low = map(int, self.read_line().split(b"\t"))
+            files[filename] = {"size": size, "hash": (high << 16) | low}
+
+        self._chip_id = chip_id
+        return {
+            "version": ".".join(map(str, info[:3])),
+            "info": info,
+            "chip_id": chip_id,
+            "heap": heap,
+            "fs_remaining": remaining,
+            "fs_used": used,
+            "fs_total": total,
+            "files": files,
+        }
+
+    @_locked
+    def read_file(self, filename, block_size=64, cache=None,
+                  heap_aware=False):
         """Read file from the device's flash.
 
         Parameters
@@ -157,39 +1979,85 @@ class NodeMCU(object):
             File to read from device.
         block_size : int
             The number of bytes to read at a time.
+        cache : :py:class:`FileCache` or None
+            If given, the file's hash is checked on the device and, if the
+            file is unchanged, the cached copy is returned. Otherwise the file
+            is read and added to the cache.
+        heap_aware : bool
+            If True, the block size is chosen (and periodically revised)
+            according to the device's free heap, ignoring block_size.
 
         Returns
         -------
         The contents of the file as a bytes.
         """
-        self.send_command(b"file.close()")
+        if cache is None:
+            return self._read_file(filename, block_size, heap_aware)
+
+        size, hash_ = self.file_hash(filename)
+        key = (self.get_chip_id(), filename, size, hash_)
+        data = cache.get(key)
+        if data is None:
+            data = self._read_file(filename, block_size, heap_aware)
+            if (len(data), adler32(data)) != (size, hash_):
+                raise IOError("File changed while being read!")
+            cache.put(key, data)
+        return data
 
-        # Determine file size (and that it exists)
-        self.send_command(b"=file.list()[" + lua_string(filename) + b"]")
+    def _read_file(self, filename, block_size, heap_aware):
+        # Determine file size (and that it exists) and open it
+        size, opened = self.run_batch([
+            b"file.close()",
+            b"=file.list()[" + lua_string(filename) + b"]",
+            b"=file.open(" + lua_string(filename) + b", 'r')"])
         try:
-            size = int(self.read_line())
+            size = int(size)
         except ValueError:
             # e.g. if "nil" due to missing file
             raise IOError("File does not exist!")
-
-        # Attempt to open the file
-        self.send_command(b"=file.open(" + lua_string(filename) + b", 'r')")
-        if self.read_line() != b"true":
+        if opened != b"true":
             raise IOError("Could not open file!")
 
         # Read the file one block at a time
         data = b""
+        num_blocks = 0
         while size:
+            if heap_aware and num_blocks % self.HEAP_PROBE_INTERVAL == 0:
+                block_size = min(self.MAX_READ_BLOCK_SIZE,
+                                 self._heap_budget())
+            num_blocks += 1
             block = min(size, block_size)
             size -= block
-            self.send_command(
-                "uart.write(0, file.read({}))".format(block).encode("ascii"))
-            data += self.read(block)
+            self.send_command(self._raw_output(
+                "file.read({})".format(block).encode("ascii")))
+            data += self._read_raw(block)
 
         self.send_command(b"file.close()")
 
         return data
 
+    def pull(self, filenames=None, block_size=64, cache=None):
+        """Read many (by default all) files from the device's flash.
+
+        Parameters
+        ----------
+        filenames : [str, ...] or None
+            The files to read, or None to read every file.
+        block_size : int
+        cache : :py:class:`FileCache` or None
+            See :py:meth:`read_file`.
+
+        Yields
+        ------
+        (filename, data)
+            For each file, as it is read.
+        """
+        if filenames is None:
+            filenames = sorted(self.list_files())
+        for filename in filenames:
+            yield (filename, self.read_file(filename, block_size, cache))
+
+    @_locked
     def list_files(self):
         """Get a list of files on the device's flash.
 
@@ -209,35 +2077,36 @@ class NodeMCU(object):
         num_files = int(self.read_line())
 
         # Print the files and their sizes (prefixed by filename length) Note we
-        # uart.write the filename in case it contains a \n which would be
-        # converted into a \r\n by print.
+        # output the filename raw in case it contains a \n which would
+        # otherwise be mistaken for the end of the line.
         self.send_command(b"for f,s in pairs(file.list()) do"
                           b"    print(#f);"
-                          b"    uart.write(0, f);"
+                          b"    " + self._raw_output(b"f") + b";"
                           b"    print(s);"
                           b"end")
 
         files = {}
         for file in range(num_files):
             filename_length = int(self.read_line())
-            filename = self.read(filename_length).decode("utf-8")
+            filename = self._read_raw(filename_length).decode("utf-8")
             size = int(self.read_line())
             files[filename] = size
 
         return files
 
+    @_locked
     def remove_file(self, filename):
         """Delete a file on the device's flash."""
-        # Check that the file exists
-        self.send_command(b"=file.list()[" + lua_string(filename) + b"]")
+        # Check that the file exists (removing it does nothing otherwise)
+        size, = self.run_batch([
+            b"=file.list()[" + lua_string(filename) + b"]",
+            b"file.remove(" + lua_string(filename) + b")"])
         try:
-            int(self.read_line())
+            int(size)
         except ValueError:
             raise IOError("File does not exist!")
 
-        # Delete it
-        self.send_command(b"file.remove(" + lua_string(filename) + b")")
-
+    @_locked
     def rename_file(self, old, new):
         """Rename a file on the device's flash."""
         self.send_command(b"=file.rename(" +
@@ -246,10 +2115,12 @@ class NodeMCU(object):
         if self.read_line() != b"true":
             raise IOError("Rename failed!")
 
+    @_locked
     def format(self):
         """Format the device's flash."""
         self.send_command(b"file.format()")
 
+    @_locked
     def dofile(self, filename):
         """Execute a file in flash using 'dofile'.
 
@@ -269,12 +2140,14 @@ class NodeMCU(object):
         self.send_command(b"dofile(" + lua_string(filename) + b")")
         return self.read_line(b"> ")
 
+    @_locked
     def restart(self):
         """Request a module restart.
 
         Wait for the propt to return.
         """
         self.send_command(b"node.restart()")
+        self._defined.clear()
 
         # Absorb the prompt returned just before restarting
         self.read_line(b"> ")
@@ -283,34 +2156,659 @@ class NodeMCU(object):
         self.read_line(b"> ")
 
 
-def main(*args):
-    import sys
-    import serial
-    import serial.tools.list_ports
-    import argparse
+def safe_path(filename):
+    """Convert a filename on the device into a relative local path which
+    cannot escape the directory it is placed in."""
+    parts = filename.split("/")
+    return os.path.join(*(p if p not in ("", ".", "..") else "_"
+                          for p in parts))
+
+
+def safe_name(name):
+    """Convert a device name (e.g. a port) into a single path component,
+    e.g. '/dev/ttyUSB0' becomes 'dev_ttyUSB0'."""
+    name = re.sub(r"[/\\:]+", "_", name).strip("_")
+    return name if name not in ("", ".", "..") else "_"
+
+
+def directory_store(directory):
+    """Get a callback for :py:func:`pull_devices` which writes files into a
+    directory."""
+    def store(path, data):
+        path = os.path.join(directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(data)
+    return store
+
+
+def tar_store(tar):
+    """Get a thread-safe callback for :py:func:`pull_devices` which adds
+    files to a :py:class:`tarfile.TarFile`."""
+    import io
+    import tarfile
+
+    lock = threading.Lock()
+
+    def store(path, data):
+        info = tarfile.TarInfo(path.replace(os.sep, "/"))
+        info.size = len(data)
+        info.mtime = time.time()
+        with lock:
+            tar.addfile(info, io.BytesIO(data))
+    return store
+
+
+def pull_devices(devices, store, cache=None, prefix_device=None):
+    """Read every file from several devices concurrently, one thread per
+    device.
+
+    Parameters
+    ----------
+    devices : {name: :py:class:`NodeMCU`, ...}
+        Devices to read from. These must already be open (and should be
+        checked for compatibility).
+    store : f(path, data)
+        Called (from the worker threads) with the local relative path and
+        contents of each file as soon as it has been read.
+    cache : :py:class:`FileCache` or None
+        See :py:meth:`NodeMCU.read_file`.
+    prefix_device : bool or None
+        If True, files are placed in a subdirectory named after the device
+        (see :py:func:`safe_name`).
+        If None, only do so when there is more than one device.
+
+    Returns
+    -------
+    {name: (num_files, num_bytes), ...}
+
+    If reading from any device fails, the first such exception is raised
+    once all devices have finished.
+    """
+    if prefix_device is None:
+        prefix_device = len(devices) > 1
+
+    def pull(name, n):
+        num_files = num_bytes = 0
+        for filename, data in n.pull(cache=cache):
+            path = safe_path(filename)
+            if prefix_device:
+                path = os.path.join(safe_name(name), path)
+            store(path, data)
+            num_files += 1
+            num_bytes += len(data)
+        return (num_files, num_bytes)
+
+    return _for_each_device(devices, pull)
+
+
+def inventory_devices(devices):
+    """Get the inventory (see :py:meth:`NodeMCU.get_inventory`) of several
+    devices concurrently, one thread per device.
+
+    Parameters
+    ----------
+    devices : {name: :py:class:`NodeMCU`, ...}
+        Devices to query. These must already be open.
+
+    Returns
+    -------
+    {name: inventory, ...}
+
+    If querying any device fails, the first such exception is raised once all
+    devices have finished.
+    """
+    return _for_each_device(devices, lambda name, n: n.get_inventory())
+
+
+def estimate_transfer_time(files, latency, char_rate, block_size=64):
+    """Estimate the time :py:meth:`NodeMCU.write_file` will take to write some
+    files (using the escaped string encoding).
+
+    Parameters
+    ----------
+    files : [(filename, data), ...]
+    latency, char_rate : float
+        As returned by :py:meth:`NodeMCU.measure_link`.
+    block_size : int
+
+    Returns
+    -------
+    The estimated time in seconds.
+    """
+    num_commands = 0
+    num_chars = 0
+    for filename, data in files:
+        # Opening and closing the file (as sent by write_file)
+        num_commands += 2
+        num_chars += len(b"file.close(); print(file.open(" +
+                         lua_string(filename) + b", 'w'))")
+        num_chars += len(b"file.close()")
+        for offset in range(0, len(data), block_size):
+            num_commands += 1
+            num_chars += len(b"=file.write()") + len(
+                lua_bytes(data[offset:offset + block_size]))
+    return num_commands * latency + num_chars / float(char_rate)
+
+
+def schedule_jobs(costs, workers):
+    """Schedule jobs across a pool of workers, largest first (LPT).
+
+    Each job is given to whichever worker becomes free first.
+
+    Parameters
+    ----------
+    costs : {job: cost, ...}
+    workers : int
+
+    Returns
+    -------
+    ([(job, worker, start, finish), ...], critical_path)
+        The jobs in the order they start. The critical path is the
+        estimated finishing time of the last job.
+    """
+    loads = [(0.0, worker) for worker in range(workers)]
+    schedule = []
+    for job, cost in sorted(costs.items(), key=lambda jc: (-jc[1], jc[0])):
+        start, worker = heapq.heappop(loads)
+        schedule.append((job, worker, start, start + cost))
+        heapq.heappush(loads, (start + cost, worker))
+    return (schedule, max([finish for _, _, _, finish in schedule] or [0.0]))
+
+
+def deploy_devices(devices, manifest, workers=None, block_size=64,
+                   **kwargs):
+    """Write different files to several devices concurrently, largest
+    transfers first.
+
+    Each device's link is measured (see :py:meth:`NodeMCU.measure_link`) to
+    estimate how long its files will take to write and the devices are then
+    scheduled across a pool of worker threads (see :py:func:`schedule_jobs`).
+
+    Parameters
+    ----------
+    devices : {name: :py:class:`NodeMCU`, ...}
+        Devices to write to. These must already be open.
+    manifest : {name: [(filename, data), ...], ...}
+        The files to write to each device.
+    workers : int or None
+        The number of devices written at once (default: all of them).
+    block_size : int
+    **kwargs
+        Passed to :py:meth:`NodeMCU.write_file`.
+
+    Returns
+    -------
+    ({name: {"worker": int, "estimate": float, "actual": float}, ...},
+     critical_path)
+        The worker which wrote each device (which may differ from the
+        planned one if the estimates are wrong), the estimated and actual
+        times taken (in seconds) and the estimated time for all devices.
+
+    If writing to any device fails, the first such exception is raised once
+    all devices have finished.
+    """
+    devices = {name: devices[name] for name in manifest}
+    workers = workers or len(devices)
+    links = _for_each_device(devices, lambda name, n: n.measure_link())
+    schedule, critical_path = schedule_jobs(
+        {name: estimate_transfer_time(manifest[name], *links[name],
+                                      block_size=block_size)
+         for name in devices},
+        workers)
+
+    def deploy(name, n):
+        start = time.time()
+        for filename, data in manifest[name]:
+            n.write_file(filename, data, block_size, **kwargs)
+        return time.time() - start
+
+    ran_on = {}
+    actual = _for_each_device(devices, deploy, workers,
+                              [name for name, _, _, _ in schedule], ran_on)
+    return ({name: {"worker": ran_on[name], "estimate": finish - start,
+                    "actual": actual[name]}
+             for name, _, start, finish in schedule},
+            critical_path)
+
+
+def _for_each_device(devices, function, workers=None, order=None,
+                     ran_on=None):
+    """Call function(name, n) for several devices concurrently, returning
+    {name: return value, ...}. By default, each device has its own thread,
+    otherwise the given number of threads take devices in the given order
+    (default: sorted by name). If ran_on is a dict, the index of the thread
+    which handled each device is stored in it. If any call fails, the first
+    exception is raised once all calls have finished."""
+    results = {}
+    errors = []
+    queue = collections.deque(sorted(devices) if order is None else order)
+
+    def run(worker):
+        while True:
+            try:
+                name = queue.popleft()
+            except IndexError:
+                return
+            if ran_on is not None:
+                ran_on[name] = worker
+            try:
+                results[name] = function(name, devices[name])
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(worker, ))
+               for worker in range(workers or len(devices))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+# Inventory fields which are expected to change between scans and so are
+# ignored by :py:func:`diff_inventories`.
+VOLATILE_INVENTORY_FIELDS = ("heap", )
+
+
+def diff_inventories(old, new):
+    """Find the differences between two sets of device inventories.
+
+    Parameters
+    ----------
+    old, new : {device: inventory, ...}
+        Inventories as returned by :py:meth:`NodeMCU.get_inventory`, possibly
+        with extra fields. Devices only present in old are ignored (e.g.
+        because they were not included in the latest scan).
+
+    Returns
+    -------
+    [(device, field, old_value, new_value), ...]
+        Sorted by device then field. Files are compared individually, with a
+        field of "files/<filename>" and values of None where the file is
+        absent. Fields in :py:data:`VOLATILE_INVENTORY_FIELDS` are ignored.
+        If a device is new, a single entry with a field of None is given.
+    """
+    def flatten(inventory):
+        fields = dict(inventory)
+        for name, value in fields.pop("files", {}).items():
+            fields["files/" + name] = value
+        return fields
+
+    changes = []
+    for device, inventory in sorted(new.items()):
+        if device not in old:
+            changes.append((device, None, None, inventory))
+            continue
+        before = flatten(old[device])
+        after = flatten(inventory)
+        for field in sorted(set(before) | set(after)):
+            if (field not in VOLATILE_INVENTORY_FIELDS and
+                    before.get(field) != after.get(field)):
+                changes.append((device, field, before.get(field),
+                                after.get(field)))
+    return changes
+
+
+class Profiler(object):
+    """Times the methods of :py:class:`NodeMCU` and the data encoders while
+    in use as a context manager, splitting the wall-clock time taken into
+    host CPU time, serial I/O and device think-time.
+
+    Timers are installed on the :py:class:`NodeMCU` class (and this module)
+    so all devices are profiled, including those used by other threads. Times
+    are inclusive (e.g. a method's time includes that of the methods it
+    calls). Generators (e.g. :py:meth:`NodeMCU.pull`) are timed while they
+    are iterated.
+
+    Example::
+
+        with Profiler("upload.pstats") as profiler:
+            n.write_file("init.lua", data)
+        print(profiler.report())
+    """
+
+    # Module-level functions which are timed (as well as all methods of
+    # :py:class:`NodeMCU`).
+    FUNCTIONS = ("lua_bytes", "lua_string", "b64encode", "lz_compress",
+                 "minify_lua", "adler32")
 
-    # Select a sensible default serial port, prioritising FTDI-style ports
+    def __init__(self, stats_file=None):
+        """
+        Parameters
+        ----------
+        stats_file : str or None
+            If given, the context is also profiled with cProfile and the
+            statistics written to this file (for use with pstats).
+        """
+        self.stats_file = stats_file
+
+        # {name: [calls, seconds], ...}
+        self.timings = {}
+
+        # Time spent waiting in serial reads and writes, the part of that
+        # time accounted for by transferring the bytes at the port's baudrate
+        # and the host CPU time used meanwhile
+        self.io_time = 0.0
+        self.wire_time = 0.0
+        self.io_cpu_time = 0.0
+
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+        self._originals = []
+        self._profile = None
+
+    def _timed(self, name, function, io=False):
+        """Wrap a function so that its calls are timed."""
+        import inspect
+
+        # Looked up once to keep the overhead of each call low
+        clock = getattr(time, "perf_counter", time.time)
+        cpu_clock = getattr(time, "process_time", None) or time.clock
+        timing = self.timings.setdefault(name, [0, 0.0])
+
+        if inspect.isgeneratorfunction(function):
+            def iterate(generator):
+                while True:
+                    start = clock()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        timing[1] += clock() - start
+                    yield item
+
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                timing[0] += 1
+                return iterate(function(*args, **kwargs))
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            if io:
+                cpu_start = cpu_clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                timing[0] += 1
+                timing[1] += elapsed
+                if io:
+                    self.io_time += elapsed
+                    self.io_cpu_time += cpu_clock() - cpu_start
+                    # NodeMCU.read(self, length) or NodeMCU.write(self, data)
+                    n, length = args[:2]
+                    if not isinstance(length, int):
+                        length = len(length)
+                    baudrate = getattr(n.serial, "baudrate", None)
+                    if isinstance(baudrate, (int, float)) and baudrate:
+                        self.wire_time += length * 10.0 / baudrate
+        return wrapper
+
+    def __enter__(self):
+        for name, method in list(vars(NodeMCU).items()):
+            if callable(method) and not name.startswith("__"):
+                self._originals.append((NodeMCU, name, method))
+                setattr(NodeMCU, name, self._timed(
+                    "NodeMCU." + name, method, name in ("read", "write")))
+        module = globals()
+        for name in self.FUNCTIONS:
+            self._originals.append((None, name, module[name]))
+            module[name] = self._timed(name, module[name])
+
+        self._start = (_wall_time(), _cpu_time())
+        if self.stats_file is not None:
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.stats_file)
+        wall_start, cpu_start = self._start
+        self.wall_time = _wall_time() - wall_start
+        self.cpu_time = _cpu_time() - cpu_start
+
+        for cls, name, original in reversed(self._originals):
+            if cls is None:
+                globals()[name] = original
+            else:
+                setattr(cls, name, original)
+        self._originals = []
+
+    @property
+    def breakdown(self):
+        """The wall-clock time taken, split into parts.
+
+        Returns
+        -------
+        {"wall": s, "host_cpu": s, "serial_io": s, "device": s, "other": s}
+            "serial_io" is the time needed to transfer the data sent and
+            received at the port's baudrate (zero if unknown, e.g. for TCP)
+            and "device" is the remainder of the time spent waiting for the
+            port, i.e. the device thinking (or the host waiting for a
+            timeout). "host_cpu" excludes CPU time used while waiting for the
+            port (which is already counted there) so, for a single thread, the
+            parts add up to the wall-clock time. "other" is whatever remains
+            (e.g. sleeping).
+        """
+        # Writes may return before the data is sent so the transfer time is
+        # not attributed to individual calls
+        serial_io = min(self.wire_time, self.io_time)
+        device = self.io_time - serial_io
+        host_cpu = max(self.cpu_time - self.io_cpu_time, 0.0)
+        return {
+            "wall": self.wall_time,
+            "host_cpu": host_cpu,
+            "serial_io": serial_io,
+            "device": device,
+            "other": max(self.wall_time - host_cpu - self.io_time, 0.0),
+        }
+
+    def report(self):
+        """Format the breakdown and timings as a human-readable table."""
+        breakdown = self.breakdown
+        wall = breakdown["wall"] or 1.0
+        lines = ["{:<28} {:>9.3f} s".format("Wall time", breakdown["wall"])]
+        for key, label in [("host_cpu", "Host CPU"),
+                           ("serial_io", "Serial I/O"),
+                           ("device", "Device"),
+                           ("other", "Other")]:
+            lines.append("  {:<26} {:>9.3f} s {:>5.1f}%".format(
+                label, breakdown[key], 100.0 * breakdown[key] / wall))
+        lines.append("")
+        lines.append("{:<28} {:>9} {:>11} {:>11}".format(
+            "Function", "Calls", "Total/s", "Per call/ms"))
+        for name, (calls, seconds) in sorted(
+                self.timings.items(), key=lambda nt: (-nt[1][1], nt[0])):
+            if calls:
+                lines.append("{:<28} {:>9} {:>11.3f} {:>11.3f}".format(
+                    name, calls, seconds, 1000.0 * seconds / calls))
+        return "\n".join(lines) + "\n"
+
+
+def _wall_time():
+    """A high resolution clock (in seconds)."""
+    return getattr(time, "perf_counter", time.time)()
+
+
+def _cpu_time():
+    """Host CPU time used by this process (in seconds)."""
+    return (getattr(time, "process_time", None) or time.clock)()
+
+
+def check_version(n):
+    """Check a device's version for compatibility (and also ensure serial
+    stream is in sync)."""
+    if not ((1, 4) <= n.get_version() < (2, 0)):
+        raise ValueError("Incompatible version of NodeMCU!")
+
+
+def default_serial_port():
+    """Select a sensible default serial port, prioritising FTDI-style ports.
+
+    Returns None if no serial ports are found.
+    """
+    import serial.tools.list_ports
     ports = map(next, map(iter, serial.tools.list_ports.comports()))
     ports = sorted(ports, key=(lambda p: ("ttyUSB" not in p, p)))
-    if ports:
-        default_port = ports[0]
-    else:
-        default_port = None
+    return ports[0] if ports else None
+
+
+def main(*args):
+    import argparse
 
     parser = argparse.ArgumentParser(
         description="Access files on an ESP8266 running NodeMCU.")
-    parser.add_argument("--port", "-p", type=str, default=default_port,
-                        help="Serial port name/path (default = %(default)s).")
+    parser.add_argument("--port", "-p", type=str, action="append",
+                        help="Serial port name/path or tcp://host[:port] "
+                             "for a networked Lua console. May be given "
+                             "several times with --pull or --inventory "
+                             "(default = the first serial port found, "
+                             "preferring USB serial adapters).")
     parser.add_argument("--baudrate", "-b", type=int, default=9600,
                         help="Baudrate to use (default = %(default)d).")
+    parser.add_argument("--rtscts", action="store_true",
+                        help="Use RTS/CTS hardware flow control.")
+    parser.add_argument("--xonxoff", action="store_true",
+                        help="Use XON/XOFF software flow control. Not "
+                             "supported by --read, --pull or --inventory "
+                             "since file data may contain the XON and XOFF "
+                             "bytes.")
+    parser.add_argument("--pace", type=int, metavar="BYTES",
+                        help="Send commands in chunks of at most this many "
+                             "bytes, waiting for each to be echoed back "
+                             "before sending the next (avoids overrunning "
+                             "the device at high baudrates).")
+    parser.add_argument("--retries", type=int, default=0, metavar="N",
+                        help="Retry each failed block of a write up to N "
+                             "times, resynchronising with the interpreter "
+                             "first (default = %(default)d).")
+    parser.add_argument("--heap-aware", action="store_true",
+                        help="Choose transfer block sizes according to the "
+                             "device's free heap and refuse writes which "
+                             "will not fit in the remaining flash.")
+    parser.add_argument("--encoding", choices=NodeMCU.ENCODINGS,
+                        default="escape",
+                        help="How file data is sent when writing: as escaped "
+                             "Lua strings, as base64 (decoded on the device "
+                             "using encoder.fromBase64) or whichever is "
+                             "shorter for each block "
+                             "(default = %(default)s).")
+    parser.add_argument("--compress", action="store_true",
+                        help="Compress file data when writing, decompressing "
+                             "it on the device. The compression ratio and "
+                             "effective throughput are reported.")
+    parser.add_argument("--write-buffer", type=int, default=0,
+                        metavar="BYTES",
+                        help="When writing, buffer file data on the device "
+                             "and only write it to flash once this many "
+                             "bytes have accumulated (default = %(default)d, "
+                             "i.e. write every block immediately).")
+    parser.add_argument("--flush-interval", type=int, metavar="N",
+                        help="With --write-buffer, flush the file after "
+                             "every N writes to flash (default = only at the "
+                             "end of the file).")
+    parser.add_argument("--workers", type=int, metavar="N",
+                        help="With --deploy, write to at most N devices at "
+                             "once (default = all of them).")
+    parser.add_argument("--profile", nargs="?", const="",
+                        metavar="STATS_FILE",
+                        help="Print a breakdown of the time taken (host CPU, "
+                             "serial I/O and device) and the time spent in "
+                             "each method on stderr. If STATS_FILE is given, "
+                             "also write cProfile statistics to it.")
+    parser.add_argument("--inventory-format", choices=("json", "csv"),
+                        default="json",
+                        help="Output format for --inventory "
+                             "(default = %(default)s).")
+    parser.add_argument("--snapshot", metavar="FILENAME",
+                        help="With --inventory, keep the latest inventory of "
+                             "each device in the specified JSON file and "
+                             "report only what has changed since the "
+                             "previous scan.")
+    parser.add_argument("--cache", metavar="DIRECTORY",
+                        help="Cache files read from the device in the "
+                             "specified directory and skip re-reading them "
+                             "when unchanged.")
+    parser.add_argument("--cache-size", type=int, default=16 * 1024 * 1024,
+                        metavar="BYTES",
+                        help="Maximum size of the cache "
+                             "(default = %(default)d).")
+    parser.add_argument("--minify", action="store_true",
+                        help="Strip comments and redundant whitespace from "
+                             "'.lua' files before writing them.")
+    parser.add_argument("--compile", action="store_true",
+                        help="Compile '.lua' files (other than init.lua) "
+                             "using node.compile after writing them. Files "
+                             "whose source is unchanged on the device are "
+                             "skipped.")
+    parser.add_argument("--remove-source", action="store_true",
+                        help="With --compile, remove the '.lua' source "
+                             "after compilation.")
+    parser.add_argument("--debounce", type=float, default=0.3,
+                        metavar="SECONDS",
+                        help="With --watch, wait until no files have changed "
+                             "for this long before uploading "
+                             "(default = %(default)s).")
+    after_watch = parser.add_mutually_exclusive_group()
+    after_watch.add_argument("--then-dofile", metavar="FILENAME",
+                             help="With --watch, run the specified file "
+                                  "using dofile after each upload.")
+    after_watch.add_argument("--then-restart", action="store_true",
+                             help="With --watch, restart the device after "
+                                  "each upload.")
+    parser.add_argument("--record", metavar="TRANSCRIPT",
+                        help="Record a timestamped transcript of all serial "
+                             "traffic into the specified file.")
+    parser.add_argument("--replay", metavar="TRANSCRIPT",
+                        help="Instead of using a serial port, play back a "
+                             "transcript recorded using --record.")
+    parser.add_argument("--replay-scale", type=float, default=1.0,
+                        metavar="SCALE",
+                        help="Scale the latencies of a replayed transcript "
+                             "by this factor, 0 to replay as fast as "
+                             "possible (default = %(default)s).")
 
     actions = parser.add_mutually_exclusive_group(required=True)
     actions.add_argument("--write", "-w", nargs=1, metavar="FILENAME",
                          help="Write the contents of stdin to the specified "
                               "file in flash.")
+    actions.add_argument("--pack", nargs=1, metavar="DIRECTORY",
+                         help="Write every file in the specified directory "
+                              "to flash, uploaded as a single archive.")
     actions.add_argument("--read", "-r", nargs=1, metavar="FILENAME",
                          help="Write the contents of the specified file in "
                               "flash and print it to stdout.")
+    actions.add_argument("--pull", nargs=1, metavar="DESTINATION",
+                         help="Read every file into the specified directory, "
+                              "or into a tar file if DESTINATION ends in "
+                              ".tar or .tar.gz, or is - (stdout). When "
+                              "several ports are given, all are read "
+                              "concurrently with each device's files placed "
+                              "in a subdirectory named after its port.")
+    actions.add_argument("--deploy", nargs=1, metavar="MANIFEST",
+                         help="Write different files to several devices "
+                              "concurrently, largest transfers first. "
+                              "MANIFEST is a JSON file mapping each port to "
+                              "a list of files and directories (relative to "
+                              "the manifest) to write to it. Any --port "
+                              "options are ignored.")
+    actions.add_argument("--inventory", action="store_true",
+                         help="Print the firmware version, chip ID, free "
+                              "heap and flash, and every file's size and "
+                              "checksum. When several ports are given, all "
+                              "are queried concurrently.")
     actions.add_argument("--list", "--ls", "-l", action="store_true",
                          help="List all files (and their sizes in bytes).")
     actions.add_argument("--delete", "--rm", nargs=1, metavar="FILENAME",
@@ -324,28 +2822,365 @@ def main(*args):
                          help="Format the flash.")
     actions.add_argument("--restart", "--reset", "-R", action="store_true",
                          help="Restart the device.")
+    actions.add_argument("--watch", nargs=1, metavar="DIRECTORY",
+                         help="Keep the connection open and write files in "
+                              "the specified directory to flash whenever "
+                              "they change, until interrupted.")
+    actions.add_argument("--monitor", action="store_true",
+                         help="Print the device's console output until "
+                              "interrupted.")
 
     args = parser.parse_args(*args)
 
-    if args.port is None:
+    # Enumerating serial ports can be slow so is only done when required
+    if args.port is None and not (args.replay or args.deploy):
+        default_port = default_serial_port()
+        args.port = [default_port] if default_port is not None else []
+    elif args.port is None:
+        args.port = []
+    if len(args.port) > 1 and not (args.pull or args.inventory or
+                                   args.deploy):
+        parser.error("Only --pull and --inventory may be used with several "
+                     "ports.")
+    if (len(args.port) > 1 or args.deploy) and (args.record or args.replay):
+        parser.error("--record and --replay require a single port.")
+    if args.xonxoff and (args.read or args.pull or args.inventory):
+        parser.error("--xonxoff cannot be used with --read, --pull or "
+                     "--inventory.")
+    if args.deploy and (args.compile or args.remove_source):
+        parser.error("--compile and --remove-source cannot be used with "
+                     "--deploy.")
+    if (args.pull or args.inventory) and (args.record or args.replay):
+        parser.error("--record and --replay cannot be used with --pull or "
+                     "--inventory.")
+
+    cache = FileCache(args.cache, args.cache_size) if args.cache else None
+
+    if args.profile is None:
+        return _dispatch(parser, args, cache)
+
+    import sys
+    profiler = Profiler(args.profile or None)
+    try:
+        with profiler:
+            return _dispatch(parser, args, cache)
+    finally:
+        sys.stderr.write(profiler.report())
+
+
+def _dispatch(parser, args, cache):
+    """Run the action selected by the parsed (and validated) arguments."""
+    if args.replay:
+        with open(args.replay, "rb") as f:
+            port = SerialReplay(read_transcript(f), args.replay_scale)
+    elif args.deploy:
+        return _deploy(args, cache)
+    elif not args.port:
         parser.error("No serial port specified.")
+    elif args.pull:
+        return _pull(args, cache)
+    elif args.inventory:
+        return _inventory(args)
+    else:
+        port = open_transport(args.port[0], args.baudrate,
+                              rtscts=args.rtscts, xonxoff=args.xonxoff)
+
+    if args.record:
+        record_file = open(args.record, "wb")
+        port = SerialRecorder(port, record_file)
+
+    try:
+        n = NodeMCU(port, max_outstanding=args.pace,
+                    max_retries=args.retries)
+        return _run_command(args, n, cache)
+    finally:
+        if args.record:
+            record_file.close()
+
+
+def _open_devices(args, devices, ports=None):
+    """Open and check the version of the device on each port given (default:
+    args.port), adding them to devices ({port: :py:class:`NodeMCU`, ...}).
+    The caller must use :py:func:`_close_devices` afterwards, even if this
+    fails."""
+    for port in args.port if ports is None else ports:
+        devices[port] = NodeMCU(
+            open_transport(port, args.baudrate,
+                           rtscts=args.rtscts, xonxoff=args.xonxoff),
+            max_outstanding=args.pace, max_retries=args.retries)
+        devices[port].__enter__()
+        check_version(devices[port])
+
+
+def _close_devices(devices):
+    for n in devices.values():
+        n.__exit__(None, None, None)
+
+
+def _pull(args, cache):
+    """Handle --pull for any number of ports."""
+    import sys
+    import tarfile
+
+    destination = args.pull[0]
+    if destination == "-" or destination.endswith((".tar", ".tar.gz")):
+        mode = "w|gz" if destination.endswith(".gz") else "w|"
+        if destination == "-":
+            # Python 2/3 hack: get stdout for bytes
+            fileobj = getattr(sys.stdout, "buffer", sys.stdout)
+        else:
+            fileobj = open(destination, "wb")
+        tar = tarfile.open(fileobj=fileobj, mode=mode)
+        store = tar_store(tar)
+    else:
+        tar = None
+        store = directory_store(destination)
+
+    devices = {}
+    try:
+        _open_devices(args, devices)
+        results = pull_devices(devices, store, cache)
+    finally:
+        _close_devices(devices)
+        if tar is not None:
+            tar.close()
+            if destination != "-":
+                fileobj.close()
+
+    for port, (num_files, num_bytes) in sorted(results.items()):
+        sys.stderr.write("{}: {} file{}, {} byte{}.\n".format(
+            port,
+            num_files, "s" if num_files != 1 else "",
+            num_bytes, "s" if num_bytes != 1 else ""))
+
+    return 0
+
+
+def _deploy(args, cache):
+    """Handle --deploy."""
+    import sys
+
+    manifest = read_manifest(args.deploy[0])
+    if args.minify:
+        manifest = {port: _minify(files, cache)
+                    for port, files in manifest.items()}
+
+    devices = {}
+    try:
+        _open_devices(args, devices, sorted(manifest))
+        start = time.time()
+        results, critical_path = deploy_devices(
+            devices, manifest, args.workers, **_write_options(args))
+        elapsed = time.time() - start
+    finally:
+        _close_devices(devices)
+
+    for port, result in sorted(results.items()):
+        num_files = len(manifest[port])
+        num_bytes = sum(len(data) for _, data in manifest[port])
+        sys.stderr.write(
+            "{}: {} file{}, {} byte{} in {:.1f} s "
+            "(estimated {:.1f} s, worker {}).\n".format(
+                port,
+                num_files, "s" if num_files != 1 else "",
+                num_bytes, "s" if num_bytes != 1 else "",
+                result["actual"], result["estimate"], result["worker"]))
+    sys.stderr.write("Critical path estimated {:.1f} s, took {:.1f} s.\n"
+                     .format(critical_path, elapsed))
+
+    return 0
+
+
+def _inventory(args):
+    """Handle --inventory for any number of ports."""
+    import sys
+    import csv
+    import json
+
+    devices = {}
+    try:
+        _open_devices(args, devices)
+        inventories = inventory_devices(devices)
+    finally:
+        _close_devices(devices)
+
+    # Devices are identified by chip ID so they can be tracked between ports
+    scan = {}
+    for port, inventory in inventories.items():
+        inventory["port"] = port
+        scan[str(inventory["chip_id"])] = inventory
+
+    changes = None
+    if args.snapshot:
+        if os.path.exists(args.snapshot):
+            with open(args.snapshot) as f:
+                snapshot = json.load(f)
+            changes = diff_inventories(snapshot, scan)
+        else:
+            snapshot = {}
+        snapshot.update(scan)
+        with open(args.snapshot, "w") as f:
+            json.dump(snapshot, f, indent=2, sort_keys=True)
+
+    if args.inventory_format == "json":
+        if changes is None:
+            output = scan
+        else:
+            output = [dict(device=device, field=field, old=old, new=new)
+                      for device, field, old, new in changes]
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    elif changes is None:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["device", "port", "version", "heap", "fs_total",
+                         "fs_used", "fs_remaining", "filename", "size",
+                         "hash"])
+        for device, inventory in sorted(scan.items()):
+            row = [device] + [inventory[field] for field in (
+                "port", "version", "heap", "fs_total", "fs_used",
+                "fs_remaining")]
+            files = sorted(inventory["files"].items()) or [(None, {})]
+            for filename, details in files:
+                writer.writerow(row + [filename, details.get("size"),
+                                       details.get("hash")])
+    else:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["device", "field", "old", "new"])
+        for change in changes:
+            writer.writerow([json.dumps(value, sort_keys=True)
+                             if isinstance(value, dict) else value
+                             for value in change])
+
+    return 0
+
+
+def _minify(files, cache):
+    """Minify any Lua files in a list of (filename, data) pairs, reporting the
+    savings on stderr."""
+    import sys
+
+    out = []
+    for filename, data in files:
+        if filename.endswith(".lua"):
+            minified = minify_lua(data, cache)
+            sys.stderr.write("{}: {} -> {} bytes ({} saved).\n".format(
+                filename, len(data), len(minified),
+                len(data) - len(minified)))
+            data = minified
+        out.append((filename, data))
+    return out
+
+
+def _write_options(args):
+    """Get the keyword arguments for the write methods of :py:class:`NodeMCU`
+    selected by the parsed arguments."""
+    return dict(heap_aware=args.heap_aware, encoding=args.encoding,
+                compress=args.compress, write_buffer=args.write_buffer,
+                flush_interval=args.flush_interval)
+
+
+def _pack(args, n, files):
+    """Handle --pack (with --compile), skipping Lua files which are already
+    compiled."""
+    compile = []
+    if args.compile:
+        existing = n.list_files()
+        current = set()
+        for filename, data in files:
+            if _compilable(filename):
+                if n.compiled_is_current(filename, data,
+                                         args.remove_source, existing):
+                    current.add(filename)
+                else:
+                    compile.append(filename)
+        files = [(f, d) for f, d in files if f not in current]
+
+    if files:
+        n.write_files(files, **_write_options(args))
+    for filename in compile:
+        n.compile_file(filename, args.remove_source)
+
+
+def _watch(args, n, cache):
+    """Handle --watch: upload changed files until interrupted."""
+    import sys
+
+    watcher = DirectoryWatcher(args.watch[0], args.debounce)
+    try:
+        while True:
+            changed = watcher.poll()
+            if not changed:
+                time.sleep(0.1)
+                continue
+
+            start = time.time()
+            files = []
+            for filename in changed:
+                try:
+                    with open(os.path.join(args.watch[0], filename),
+                              "rb") as f:
+                        files.append((filename, f.read()))
+                except (IOError, OSError):
+                    # Deleted since the change was seen
+                    pass
+            if not files:
+                continue
+            if args.minify:
+                files = _minify(files, cache)
+            try:
+                if len(files) == 1 and not args.compile:
+                    n.write_file(*files[0], **_write_options(args))
+                else:
+                    _pack(args, n, files)
+            except IOError as e:
+                # Keep watching: the files are written again when next saved
+                sys.stderr.write("Failed to write {}: {}\n".format(
+                    ", ".join(f for f, _ in files), e))
+                continue
+            sys.stderr.write("Wrote {} ({} bytes) in {:.1f} s.\n".format(
+                ", ".join(f for f, _ in files),
+                sum(len(d) for _, d in files),
+                time.time() - start))
+
+            if args.then_dofile:
+                stdout = getattr(sys.stdout, "buffer", sys.stdout)
+                stdout.write(n.dofile(args.then_dofile))
+                stdout.flush()
+            elif args.then_restart:
+                n.restart()
+    except KeyboardInterrupt:
+        pass
+
+
+def _run_command(args, n, cache):
+    """Run the command selected by the parsed arguments on a device."""
+    import sys
 
-    n = NodeMCU(serial.Serial(args.port, args.baudrate, timeout=2.0))
     with n:
-        # Check version for compatibility (and also ensure serial stream is in
-        # sync)
-        if not ((1, 4) <= n.get_version() < (2, 0)):
-            raise ValueError("Incompatible version of NodeMCU!")
+        check_version(n)
 
         # Handle command
         if args.write:
             # Python 2/3 hack: get stdin for bytes
             stdin = getattr(sys.stdin, "buffer", sys.stdin)
-            n.write_file(args.write[0], stdin.read())
+            files = [(args.write[0], stdin.read())]
+            if args.minify:
+                files = _minify(files, cache)
+            if args.compile and _compilable(files[0][0]):
+                n.write_compiled(*files[0], remove_source=args.remove_source,
+                                 **_write_options(args))
+            else:
+                n.write_file(*files[0], **_write_options(args))
+        elif args.pack:
+            files = read_directory(args.pack[0])
+            if args.minify:
+                files = _minify(files, cache)
+            _pack(args, n, files)
         elif args.read:
             # Python 2/3 hack: get stdout for bytes
             stdout = getattr(sys.stdout, "buffer", sys.stdout)
-            stdout.write(n.read_file(args.read[0]))
+            stdout.write(n.read_file(args.read[0], cache=cache,
+                                     heap_aware=args.heap_aware))
         elif args.list:
             files = n.list_files()
 
@@ -371,12 +3206,41 @@ def main(*args):
             n.format()
         elif args.dofile:
             stdout = getattr(sys.stdout, "buffer", sys.stdout)
-            sys.stdout.write(n.dofile(args.dofile[0]))
-        elif args.restart:  # pragma: no branch
+            stdout.write(n.dofile(args.dofile[0]))
+        elif args.restart:
             n.restart()
+        elif args.watch:
+            _watch(args, n, cache)
+        elif args.monitor:  # pragma: no branch
+            stdout = getattr(sys.stdout, "buffer", sys.stdout)
+
+            def output(data):
+                stdout.write(data)
+                stdout.flush()
+            try:
+                with ConsoleMonitor(n, output):
+                    while True:
+                        time.sleep(1.0)
+            except KeyboardInterrupt:
+                pass
+
+    if n.overruns:
+        sys.stderr.write(
+            "Detected {} corrupted command echo{} (overrun?).\n".format(
+                n.overruns, "es" if n.overruns != 1 else ""))
+    if n.retries:
+        sys.stderr.write("Recovered from {} failed block{}.\n".format(
+            n.retries, "s" if n.retries != 1 else ""))
+    if args.compress and n.bytes_written:
+        sys.stderr.write(
+            "Compressed {} -> {} bytes ({:.2f}x), {:.0f} B/s.\n".format(
+                n.bytes_written, n.bytes_sent,
+                n.bytes_written / float(n.bytes_sent or 1),
+                n.bytes_written / max(n.write_time, 1e-6)))
 
     return 0
 
+
 if __name__ == "__main__":  # pragma: no cover
     import sys
     sys.exit(main())
@@ -9,9 +9,26 @@ Usage:
 
 import pytest
 
-from mock import Mock
+from base64 import b64encode
+
+from mock import Mock, MagicMock
+
+import nodemcuload
 
 from nodemcuload import lua_bytes, lua_string, NodeMCU, main
+from nodemcuload import lua_bytes_length
+from nodemcuload import SerialRecorder, SerialReplay, read_transcript
+from nodemcuload import TCPSerial, open_transport
+from nodemcuload import pack_archive, read_directory
+from nodemcuload import adler32, FileCache
+from nodemcuload import lz_compress, lz_decompress, LZ_DECOMPRESS_LUA
+from nodemcuload import WRITE_BUFFER_LUA
+from nodemcuload import minify_lua, ConsoleMonitor, DirectoryWatcher
+from nodemcuload import safe_path, safe_name
+from nodemcuload import directory_store, tar_store, pull_devices
+from nodemcuload import inventory_devices, diff_inventories
+from nodemcuload import read_manifest, estimate_transfer_time, schedule_jobs
+from nodemcuload import deploy_devices, Profiler
 
 
 @pytest.mark.parametrize("case,string",
@@ -57,6 +74,25 @@ def test_lua_string(case, string):
     assert lua_string(case) == string
 
 
+@pytest.mark.parametrize("data", [b"", b"hello", b"\\'\x00\xFF x"])
+def test_lua_bytes_length(data):
+    assert lua_bytes_length(data) == len(lua_bytes(data))
+
+
+@pytest.mark.parametrize("data,offset,max_length,num_bytes",
+                         [(b"hello", 0, 100, 5),
+                          (b"hello", 0, 7, 5),
+                          (b"hello", 0, 6, 4),
+                          (b"hello", 2, 6, 3),
+                          (b"\x00\x00\x00", 0, 10, 2),
+                          (b"\x00\x00\x00", 0, 9, 1),
+                          # At least one byte is always included
+                          (b"\x00\x00\x00", 0, 2, 1),
+                          (b"''", 0, 5, 1)])
+def test_lua_bytes_length_limit(data, offset, max_length, num_bytes):
+    assert lua_bytes_length(data, offset, max_length) == num_bytes
+
+
 class MockSerial(object):
     """A pretend serial device."""
 
@@ -123,6 +159,1032 @@ class MockSerial(object):
                  self.expected_sequence[0] == b""))
 
 
+def command(cmd, response=b""):
+    """Expected sequence entries for a command and its echo and response."""
+    return [cmd + b"\r\n", cmd + b"\r\n" + response]
+
+
+def define_sequence(lua):
+    """Expected sequence entries for defining a multi-line Lua helper, packed
+    into as few commands as possible."""
+    commands = [b""]
+    for line in lua:
+        line = line.strip()
+        if len(commands[-1] + b" " + line) > NodeMCU.MAX_LINE_LENGTH:
+            commands.append(b"")
+        commands[-1] = (commands[-1] + b" " + line).lstrip()
+    return sum((command(c) for c in commands), [])
+
+
+def write_file_sequence(filename, data, block_size=64):
+    """Expected sequence entries for a successful NodeMCU.write_file call."""
+    sequence = command(b"file.close(); print(file.open(" +
+                       lua_string(filename) + b", 'w'))", b"true\r\n")
+    for offset in range(0, len(data), block_size):
+        block = data[offset:offset + block_size]
+        sequence += command(b"=file.write(" + lua_bytes(block) + b")",
+                            b"true\r\n")
+    return sequence + command(b"file.close()")
+
+
+@pytest.mark.parametrize("source,minified",
+                         [(b"", b""),
+                          (b"\n\n  \n", b""),
+                          # Indentation, blank lines and redundant spaces
+                          (b"if x == 1 then\n\n    f ( x )\nend\n",
+                           b"if x==1 then\nf(x)\nend"),
+                          # Comments
+                          (b"-- comment\nx = 1 -- trailing\ny = 2",
+                           b"x=1\ny=2"),
+                          (b"x = 1 --[[ long\ncomment ]] y = 2",
+                           b"x=1\ny=2"),
+                          (b"x = 1 --[==[ long ]] ]==] y = 2",
+                           b"x=1 y=2"),
+                          (b"x = 1 --[[ unterminated", b"x=1"),
+                          (b"x = 1 -- no newline", b"x=1"),
+                          # Strings are untouched
+                          (b"s = 'a  -- b' .. \"c \\\" d\"",
+                           b"s='a  -- b'..\"c \\\" d\""),
+                          (b"s = [[ a  --\n b ]] .. [=[ ]] ]=]",
+                           b"s=[[ a  --\n b ]]..[=[ ]] ]=]"),
+                          (b"s = [[ unterminated  ", b"s=[[ unterminated  "),
+                          (b"s = 'unterminated  \nx = 1",
+                           b"s='unterminated  \nx=1"),
+                          # Spaces which must be kept
+                          (b"local x = a - -b", b"local x=a- -b"),
+                          (b"x = 1 .. 2 .. y", b"x=1 .. 2 ..y"),
+                          (b"x = y .. .5", b"x=y.. .5"),
+                          (b"x = t[ [[s]] ]", b"x=t[ [[s]]]"),
+                          (b"x = t[ [=[s]=] ]", b"x=t[ [=[s]=]]"),
+                          (b"x = a ~= b", b"x=a~=b"),
+                          # Arbitrary bytes preserved
+                          (b"s = '\xDE\xAD'", b"s='\xDE\xAD'")])
+def test_minify_lua(source, minified):
+    assert minify_lua(source) == minified
+
+
+def test_minify_lua_cache(tmpdir, monkeypatch):
+    cache = FileCache(str(tmpdir))
+    assert minify_lua(b"x = 1", cache) == b"x=1"
+
+    # Cached result should be used
+    monkeypatch.setattr(nodemcuload, "_LUA_LONG_BRACKET", None)
+    assert minify_lua(b"x = 1", cache) == b"x=1"
+
+
+def test_pack_archive():
+    assert pack_archive([]) == b"0\n"
+    assert pack_archive([("a.lua", b"print(1)"),
+                         (u"\u2603", b""),
+                         ("c", b"\x00\n")]) == (b"3\n"
+                                                b"5 8\na.lua"
+                                                b"3 0\n\xE2\x98\x83"
+                                                b"1 2\nc"
+                                                b"print(1)"
+                                                b"\x00\n")
+
+
+def test_read_directory(tmpdir):
+    tmpdir.join("b.lua").write(b"bee", mode="wb")
+    tmpdir.join("a.txt").write(b"ay", mode="wb")
+    tmpdir.mkdir("sub").join("c.html").write(b"", mode="wb")
+    tmpdir.mkdir(".git").mkdir("objects").join("d").write(b"x", mode="wb")
+    tmpdir.join(".DS_Store").write(b"x", mode="wb")
+    tmpdir.join("b.lua~").write(b"x", mode="wb")
+    assert read_directory(str(tmpdir)) == [
+        ("a.txt", b"ay"),
+        ("b.lua", b"bee"),
+        ("sub/c.html", b""),
+    ]
+
+
+def test_read_manifest(tmpdir):
+    import json
+    tmpdir.join("init.lua").write(b"x=1", mode="wb")
+    tmpdir.mkdir("www").join("index.html").write(b"<p>", mode="wb")
+    tmpdir.join("www").mkdir("css").join("a.css").write(b"", mode="wb")
+    tmpdir.join("deploy.json").write(json.dumps({
+        "/dev/a": ["init.lua", "www"],
+        "/dev/b": [],
+    }))
+    assert read_manifest(str(tmpdir.join("deploy.json"))) == {
+        "/dev/a": [("init.lua", b"x=1"),
+                   ("css/a.css", b""),
+                   ("index.html", b"<p>")],
+        "/dev/b": [],
+    }
+
+
+def test_read_manifest_duplicate_names(tmpdir):
+    """Files which would overwrite each other on a device are an error."""
+    import json
+    tmpdir.mkdir("a").join("init.lua").write(b"a", mode="wb")
+    tmpdir.mkdir("b").join("init.lua").write(b"b", mode="wb")
+    tmpdir.join("deploy.json").write(json.dumps({
+        "/dev/a": ["a/init.lua", "b/init.lua"],
+    }))
+    with pytest.raises(ValueError):
+        read_manifest(str(tmpdir.join("deploy.json")))
+
+
+@pytest.mark.parametrize("data", [b"", b"a", b"abcabcabcabcabd" * 20,
+                                  b"\x00" * 1000,
+                                  bytes(bytearray(range(256))) * 3,
+                                  b"".join(b"print('line " +
+                                           str(i).encode("ascii") + b"')\n"
+                                           for i in range(200))])
+def test_lz_compress(data):
+    """Compression should be reversible."""
+    compressed = lz_compress(data)
+    assert lz_decompress(compressed) == data
+    if len(data) > 100:
+        assert len(compressed) < len(data)
+
+
+def test_lz_compress_limits():
+    # Literal runs and repeats are split at their maximum lengths
+    assert lz_compress(bytes(bytearray(range(130)))) == (
+        b"\x7F" + bytes(bytearray(range(128))) + b"\x01\x80\x81")
+    assert lz_compress(b"\x00" * 200) == (b"\x00\x00" + b"\xFF\x00\x00" +
+                                          b"\xC0\x00\x00")
+    # Repeats must be within the window
+    data = b"abcd" + b"x" * 20 + b"abcd"
+    assert lz_compress(data, window_size=16) == (b"\x04abcdx\x8F\x00\x00"
+                                                 b"\x03abcd")
+    assert lz_compress(data)[-3:] == b"\x80\x00\x17"
+
+
+@pytest.mark.parametrize("data", [b"", b"Wikipedia", b"\xFF" * 10000])
+def test_adler32(data):
+    """Should match the algorithm used by the Lua implementation."""
+    a, b = 1, 0
+    for byte in bytearray(data):
+        a = (a + byte) % 65521
+        b = (b + a) % 65521
+    assert adler32(data) == b * 65536 + a
+
+
+class TestFileCache(object):
+
+    def test_creates_directory(self, tmpdir):
+        FileCache(str(tmpdir.join("a", "b")))
+        assert tmpdir.join("a", "b").check(dir=True)
+
+    def test_get_put(self, tmpdir):
+        c = FileCache(str(tmpdir))
+        assert c.get((123, "foo.txt", 3, 456)) is None
+        c.put((123, "foo.txt", 3, 456), b"foo")
+        assert c.get((123, "foo.txt", 3, 456)) == b"foo"
+        assert c.get((123, "foo.txt", 3, 457)) is None
+        assert c.get((124, "foo.txt", 3, 456)) is None
+
+        # Should persist
+        assert FileCache(str(tmpdir)).get((123, "foo.txt", 3, 456)) == b"foo"
+
+    def test_too_big(self, tmpdir):
+        c = FileCache(str(tmpdir), max_bytes=3)
+        c.put(("a", ), b"four")
+        assert c.get(("a", )) is None
+
+    def test_lru_eviction(self, tmpdir):
+        import os
+        c = FileCache(str(tmpdir), max_bytes=10)
+        c.put(("a", ), b"aaaa")
+        c.put(("b", ), b"bbbb")
+
+        # Make "a" most recently used (with a coarse clock, backdate b)
+        path_b = c._path(("b", ))
+        os.utime(path_b, (0, 0))
+        assert c.get(("a", )) == b"aaaa"
+
+        # Adding c should evict b only
+        c.put(("c", ), b"cccc")
+        assert c.get(("a", )) == b"aaaa"
+        assert c.get(("b", )) is None
+        assert c.get(("c", )) == b"cccc"
+
+
+@pytest.mark.parametrize("filename,path",
+                         [("a.lua", "a.lua"),
+                          ("dir/a.lua", "dir/a.lua"),
+                          ("/a.lua", "_/a.lua"),
+                          ("../../a.lua", "_/_/a.lua"),
+                          ("a//./b", "a/_/_/b")])
+def test_safe_path(filename, path):
+    import os
+    assert safe_path(filename) == path.replace("/", os.sep)
+
+
+@pytest.mark.parametrize("name,safe",
+                         [("a", "a"),
+                          ("/dev/ttyUSB0", "dev_ttyUSB0"),
+                          ("tcp://10.0.0.5:23", "tcp_10.0.0.5_23"),
+                          ("COM3", "COM3"),
+                          ("..", "_"),
+                          ("/", "_")])
+def test_safe_name(name, safe):
+    assert safe_name(name) == safe
+
+
+def test_directory_store(tmpdir):
+    import os
+    store = directory_store(str(tmpdir))
+    store("a.txt", b"ay")
+    store(os.path.join("b", "c", "d.txt"), b"dee")
+    store(os.path.join("b", "e.txt"), b"ee")
+    assert tmpdir.join("a.txt").read(mode="rb") == b"ay"
+    assert tmpdir.join("b", "c", "d.txt").read(mode="rb") == b"dee"
+    assert tmpdir.join("b", "e.txt").read(mode="rb") == b"ee"
+
+
+def test_tar_store():
+    import io
+    import tarfile
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode="w") as tar:
+        store = tar_store(tar)
+        store("a.txt", b"ay")
+        store("b/c.txt", b"")
+    f.seek(0)
+    with tarfile.open(fileobj=f) as tar:
+        assert tar.getnames() == ["a.txt", "b/c.txt"]
+        assert tar.extractfile("a.txt").read() == b"ay"
+
+
+class TestPullDevices(object):
+
+    def device(self, files):
+        n = Mock()
+        n.pull.side_effect = lambda cache: iter(sorted(files.items()))
+        return n
+
+    def test_single(self):
+        import os
+        store = Mock()
+        a = self.device({"x": b"12", "y/z": b"3"})
+        assert pull_devices({"/dev/a": a}, store, "cache") == {
+            "/dev/a": (2, 3)}
+        a.pull.assert_called_once_with(cache="cache")
+        assert store.mock_calls == [
+            ((os.path.join("x"), b"12"), ),
+            ((os.path.join("y", "z"), b"3"), ),
+        ]
+
+    def test_several(self):
+        import os
+        stored = {}
+        devices = {"/dev/a": self.device({"x": b"a"}),
+                   "/dev/b": self.device({"x": b"bb", "y": b""})}
+        assert pull_devices(devices, stored.__setitem__) == {
+            "/dev/a": (1, 1),
+            "/dev/b": (2, 2),
+        }
+        assert stored == {
+            os.path.join("dev_a", "x"): b"a",
+            os.path.join("dev_b", "x"): b"bb",
+            os.path.join("dev_b", "y"): b"",
+        }
+
+    def test_prefix_device(self):
+        import os
+        stored = {}
+        pull_devices({"a": self.device({"x": b""})}, stored.__setitem__,
+                     prefix_device=True)
+        assert stored == {os.path.join("a", "x"): b""}
+
+    def test_failure(self):
+        """Failures should be reported once all devices are done."""
+        stored = {}
+        bad = Mock()
+        bad.pull.side_effect = IOError("Timeout.")
+        devices = {"/dev/a": self.device({"x": b"a"}), "/dev/b": bad}
+        with pytest.raises(IOError):
+            pull_devices(devices, stored.__setitem__)
+        assert len(stored) == 1
+
+
+def test_inventory_devices():
+    devices = {}
+    for name in ("/dev/a", "/dev/b"):
+        devices[name] = Mock()
+        devices[name].get_inventory.return_value = {"chip_id": name}
+    assert inventory_devices(devices) == {
+        "/dev/a": {"chip_id": "/dev/a"},
+        "/dev/b": {"chip_id": "/dev/b"},
+    }
+
+
+def test_diff_inventories():
+    old = {
+        "1": {"version": "1.5.4", "heap": 100,
+              "files": {"a": {"size": 1, "hash": 2},
+                        "b": {"size": 3, "hash": 4}}},
+        # Devices missing from the latest scan are not reported
+        "2": {"version": "1.5.4", "heap": 100, "files": {}},
+    }
+    new = {
+        "1": {"version": "1.5.5", "heap": 200,
+              "files": {"a": {"size": 1, "hash": 5},
+                        "c": {"size": 6, "hash": 7}}},
+        "3": {"version": "1.5.4", "heap": 100, "files": {}},
+    }
+    assert diff_inventories(old, new) == [
+        ("1", "files/a", {"size": 1, "hash": 2}, {"size": 1, "hash": 5}),
+        ("1", "files/b", {"size": 3, "hash": 4}, None),
+        ("1", "files/c", None, {"size": 6, "hash": 7}),
+        ("1", "version", "1.5.4", "1.5.5"),
+        ("3", None, None, new["3"]),
+    ]
+    assert diff_inventories(old, old) == []
+
+
+def test_estimate_transfer_time():
+    # Opening and closing: 2 commands, 40 + 12 characters
+    # Blocks: 2 commands, 13 + 66 and 13 + 38 characters
+    assert estimate_transfer_time([("a", b"x" * 100)], 0.1, 1000.0) == \
+        pytest.approx(4 * 0.1 + 182 / 1000.0)
+    assert estimate_transfer_time([], 0.1, 1000.0) == 0.0
+
+
+def test_schedule_jobs():
+    assert schedule_jobs({"a": 5, "b": 4, "c": 3, "d": 3, "e": 1}, 2) == (
+        [("a", 0, 0, 5),
+         ("b", 1, 0, 4),
+         ("c", 1, 4, 7),
+         ("d", 0, 5, 8),
+         ("e", 1, 7, 8)],
+        8)
+    assert schedule_jobs({"a": 1}, 4) == ([("a", 0, 0, 1)], 1)
+    assert schedule_jobs({}, 1) == ([], 0.0)
+
+
+class FakeTime(object):
+    """A stand-in for the time module where time only passes on sleep (or
+    when advanced by hand)."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    """When used, nodemcuload's notion of time is replaced by a FakeTime."""
+    fake = FakeTime()
+    monkeypatch.setattr(nodemcuload, "time", fake)
+    return fake
+
+
+def test_deploy_devices(fake_time):
+    written = []
+
+    def device(link):
+        n = Mock()
+        n.measure_link.return_value = link
+
+        def write_file(filename, data, block_size, **kwargs):
+            assert block_size == 32
+            assert kwargs == {"compress": True}
+            written.append(filename)
+            fake_time.sleep(len(data))
+        n.write_file.side_effect = write_file
+        return n
+
+    devices = {"a": device((1.0, 1e9)),
+               "b": device((10.0, 1e9)),
+               "c": device((1.0, 1e9))}
+    manifest = {"a": [("a1", b"x"), ("a2", b"xx")],
+                "b": [("b1", b"x")],
+                # Devices not in the manifest are untouched
+                }
+    results, critical_path = deploy_devices(devices, manifest, workers=1,
+                                            block_size=32, compress=True)
+    # The slow link is done first
+    assert written == ["b1", "a1", "a2"]
+    assert results == {
+        "a": {"worker": 0, "estimate": pytest.approx(6.0), "actual": 3.0},
+        "b": {"worker": 0, "estimate": pytest.approx(30.0), "actual": 1.0},
+    }
+    assert critical_path == pytest.approx(36.0)
+    assert not devices["c"].measure_link.called
+    assert not devices["c"].write_file.called
+
+
+def test_deploy_devices_actual_worker(fake_time):
+    """The worker reported should be the one which wrote the device, even
+    if the schedule planned otherwise."""
+    import threading
+    y_started = threading.Event()
+    z_done = threading.Event()
+
+    def device(write_file):
+        n = Mock()
+        n.measure_link.return_value = (0.0, 1.0)
+        n.write_file.side_effect = write_file
+        return n
+
+    # x is planned for one worker and y and z for the other but x finishes
+    # early so its worker writes z while y is still being written.
+    devices = {"x": device(lambda *a, **k: y_started.wait(2.0)),
+               "y": device(lambda *a, **k: (y_started.set(),
+                                            z_done.wait(2.0))),
+               "z": device(lambda *a, **k: z_done.set())}
+    manifest = {"x": [("x", b"x" * 100)],
+                "y": [("y", b"y" * 50)],
+                "z": [("z", b"z" * 40)]}
+    results, _ = deploy_devices(devices, manifest, workers=2)
+    assert results["z"]["worker"] == results["x"]["worker"]
+    assert results["y"]["worker"] != results["x"]["worker"]
+
+
+class TestSerialRecorder(object):
+
+    def test_context_manager_passthrough(self):
+        s = MockSerial()
+        r = SerialRecorder(s, Mock())
+        with r:
+            assert s.context_manager_state == ["enter"]
+        assert s.context_manager_state == [
+            "enter", ("exit", (None, None, None), {})]
+
+    def test_in_waiting(self):
+        r = SerialRecorder(Mock(in_waiting=3), Mock())
+        assert r.in_waiting == 3
+
+    def test_transcript(self, fake_time):
+        """Both directions should be recorded, merging adjacent transfers."""
+        from io import BytesIO
+        s = MockSerial([b"",
+                        b"ping\r\n",
+                        b"pong\r\n"])
+        transcript = BytesIO()
+        r = SerialRecorder(s, transcript)
+
+        assert r.write(b"ping\r\n") == 6
+        fake_time.now += 0.5
+        assert r.read(2) == b"po"
+        assert r.read(2) == b"ng"
+        fake_time.now += 0.25
+        assert r.read(2) == b"\r\n"
+
+        # Nothing written until the line is complete
+        assert transcript.getvalue() == (
+            b"0.000000 > 70696e670d0a\n"
+            b"0.500000 < 706f6e67\n")
+        r.flush_transcript()
+        assert transcript.getvalue() == (
+            b"0.000000 > 70696e670d0a\n"
+            b"0.500000 < 706f6e67\n"
+            b"0.750000 < 0d0a\n")
+
+        # Should round-trip
+        transcript.seek(0)
+        assert read_transcript(transcript) == [
+            (0.0, ">", b"ping\r\n"),
+            (0.5, "<", b"pong"),
+            (0.75, "<", b"\r\n"),
+        ]
+
+    @pytest.mark.parametrize("baudrate,interval", [(None, 0.001),
+                                                   (115200, 0.001),
+                                                   (9600, 40.0 / 9600)])
+    def test_merge_interval(self, baudrate, interval):
+        s = Mock(spec=["read", "write"])
+        if baudrate is not None:
+            s.baudrate = baudrate
+        r = SerialRecorder(s, Mock())
+        assert r.merge_interval == pytest.approx(interval)
+        assert SerialRecorder(s, Mock(), 0.5).merge_interval == 0.5
+
+    def test_transcript_slow_baudrate(self, fake_time):
+        """At 9600 baud, byte-at-a-time reads (each taking longer than 1 ms)
+        should still be merged."""
+        from io import BytesIO
+        s = MockSerial([b"", b"=1\r\n", b"=1\r\n1\r\n"])
+        s.baudrate = 9600
+        transcript = BytesIO()
+        r = SerialRecorder(s, transcript)
+
+        r.write(b"=1\r\n")
+        fake_time.now += 0.01
+        for _ in range(7):
+            assert r.read(1)
+            fake_time.now += 10.0 / 9600
+        r.flush_transcript()
+        assert transcript.getvalue() == (
+            b"0.000000 > 3d310d0a\n"
+            b"0.010000 < 3d310d0a310d0a\n")
+
+    def test_timeout_not_recorded(self):
+        """Reads which time out without data shouldn't appear."""
+        from io import BytesIO
+        transcript = BytesIO()
+        r = SerialRecorder(Mock(read=Mock(return_value=b"")), transcript)
+        assert r.read(1) == b""
+        r.flush_transcript()
+        assert transcript.getvalue() == b""
+
+    def test_flush_on_exit(self):
+        from io import BytesIO
+        transcript = BytesIO()
+        r = SerialRecorder(MockSerial([b"", b"x"]), transcript)
+        with r:
+            r.write(b"x")
+        assert transcript.getvalue().endswith(b" > 78\n")
+
+    def test_read_transcript_blank_lines(self):
+        assert read_transcript([b"1.5 < 00\n", b"\n"]) == [
+            (1.5, "<", b"\x00")]
+
+
+class TestSerialReplay(object):
+
+    TRANSCRIPT = [
+        (0.5, "<", b"hello"),
+        (1.0, ">", b"ping\r\n"),
+        (1.25, "<", b"pong"),
+        (2.0, "<", b"\r\n"),
+    ]
+
+    def test_context_manager(self):
+        r = SerialReplay([])
+        with r as r2:
+            assert r2 is r
+
+    def test_replay_timing(self, fake_time):
+        """Reads should be delayed relative to the preceding write."""
+        r = SerialReplay(self.TRANSCRIPT)
+
+        # Data before the first write is relative to the start
+        assert r.in_waiting == 0
+        assert r.read(5) == b"hello"
+        assert fake_time.sleeps == [0.5]
+
+        # Data following a write is not available until the write occurs
+        assert r.read(1) == b""
+        fake_time.now += 10.0
+        assert r.write(b"ping") == 4
+        assert r.read(1) == b""
+        assert r.write(b"\r\n") == 2
+        assert r.in_waiting == 0
+        assert r.read(2) == b"po"
+        assert fake_time.sleeps == [0.5, 0.25]
+
+        # Partially consumed transfers are counted in in_waiting
+        assert r.in_waiting == 2
+        fake_time.now += 1.0
+        assert r.in_waiting == 4
+        assert r.read(10) == b"ng\r\n"
+        assert fake_time.sleeps == [0.5, 0.25]
+
+    def test_time_scale(self, fake_time):
+        r = SerialReplay(self.TRANSCRIPT, time_scale=0.5)
+        assert r.read(5) == b"hello"
+        r.write(b"ping\r\n")
+        assert r.read(6) == b"pong\r\n"
+        assert fake_time.sleeps == [0.25, 0.125, 0.375]
+
+    def test_strict(self, fake_time):
+        r = SerialReplay(self.TRANSCRIPT, time_scale=0)
+        with pytest.raises(IOError):
+            r.write(b"pong")
+
+        r = SerialReplay(self.TRANSCRIPT, time_scale=0)
+        with pytest.raises(IOError):
+            r.write(b"ping\r\nmore")
+
+    def test_not_strict(self, fake_time):
+        r = SerialReplay(self.TRANSCRIPT, time_scale=0, strict=False)
+        assert r.write(b"pong\r\nmore") == 10
+        assert r.read(100) == b"hellopong\r\n"
+
+    def test_nodemcu(self, fake_time):
+        """A NodeMCU should be usable with a replay."""
+        r = SerialReplay([
+            (0.0, ">", b"=node.info()\r\n"),
+            (0.1, "<", b"=node.info()\r\n1\t5\t1234\t4321\r\n"),
+        ])
+        assert NodeMCU(r).get_version() == (1, 5)
+
+
+@pytest.fixture
+def console_server():
+    """A loopback stand-in for a networked Lua console. Echoes each line
+    received and answers a few commands. Yields the port number."""
+    import socket
+    import threading
+
+    # Results are only returned using print (as if relayed by node.output)
+    responses = {
+        b"=node.info()": b"1\t5\t1234\t4321\r\n",
+        # list_files
+        b"do    local cnt = 0;    for k, v in pairs(file.list()) do"
+        b"        cnt = cnt + 1;    end;    print(cnt);end": b"1\r\n",
+        b"for f,s in pairs(file.list()) do    print(#f);    print(f);"
+        b"    print(s);end": b"5\r\na.txt\r\n4\r\n",
+        # read_file
+        b"file.close(); print(file.list()['a.txt']); "
+        b"print(file.open('a.txt', 'r'))": b"4\r\ntrue\r\n",
+        b"print(file.read(4))": b"hi\r\n\r\n",
+        # get_inventory
+        b"_nminv()": b"1\t5\t4\r\n42\t1\t2\t3\t4\r\n1\r\n"
+                     b"5\r\na.txt\r\n4\t0\t99\r\n",
+    }
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    def serve():
+        conn, _ = listener.accept()
+        data = b""
+        while True:
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+            while b"\r\n" in data:
+                line, _, data = data.partition(b"\r\n")
+                conn.sendall(line + b"\r\n" + responses.get(line, b""))
+        conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+
+    yield listener.getsockname()[1]
+
+    listener.close()
+    thread.join(1.0)
+
+
+class TestTCPSerial(object):
+
+    def test_socket_options(self, console_server):
+        import socket
+        with TCPSerial("127.0.0.1", console_server) as t:
+            assert t.socket.getsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_NODELAY)
+            assert t.socket.getsockopt(socket.SOL_SOCKET,
+                                       socket.SO_KEEPALIVE)
+
+    def test_read_write(self, console_server):
+        with TCPSerial("127.0.0.1", console_server) as t:
+            assert t.in_waiting == 0
+            assert t.write(b"hello\r\n") == 7
+            assert t.read(3) == b"hel"
+            assert t.read(4) == b"lo\r\n"
+
+    def test_in_waiting(self, console_server):
+        import select
+        with TCPSerial("127.0.0.1", console_server) as t:
+            t.write(b"hi\r\n")
+            select.select([t.socket], [], [], 2.0)
+            assert t.in_waiting == 4
+
+    def test_timeout(self, console_server):
+        with TCPSerial("127.0.0.1", console_server, timeout=0.05) as t:
+            t.write(b"hi\r\n")
+            assert t.read(10) == b"hi\r\n"
+
+    def test_closed(self, console_server):
+        """If the connection is closed, reads should return short."""
+        import socket
+        with TCPSerial("127.0.0.1", console_server) as t:
+            t.socket.shutdown(socket.SHUT_WR)
+            assert t.read(1) == b""
+
+    def test_nodemcu(self, console_server):
+        n = NodeMCU(TCPSerial("127.0.0.1", console_server))
+        with n:
+            assert n.get_version() == (1, 5)
+
+    def test_nodemcu_print_only(self, console_server):
+        """Raw data should be returned using print, not uart.write."""
+        n = NodeMCU(TCPSerial("127.0.0.1", console_server))
+        assert n.print_only
+        with n:
+            assert n.list_files() == {"a.txt": 4}
+            assert n.read_file("a.txt") == b"hi\r\n"
+            assert n.get_inventory()["files"] == {
+                "a.txt": {"size": 4, "hash": 99}}
+
+    def test_recorder_print_only(self):
+        assert SerialRecorder(Mock(print_only=True), Mock()).print_only
+        assert not SerialRecorder(object(), Mock()).print_only
+        assert NodeMCU(SerialRecorder(Mock(print_only=True),
+                                      Mock())).print_only
+        # Only a real True counts (not e.g. a Mock attribute)
+        assert not NodeMCU(Mock()).print_only
+        assert NodeMCU(Mock(), print_only=True).print_only
+
+
+class TestOpenTransport(object):
+
+    def test_serial(self, monkeypatch):
+        import serial
+        monkeypatch.setattr(serial, "Serial", Mock())
+        assert open_transport("/dev/null", 115200) is \
+            serial.Serial.return_value
+        serial.Serial.assert_called_once_with("/dev/null", 115200,
+                                              timeout=2.0)
+
+    @pytest.mark.parametrize("rtscts,xonxoff", [(True, False),
+                                                (False, True),
+                                                (True, True)])
+    def test_serial_flow_control(self, monkeypatch, rtscts, xonxoff):
+        import serial
+        monkeypatch.setattr(serial, "Serial", Mock())
+        open_transport("/dev/null", 115200, rtscts=rtscts, xonxoff=xonxoff)
+        expected = {}
+        if rtscts:
+            expected["rtscts"] = True
+        if xonxoff:
+            expected["xonxoff"] = True
+        serial.Serial.assert_called_once_with("/dev/null", 115200,
+                                              timeout=2.0, **expected)
+
+    @pytest.mark.parametrize("url,host,port",
+                             [("tcp://myhost", "myhost", 23),
+                              ("tcp://1.2.3.4:2323", "1.2.3.4", 2323)])
+    def test_tcp(self, monkeypatch, url, host, port):
+        monkeypatch.setattr(nodemcuload, "TCPSerial", Mock())
+        nodemcuload.TCPSerial.DEFAULT_PORT = 23
+        assert open_transport(url, 9600) is \
+            nodemcuload.TCPSerial.return_value
+        nodemcuload.TCPSerial.assert_called_once_with(host, port,
+                                                      timeout=2.0)
+
+
+def lock_is_free_elsewhere(lock):
+    """Test whether another thread could acquire a lock."""
+    import threading
+    result = []
+
+    def attempt():
+        acquired = lock.acquire(False)
+        if acquired:
+            lock.release()
+        result.append(acquired)
+    thread = threading.Thread(target=attempt)
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+class TestConsoleMonitor(object):
+
+    def nodemcu(self, *outputs):
+        """A NodeMCU whose port has the given output waiting in turn."""
+        outputs = list(outputs)
+        serial = Mock()
+        type(serial).in_waiting = property(
+            lambda self: len(outputs[0]) if outputs else 0)
+        serial.read.side_effect = lambda n: outputs.pop(0)[:n]
+        return NodeMCU(serial)
+
+    def test_poll(self):
+        callback = Mock()
+        m = ConsoleMonitor(self.nodemcu(b"hello", b" world"), callback)
+
+        assert m.poll() == b"hello"
+        callback.assert_called_once_with(b"hello")
+        assert m.poll() == b" world"
+        assert m.poll() == b""
+        assert callback.call_count == 2
+
+        assert m.read() == b"hello world"
+        assert m.read() == b""
+
+    def test_poll_busy(self):
+        """Nothing should be read while the device is in use elsewhere."""
+        import threading
+        n = self.nodemcu(b"hello")
+        m = ConsoleMonitor(n)
+
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with n.lock:
+                locked.set()
+                release.wait()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        locked.wait()
+        try:
+            assert m.poll() == b""
+        finally:
+            release.set()
+            thread.join()
+        assert m.poll() == b"hello"
+
+    def test_buffer_size(self):
+        m = ConsoleMonitor(self.nodemcu(b"abc", b"defg", b"hijklmn",
+                                        b"ab", b"cdefgh"),
+                           buffer_size=5)
+        m.poll()
+        m.poll()
+        assert m.read() == b"cdefg"
+        m.poll()
+        assert m.read() == b"jklmn"
+        m.poll()
+        m.poll()
+        assert m.read() == b"defgh"
+
+    def test_thread(self):
+        import threading
+        received = threading.Event()
+        n = self.nodemcu(b"hi")
+        with ConsoleMonitor(n, lambda data: received.set(),
+                            interval=0.001) as m:
+            assert received.wait(2.0)
+        assert m.read() == b"hi"
+        assert not m._thread.is_alive()
+
+    def test_stop_not_started(self):
+        m = ConsoleMonitor(self.nodemcu())
+        m.stop()
+        assert m._thread is None
+
+
+class TestDirectoryWatcher(object):
+
+    def touch(self, path, data, mtime):
+        import os
+        path.write(data, mode="wb", ensure=True)
+        os.utime(str(path), (mtime, mtime))
+
+    def test_scan(self, tmpdir):
+        self.touch(tmpdir.join("a.lua"), b"a", 100)
+        self.touch(tmpdir.join("sub", "b.lua"), b"bb", 200)
+        self.touch(tmpdir.join(".a.lua.swp"), b"", 100)
+        self.touch(tmpdir.join("a.lua~"), b"", 100)
+        self.touch(tmpdir.join(".git", "HEAD"), b"", 100)
+        w = DirectoryWatcher(str(tmpdir))
+        assert w.scan() == {"a.lua": (100, 1), "sub/b.lua": (200, 2)}
+
+    def test_scan_deleted(self, tmpdir, monkeypatch):
+        """Files deleted mid-scan should be skipped."""
+        import os
+        self.touch(tmpdir.join("a.lua"), b"a", 100)
+        w = DirectoryWatcher(str(tmpdir))
+        monkeypatch.setattr(os, "stat", Mock(side_effect=OSError))
+        assert w.scan() == {}
+
+    def test_poll(self, tmpdir, fake_time):
+        self.touch(tmpdir.join("a.lua"), b"a", 100)
+        self.touch(tmpdir.join("b.lua"), b"b", 100)
+        w = DirectoryWatcher(str(tmpdir), debounce=1.0)
+
+        # Existing files are not reported
+        assert w.poll() == []
+        fake_time.now += 10
+        assert w.poll() == []
+
+        # Changes are only reported once things settle
+        self.touch(tmpdir.join("a.lua"), b"a", 101)
+        assert w.poll() == []
+        fake_time.now += 0.5
+        self.touch(tmpdir.join("c.lua"), b"c", 101)
+        assert w.poll() == []
+        fake_time.now += 0.5
+        assert w.poll() == []
+        fake_time.now += 0.5
+        assert w.poll() == ["a.lua", "c.lua"]
+        fake_time.now += 10
+        assert w.poll() == []
+
+        # Size changes are changes too, deletions are not
+        self.touch(tmpdir.join("b.lua"), b"bb", 100)
+        tmpdir.join("c.lua").remove()
+        assert w.poll() == []
+        fake_time.now += 1.0
+        assert w.poll() == ["b.lua"]
+
+
+class TestProfiler(object):
+
+    @pytest.fixture
+    def slow_serial(self, fake_time):
+        """A serial port at 1000 baud where each write takes 1 second (and
+        the host uses no CPU time)."""
+        fake_time.process_time = lambda: 0.0
+        s = MockSerial([b""] + command(b"=node.heap()", b"123\r\n"))
+        s.baudrate = 1000
+        write = s.write
+
+        def slow_write(data):
+            fake_time.now += 1.0
+            return write(data)
+        s.write = slow_write
+        return s
+
+    def test_timings(self, slow_serial):
+        n = NodeMCU(slow_serial)
+        get_heap = vars(NodeMCU)["get_heap"]
+        encode = nodemcuload.lua_bytes
+        with Profiler() as profiler:
+            assert n.get_heap() == 123
+            nodemcuload.lua_bytes(b"x")
+
+        assert profiler.timings["NodeMCU.get_heap"] == [1, 1.0]
+        assert profiler.timings["NodeMCU.write"] == [1, 1.0]
+        assert profiler.timings["NodeMCU.read"] == [19, 0.0]
+        assert profiler.timings["lua_bytes"] == [1, 0.0]
+
+        # 33 bytes sent and received
+        assert profiler.breakdown == {
+            "wall": 1.0,
+            "host_cpu": 0.0,
+            "serial_io": pytest.approx(0.33),
+            "device": pytest.approx(0.67),
+            "other": 0.0,
+        }
+
+        report = profiler.report()
+        assert "Wall time" in report
+        assert "NodeMCU.get_heap" in report
+        # Unused methods are omitted
+        assert "NodeMCU.format" not in report
+
+        # The timers are removed afterwards
+        assert vars(NodeMCU)["get_heap"] is get_heap
+        assert nodemcuload.lua_bytes is encode
+
+    def test_breakdown_partitions_wall_time(self, slow_serial, fake_time):
+        """CPU time used during serial I/O should not be counted twice."""
+        cpu = [0.0]
+        fake_time.process_time = lambda: cpu[0]
+        write = slow_serial.write
+
+        def busy_write(data):
+            cpu[0] += 0.5
+            return write(data)
+        slow_serial.write = busy_write
+        n = NodeMCU(slow_serial)
+        with Profiler() as profiler:
+            n.get_heap()
+            # Some host work outside of the I/O
+            fake_time.now += 0.25
+            cpu[0] += 0.25
+
+        breakdown = profiler.breakdown
+        assert breakdown["wall"] == 1.25
+        assert breakdown["host_cpu"] == pytest.approx(0.25)
+        assert (breakdown["host_cpu"] + breakdown["serial_io"] +
+                breakdown["device"] + breakdown["other"] ==
+                pytest.approx(breakdown["wall"]))
+
+    def test_generator(self, fake_time, monkeypatch):
+        """Generators should be timed while iterated, not when created."""
+        fake_time.process_time = lambda: 0.0
+        n = NodeMCU(Mock())
+        monkeypatch.setattr(n, "list_files", Mock(return_value={"a": 1,
+                                                                "b": 1}))
+
+        def read_file(filename, block_size, cache):
+            fake_time.now += 1.0
+            return b"x"
+        monkeypatch.setattr(n, "read_file", read_file)
+
+        with Profiler() as profiler:
+            files = n.pull()
+            assert profiler.timings["NodeMCU.pull"] == [1, 0.0]
+            assert list(files) == [("a", b"x"), ("b", b"x")]
+        assert profiler.timings["NodeMCU.pull"] == [1, 2.0]
+
+    def test_unknown_baudrate(self, slow_serial):
+        """Without a baudrate all waiting is attributed to the device."""
+        del slow_serial.baudrate
+        n = NodeMCU(slow_serial)
+        with Profiler() as profiler:
+            n.get_heap()
+        assert profiler.breakdown["serial_io"] == 0.0
+        assert profiler.breakdown["device"] == 1.0
+
+    def test_stats_file(self, tmpdir):
+        import pstats
+        filename = str(tmpdir.join("out.pstats"))
+        with Profiler(filename):
+            lua_bytes(b"x")
+        stats = pstats.Stats(filename)
+        assert any(function == "lua_bytes"
+                   for _, _, function in stats.stats)
+
+    def test_empty(self):
+        with Profiler() as profiler:
+            pass
+        assert "Wall time" in profiler.report()
+
+
 class TestNodeMCU(object):
 
     def test_context_manager_wrapper(self):
@@ -136,6 +1198,23 @@ class TestNodeMCU(object):
         assert s.context_manager_state == [
             "enter", ("exit", (None, None, None), {})]
 
+    def test_locked(self):
+        """Methods should hold the device lock while communicating."""
+        s = MockSerial([b""] + command(b"=node.info()", b"1\t4\r\n"))
+        n = NodeMCU(s)
+
+        free = []
+        write = s.write
+
+        def check_lock_and_write(data):
+            free.append(lock_is_free_elsewhere(n.lock))
+            return write(data)
+        s.write = check_lock_and_write
+
+        assert n.get_version() == (1, 4)
+        assert free == [False]
+        assert lock_is_free_elsewhere(n.lock)
+
     def test_read(self):
         """Read wrapper should work as expected..."""
         s = Mock(read=Mock(return_value=b"passes"))
@@ -214,6 +1293,103 @@ class TestNodeMCU(object):
         # Should have read in the echo-back but left the response
         assert s.expected_sequence[0] == response
 
+    def test_send_command_corrupt_echo(self):
+        """Corrupted echoes should be detected and counted."""
+        s = MockSerial([b"",
+                        b"foo()\r\n",
+                        b"fo\x00()\r\n"])
+        n = NodeMCU(s)
+
+        with pytest.raises(IOError):
+            n.send_command(b"foo()")
+        assert n.overruns == 1
+
+    @pytest.mark.parametrize("prompt", [b"", b"> ", b">> "])
+    def test_send_command_paced(self, prompt):
+        """Commands should be sent in chunks, each awaiting its echo."""
+        s = MockSerial([b"",
+                        b"foo(", prompt + b"foo(",
+                        b"1, 2", b"1, 2",
+                        b")", b")",
+                        b"\r\n", b"\r\nresponse\r\n"])
+        n = NodeMCU(s, max_outstanding=4)
+
+        n.send_command(b"foo(1, 2)")
+
+        assert s.expected_sequence == [b"response\r\n"]
+        assert n.overruns == 0
+
+    def test_send_command_paced_corrupt_first(self):
+        """A corrupt first chunk can't be told apart from a prompt until no
+        more data arrives."""
+        s = Mock(write=Mock(side_effect=len),
+                 read=Mock(side_effect=[b"fXo(", b""]))
+        n = NodeMCU(s, max_outstanding=4)
+
+        with pytest.raises(IOError):
+            n.send_command(b"foo(1, 2)")
+        assert n.overruns == 1
+        s.write.assert_called_once_with(b"foo(")
+
+    @pytest.mark.parametrize("first,second",
+                             [(b">> fXo(", None),
+                              (b"foo(", b"1,,2")])
+    def test_send_command_paced_corrupt(self, first, second):
+        """Corruption should be detected before the command is completed."""
+        sequence = [b"", b"foo(", first]
+        if second is not None:
+            sequence += [b"1, 2", second]
+        s = MockSerial(sequence)
+        n = NodeMCU(s, max_outstanding=4)
+
+        with pytest.raises(IOError):
+            n.send_command(b"foo(1, 2)")
+        assert n.overruns == 1
+        assert s.finished
+
+    def test_send_command_paced_corrupt_line_end(self):
+        s = MockSerial([b"",
+                        b"foo(", b"foo(",
+                        b"\r\n", b"\x00\r\n"])
+        n = NodeMCU(s, max_outstanding=4)
+
+        with pytest.raises(IOError):
+            n.send_command(b"foo(")
+        assert n.overruns == 1
+
+    def test_resync(self):
+        s = MockSerial([b"junk",
+                        b"\r\nprint('nms' .. 'ync1')\r\n",
+                        b"\r\n> print('nms' .. 'ync1')\r\nnmsync1\r\n"])
+        n = NodeMCU(s)
+
+        n.resync()
+
+        assert s.finished
+
+    def test_resync_retries(self):
+        """If the token doesn't appear, try again with a new token."""
+        s = Mock(in_waiting=0, write=Mock(side_effect=len),
+                 read=Mock(side_effect=[b""] + [
+                     bytes(bytearray([c])) for c in bytearray(b"nmsync2\r\n")
+                 ]))
+        n = NodeMCU(s)
+
+        n.resync()
+
+        assert s.write.mock_calls[-1][1][0] == (
+            b"\r\nprint('nms' .. 'ync2')\r\n")
+
+    def test_resync_fails(self):
+        s = Mock(in_waiting=0, write=Mock(side_effect=len),
+                 read=Mock(return_value=b""))
+        n = NodeMCU(s)
+
+        with pytest.raises(IOError):
+            n.resync(attempts=2)
+
+        assert s.write.call_count == 2
+
     def test_get_version(self):
         """Make sure versions are correctly decoded."""
         s = MockSerial([b"",                       # Nothing to read in buffer
@@ -232,12 +1408,11 @@ class TestNodeMCU(object):
     def test_write_file_unopenable(self):
         """Files which can't be opened for write cause an error."""
         s = MockSerial([b"",
-                        # Close existing file
-                        b"file.close()\r\n",
-                        b"file.close()\r\n",
-                        # Open file
-                        b"=file.open('test.txt', 'w')\r\n",
-                        b"=file.open('test.txt', 'w')\r\nnil\r\n"])
+                        # Close any open file and open this one
+                        b"file.close(); print(file.open('test.txt', 'w'))"
+                        b"\r\n",
+                        b"file.close(); print(file.open('test.txt', 'w'))"
+                        b"\r\nnil\r\n"])
         n = NodeMCU(s)
 
         with pytest.raises(IOError):
@@ -248,12 +1423,11 @@ class TestNodeMCU(object):
     def test_write_file_unwriteable(self):
         """Files which can't be be written to cause an error."""
         s = MockSerial([b"",
-                        # Close existing file
-                        b"file.close()\r\n",
-                        b"file.close()\r\n",
-                        # Open file
-                        b"=file.open('test.txt', 'w')\r\n",
-                        b"=file.open('test.txt', 'w')\r\ntrue\r\n",
+                        # Close any open file and open this one
+                        b"file.close(); print(file.open('test.txt', 'w'))"
+                        b"\r\n",
+                        b"file.close(); print(file.open('test.txt', 'w'))"
+                        b"\r\ntrue\r\n",
                         # Write fails
                         b"=file.write('1234')\r\n",
                         b"=file.write('1234')\r\nnil\r\n"])
@@ -267,12 +1441,11 @@ class TestNodeMCU(object):
     def test_write_file(self):
         """Writing should succeed in blocks of some predetermined size."""
         s = MockSerial([b"",
-                        # Close existing file
-                        b"file.close()\r\n",
-                        b"file.close()\r\n",
-                        # Open file
-                        b"=file.open('test.txt', 'w')\r\n",
-                        b"=file.open('test.txt', 'w')\r\ntrue\r\n",
+                        # Close any open file and open this one
+                        b"file.close(); print(file.open('test.txt', 'w'))"
+                        b"\r\n",
+                        b"file.close(); print(file.open('test.txt', 'w'))"
+                        b"\r\ntrue\r\n",
                         # Write part 1
                         b"=file.write('12')\r\n",
                         b"=file.write('12')\r\ntrue\r\n",
@@ -289,15 +1462,492 @@ class TestNodeMCU(object):
 
         assert s.finished
 
+    def test_get_heap(self):
+        s = MockSerial([b""] + command(b"=node.heap()", b"21000\r\n"))
+        assert NodeMCU(s).get_heap() == 21000
+        assert s.finished
+
+    def test_get_fs_info(self):
+        s = MockSerial([b""] + command(b"=file.fsinfo()",
+                                       b"100\t200\t300\r\n"))
+        assert NodeMCU(s).get_fs_info() == (100, 200, 300)
+        assert s.finished
+
+    SPACE_CHECK = b"=file.list()['test.txt'] or 0, file.fsinfo()"
+
+    OPEN_FOR_WRITE = b"file.close(); print(file.open('test.txt', 'w'))"
+
+    OPEN_FOR_READ = (b"file.close(); print(file.list()['test.txt']); "
+                     b"print(file.open('test.txt', 'r'))")
+
+    def test_write_file_heap_aware_no_space(self):
+        """Writes which won't fit should be refused up front."""
+        s = MockSerial([b""] + command(self.SPACE_CHECK,
+                                       b"2\t1\t100\t101\r\n"))
+        n = NodeMCU(s)
+
+        with pytest.raises(IOError):
+            n.write_file("test.txt", b"1234", heap_aware=True)
+
+        assert s.finished
+
+    def test_write_file_heap_aware(self, monkeypatch):
+        """Block sizes should follow the free heap, probed periodically."""
+        monkeypatch.setattr(NodeMCU, "HEAP_PROBE_INTERVAL", 2)
+        monkeypatch.setattr(NodeMCU, "MIN_HEAP_BUDGET", 1)
+        s = MockSerial([b""] +
+                       # Replaces existing 1 byte file with 3 free
+                       command(self.SPACE_CHECK,
+                               b"1\t3\t100\t103\r\n") +
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       # Room for a 3 character literal
+                       command(b"=node.heap()", b"48\r\n") +
+                       command(b"=file.write('1')", b"true\r\n") +
+                       command(b"=file.write('2')", b"true\r\n") +
+                       # Then a 4 character literal
+                       command(b"=node.heap()", b"64\r\n") +
+                       command(b"=file.write('34')", b"true\r\n") +
+                       command(b"file.close()"))
+        n = NodeMCU(s)
+
+        n.write_file("test.txt", b"1234", heap_aware=True)
+
+        assert s.finished
+
+    def test_write_file_heap_aware_line_limit(self):
+        """Blocks should never exceed the interpreter's line length."""
+        data = b"\x00" * 100
+        s = MockSerial([b""] +
+                       command(self.SPACE_CHECK, b"0\t1000\t0\t1000\r\n") +
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       command(b"=node.heap()", b"40000\r\n") +
+                       command(b"=file.write(" + lua_bytes(data[:60]) + b")",
+                               b"true\r\n") +
+                       command(b"=file.write(" + lua_bytes(data[60:]) + b")",
+                               b"true\r\n") +
+                       command(b"file.close()"))
+        n = NodeMCU(s)
+
+        n.write_file("test.txt", data, heap_aware=True)
+
+        assert s.finished
+
+    def test_write_file_heap_aware_no_heap(self):
+        s = MockSerial([b""] +
+                       command(self.SPACE_CHECK, b"0\t1000\t0\t1000\r\n") +
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       command(b"=node.heap()", b"200\r\n"))
+        n = NodeMCU(s)
+
+        with pytest.raises(IOError):
+            n.write_file("test.txt", b"1234", heap_aware=True)
+
+        assert s.finished
+
+    BASE64_PROBE = b"=encoder ~= nil and encoder.fromBase64 ~= nil"
+
+    def test_has_base64(self):
+        """Base64 support should be probed once and cached."""
+        s = MockSerial([b""] +
+                       command(self.BASE64_PROBE,
+                               b"false\r\n"))
+        n = NodeMCU(s)
+        assert n.has_base64() is False
+        assert n.has_base64() is False
+        assert s.finished
+
+    def test_write_file_bad_encoding(self):
+        with pytest.raises(ValueError):
+            NodeMCU(MockSerial()).write_file("test.txt", b"", encoding="rot13")
+
+    def test_write_file_base64(self):
+        """Base64 blocks should be decoded on the device."""
+        s = MockSerial([b""] +
+                       command(self.BASE64_PROBE,
+                               b"true\r\n") +
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       command(b"=file.write(encoder.fromBase64('AP8B'))",
+                               b"true\r\n") +
+                       command(b"=file.write(encoder.fromBase64('Ag=='))",
+                               b"true\r\n") +
+                       command(b"file.close()"))
+        n = NodeMCU(s)
+
+        n.write_file("test.txt", b"\x00\xff\x01\x02", block_size=3,
+                     encoding="base64")
+
+        assert s.finished
+
+    def test_write_file_base64_unsupported(self):
+        s = MockSerial([b""] +
+                       command(self.BASE64_PROBE,
+                               b"false\r\n"))
+        n = NodeMCU(s)
+
+        with pytest.raises(IOError):
+            n.write_file("test.txt", b"1234", encoding="base64")
+
+        assert s.finished
+
+    @pytest.mark.parametrize("supported", [True, False])
+    def test_write_file_auto(self, supported):
+        """The shorter encoding should be chosen for each block."""
+        text = b"a" * 30
+        binary = b"\xff" * 30
+        s = MockSerial(
+            [b""] +
+            command(self.BASE64_PROBE,
+                    b"true\r\n" if supported else b"false\r\n") +
+            command(self.OPEN_FOR_WRITE, b"true\r\n") +
+            command(b"=file.write(" + lua_bytes(text) + b")", b"true\r\n") +
+            (command(b"=file.write(encoder.fromBase64('" +
+                     b64encode(binary) + b"'))", b"true\r\n")
+             if supported else
+             command(b"=file.write(" + lua_bytes(binary) + b")",
+                     b"true\r\n")) +
+            command(b"file.close()"))
+        n = NodeMCU(s)
+
+        n.write_file("test.txt", text + binary, block_size=30,
+                     encoding="auto",
+                     compress=False)
+
+        assert s.finished
+
+    def test_write_file_heap_aware_base64(self):
+        """Heap-aware base64 blocks should fill the line."""
+        data = bytes(bytearray(range(200)))
+        s = MockSerial([b""] +
+                       command(self.BASE64_PROBE,
+                               b"true\r\n") +
+                       command(self.SPACE_CHECK, b"0\t1000\t0\t1000\r\n") +
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       command(b"=node.heap()", b"40000\r\n") +
+                       command(b"=file.write(encoder.fromBase64('" +
+                               b64encode(data[:165]) + b"'))",
+                               b"true\r\n") +
+                       command(b"=file.write(encoder.fromBase64('" +
+                               b64encode(data[165:]) + b"'))",
+                               b"true\r\n") +
+                       command(b"file.close()"))
+        n = NodeMCU(s)
+
+        n.write_file("test.txt", data, heap_aware=True, encoding="base64")
+
+        assert s.finished
+
+    @pytest.mark.parametrize("max_length", [1, 5, 6])
+    def test_write_block_command_base64_minimum(self, max_length):
+        """Even tiny budgets should carry one base64 group."""
+        n = NodeMCU(Mock())
+        command, num_bytes = n._write_block_command(
+            b"abcdef", 0, 64, ["base64"], max_length, b"file.write")
+        assert num_bytes == 3
+        assert command == b"=file.write(encoder.fromBase64('YWJj'))"
+
+    LZ_START = (define_sequence(LZ_DECOMPRESS_LUA) +
+                command(OPEN_FOR_WRITE + b"; _nmlzp, _nmlzw = '', ''",
+                        b"true\r\n"))
+    LZ_END = b"file.close(); _nmlzp, _nmlzw = nil, nil"
+
+    def test_write_file_compress(self):
+        """Compressed data should be decompressed on the device."""
+        s = MockSerial([b""] + self.LZ_START +
+                       command(b"=_nmlz(" +
+                               lua_bytes(lz_compress(b"a" * 1000)) + b")",
+                               b"true\r\n") +
+                       command(self.LZ_END) +
+                       # Decompressor already defined
+                       command(self.OPEN_FOR_WRITE +
+                               b"; _nmlzp, _nmlzw = '', ''", b"true\r\n") +
+                       # Blocks may split tokens
+                       command(b"=_nmlz('\\x00b')", b"true\r\n") +
+                       command(b"=_nmlz('\\xDF\\x00')", b"true\r\n") +
+                       command(b"=_nmlz('\\x00')", b"true\r\n") +
+                       command(self.LZ_END))
+        n = NodeMCU(s)
+
+        assert n.write_file("test.txt", b"a" * 1000, compress=True) is True
+        assert n.write_file("test.txt", b"b" * 100, block_size=2,
+                            compress=True) is True
+        assert n.bytes_written == 1100
+        assert n.bytes_sent == len(lz_compress(b"a" * 1000)) + 5
+
+        assert s.finished
+
+    def test_write_file_compress_incompressible(self):
+        """Data should be sent as-is if compression doesn't help."""
+        s = MockSerial([b""] +
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       command(b"=file.write('abc')", b"true\r\n") +
+                       command(b"file.close()"))
+        n = NodeMCU(s)
+
+        assert n.write_file("test.txt", b"abc", compress=True) is False
+        assert n.bytes_written == n.bytes_sent == 3
+
+        assert s.finished
+
+    def test_write_file_compress_retry(self):
+        """Failed compressed writes should start again."""
+        s = MockSerial([b""] + self.LZ_START +
+                       command(b"=_nmlz('\\x00a')", b"true\r\n") +
+                       command(b"=_nmlz('\\xDF\\x00')", b"nil\r\n") +
+                       self.resync_sequence(1) +
+                       self.reopen_sequence(0) +
+                       command(b"_nmlzp, _nmlzw = '', ''") +
+                       command(b"=_nmlz('\\x00a')", b"true\r\n") +
+                       command(b"=_nmlz('\\xDF\\x00')", b"true\r\n") +
+                       command(b"=_nmlz('\\x00')", b"true\r\n") +
+                       self.size_sequence(100) +
+                       command(self.LZ_END))
+        n = NodeMCU(s, max_retries=1)
+
+        n.write_file("test.txt", b"a" * 100, block_size=2, compress=True)
+
+        assert n.retries == 1
+        assert s.finished
+
+    def test_write_file_compress_retries_exhausted(self):
+        """Since compressed writes start again, retries are limited over the
+        whole file rather than per block."""
+        s = MockSerial([b""] + self.LZ_START +
+                       command(b"=_nmlz('\\x00a')", b"true\r\n") +
+                       command(b"=_nmlz('\\xDF\\x00')", b"nil\r\n") +
+                       self.resync_sequence(1) +
+                       self.reopen_sequence(0) +
+                       command(b"_nmlzp, _nmlzw = '', ''") +
+                       command(b"=_nmlz('\\x00a')", b"true\r\n") +
+                       command(b"=_nmlz('\\xDF\\x00')", b"nil\r\n"))
+        n = NodeMCU(s, max_retries=1)
+
+        with pytest.raises(IOError):
+            n.write_file("test.txt", b"a" * 100, block_size=2, compress=True)
+
+        assert n.retries == 1
+        assert s.finished
+
+    BUFFER_START = (define_sequence(WRITE_BUFFER_LUA) +
+                    command(OPEN_FOR_WRITE + b"; _nmb = {}", b"true\r\n"))
+    BUFFER_END = b"file.close(); _nmb = nil"
+
+    def test_write_file_buffered(self):
+        """Blocks should be written to flash once enough are buffered."""
+        s = MockSerial([b""] + self.BUFFER_START +
+                       command(b"=_nmba('12')", b"true\r\n") +
+                       command(b"=_nmbw('34')", b"true\r\n") +
+                       command(b"=_nmba('56')", b"true\r\n") +
+                       command(b"=_nmbw('78')", b"true\r\n") +
+                       # The final write is always flushed
+                       command(b"=_nmbf('9')", b"true\r\n") +
+                       command(self.BUFFER_END) +
+                       # Flush periodically, defining the buffer only once
+                       command(self.OPEN_FOR_WRITE + b"; _nmb = {}",
+                               b"true\r\n") +
+                       command(b"=_nmbw('12')", b"true\r\n") +
+                       command(b"=_nmbf('34')", b"true\r\n") +
+                       command(b"=_nmbw('56')", b"true\r\n") +
+                       command(b"=_nmbf('78')", b"true\r\n") +
+                       command(self.BUFFER_END))
+        n = NodeMCU(s)
+
+        n.write_file("test.txt", b"123456789", block_size=2, write_buffer=3)
+        n.write_file("test.txt", b"12345678", block_size=2, write_buffer=1,
+                     flush_interval=2)
+
+        assert s.finished
+
+    def test_write_file_buffered_retry(self):
+        """Failed buffered writes should resume from the last flash write."""
+        s = MockSerial([b""] + self.BUFFER_START +
+                       command(b"=_nmba('12')", b"true\r\n") +
+                       command(b"=_nmbw('34')", b"true\r\n") +
+                       command(b"=_nmba('56')", b"true\r\n") +
+                       command(b"=_nmbf('7')", b"nil\r\n") +
+                       self.resync_sequence(1) +
+                       self.reopen_sequence(4) +
+                       command(b"_nmb = {}") +
+                       command(b"=_nmba('56')", b"true\r\n") +
+                       command(b"=_nmbf('7')", b"true\r\n") +
+                       self.size_sequence(7) +
+                       command(self.BUFFER_END))
+        n = NodeMCU(s, max_retries=1)
+
+        n.write_file("test.txt", b"1234567", block_size=2, write_buffer=4)
+
+        assert n.retries == 1
+        assert s.finished
+
+    def test_write_file_buffered_retries_exhausted(self):
+        """Blocks resent after a failure don't reset the failure count until
+        they reach flash, so periodic failures can't loop forever."""
+        s = MockSerial([b""] + self.BUFFER_START +
+                       command(b"=_nmba('12')", b"true\r\n") +
+                       command(b"=_nmba('34')", b"nil\r\n") +
+                       self.resync_sequence(1) +
+                       self.reopen_sequence(0) +
+                       command(b"_nmb = {}") +
+                       command(b"=_nmba('12')", b"true\r\n") +
+                       command(b"=_nmba('34')", b"nil\r\n"))
+        n = NodeMCU(s, max_retries=1)
+
+        with pytest.raises(IOError):
+            n.write_file("test.txt", b"123456", block_size=2,
+                         write_buffer=6)
+
+        assert n.retries == 1
+        assert s.finished
+
+    def test_write_file_buffered_compressed(self):
+        """The decompressor does its own buffering."""
+        s = MockSerial([b""] + self.LZ_START +
+                       command(b"=_nmlz(" +
+                               lua_bytes(lz_compress(b"a" * 1000)) + b")",
+                               b"true\r\n") +
+                       command(self.LZ_END))
+        n = NodeMCU(s)
+
+        n.write_file("test.txt", b"a" * 1000, compress=True,
+                     write_buffer=1024)
+
+        assert s.finished
+
+    def test_read_file_heap_aware(self, monkeypatch):
+        monkeypatch.setattr(NodeMCU, "HEAP_PROBE_INTERVAL", 2)
+        monkeypatch.setattr(NodeMCU, "MAX_READ_BLOCK_SIZE", 3)
+        monkeypatch.setattr(NodeMCU, "MIN_HEAP_BUDGET", 1)
+        s = MockSerial([b""] +
+                       command(self.OPEN_FOR_READ, b"7\r\ntrue\r\n") +
+                       command(b"=node.heap()", b"32\r\n") +
+                       command(b"uart.write(0, file.read(2))", b"12") +
+                       command(b"uart.write(0, file.read(2))", b"34") +
+                       command(b"=node.heap()", b"1000\r\n") +
+                       command(b"uart.write(0, file.read(3))", b"567") +
+                       command(b"file.close()"))
+        n = NodeMCU(s)
+
+        assert n.read_file("test.txt", heap_aware=True) == b"1234567"
+
+        assert s.finished
+
+    def reopen_sequence(self, offset, response=None):
+        return command(b"file.close(); print(file.open('test.txt', 'r+') and "
+                       b"file.seek('set', " + str(offset).encode("ascii") +
+                       b"))",
+                       response or str(offset).encode("ascii") + b"\r\n")
+
+    def size_sequence(self, size):
+        return command(b"file.close(); print(file.list()['test.txt'])",
+                       str(size).encode("ascii") + b"\r\n")
+
+    def resync_sequence(self, count):
+        token = "nmsync{}".format(count).encode("ascii")
+        cmd = b"\r\nprint('" + token[:3] + b"' .. '" + token[3:] + b"')\r\n"
+        return [cmd, cmd + token + b"\r\n"]
+
+    def test_write_file_retry(self):
+        """Failed blocks should be retried after resynchronising."""
+        s = MockSerial([b""] +
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       command(b"=file.write('12')", b"true\r\n") +
+                       # Garbled echo
+                       [b"=file.write('34')\r\n",
+                        b"=fi\x00e.write('34')\r\n"] +
+                       self.resync_sequence(1) +
+                       self.reopen_sequence(2) +
+                       # Failed write
+                       command(b"=file.write('34')", b"nil\r\n") +
+                       self.resync_sequence(2) +
+                       self.reopen_sequence(2) +
+                       command(b"=file.write('34')", b"true\r\n") +
+                       # Failure count reset after success
+                       command(b"=file.write('5')", b"nil\r\n") +
+                       self.resync_sequence(3) +
+                       self.reopen_sequence(4) +
+                       command(b"=file.write('5')", b"true\r\n") +
+                       self.size_sequence(5) +
+                       command(b"file.close()"))
+        n = NodeMCU(s, max_retries=2)
+
+        n.write_file("test.txt", b"12345", 2)
+
+        assert n.retries == 3
+        assert s.finished
+
+    def test_write_file_retry_wrong_size(self):
+        """If a failed block wrote past the end, the file should be written
+        again from scratch (truncating it)."""
+        s = MockSerial([b""] +
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       command(b"=file.write('12')", b"true\r\n") +
+                       command(b"=file.write('3')", b"nil\r\n") +
+                       self.resync_sequence(1) +
+                       self.reopen_sequence(2) +
+                       command(b"=file.write('3')", b"true\r\n") +
+                       self.size_sequence(7) +
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       command(b"=file.write('12')", b"true\r\n") +
+                       command(b"=file.write('3')", b"true\r\n") +
+                       command(b"file.close()") +
+                       # Give up if the size is still wrong
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       command(b"=file.write('12')", b"true\r\n") +
+                       command(b"=file.write('3')", b"nil\r\n") +
+                       self.resync_sequence(2) +
+                       self.reopen_sequence(2) +
+                       command(b"=file.write('3')", b"true\r\n") +
+                       self.size_sequence(4) +
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       command(b"=file.write('12')", b"true\r\n") +
+                       command(b"=file.write('3')", b"nil\r\n") +
+                       self.resync_sequence(3) +
+                       self.reopen_sequence(2) +
+                       command(b"=file.write('3')", b"true\r\n") +
+                       self.size_sequence(4))
+        n = NodeMCU(s, max_retries=1)
+
+        n.write_file("test.txt", b"123", 2)
+        assert n.retries == 2
+        with pytest.raises(IOError):
+            n.write_file("test.txt", b"123", 2)
+
+        assert n.retries == 5
+        assert s.finished
+
+    def test_write_file_retries_exhausted(self):
+        s = MockSerial([b""] +
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       command(b"=file.write('12')", b"nil\r\n") +
+                       self.resync_sequence(1) +
+                       self.reopen_sequence(0) +
+                       command(b"=file.write('12')", b"nil\r\n"))
+        n = NodeMCU(s, max_retries=1)
+
+        with pytest.raises(IOError):
+            n.write_file("test.txt", b"12", 2)
+
+        assert n.retries == 1
+        assert s.finished
+
+    def test_write_file_retry_reopen_fails(self):
+        s = MockSerial([b""] +
+                       command(self.OPEN_FOR_WRITE, b"true\r\n") +
+                       command(b"=file.write('12')", b"nil\r\n") +
+                       self.resync_sequence(1) +
+                       self.reopen_sequence(0, b"nil\r\n"))
+        n = NodeMCU(s, max_retries=1)
+
+        with pytest.raises(IOError):
+            n.write_file("test.txt", b"12", 2)
+
+        assert s.finished
+
     def test_read_file_not_exists(self):
         """Files which can't be opened for read cause an error."""
         s = MockSerial([b"",
-                        # Close existing file
-                        b"file.close()\r\n",
-                        b"file.close()\r\n",
-                        # Check for existance of the file
-                        b"=file.list()['test.txt']\r\n",
-                        b"=file.list()['test.txt']\r\nnil\r\n"])
+                        # Check for existance of the file and open it
+                        self.OPEN_FOR_READ + b"\r\n",
+                        self.OPEN_FOR_READ + b"\r\nnil\r\nnil\r\n"])
         n = NodeMCU(s)
 
         with pytest.raises(IOError):
@@ -308,15 +1958,9 @@ class TestNodeMCU(object):
     def test_read_file_not_openable(self):
         """Files which can't be opened for read cause an error."""
         s = MockSerial([b"",
-                        # Close existing file
-                        b"file.close()\r\n",
-                        b"file.close()\r\n",
-                        # Check for existance of the file
-                        b"=file.list()['test.txt']\r\n",
-                        b"=file.list()['test.txt']\r\n123\r\n",
-                        # Open the file for read
-                        b"=file.open('test.txt', 'r')\r\n",
-                        b"=file.open('test.txt', 'r')\r\nnil\r\n"])
+                        # Check for existance of the file and open it
+                        self.OPEN_FOR_READ + b"\r\n",
+                        self.OPEN_FOR_READ + b"\r\n123\r\nnil\r\n"])
         n = NodeMCU(s)
 
         with pytest.raises(IOError):
@@ -327,15 +1971,9 @@ class TestNodeMCU(object):
     def test_read_file(self):
         """Reading should proceed block-by-block."""
         s = MockSerial([b"",
-                        # Close existing file
-                        b"file.close()\r\n",
-                        b"file.close()\r\n",
-                        # Check for existance of the file
-                        b"=file.list()['test.txt']\r\n",
-                        b"=file.list()['test.txt']\r\n3\r\n",
-                        # Open the file for read
-                        b"=file.open('test.txt', 'r')\r\n",
-                        b"=file.open('test.txt', 'r')\r\ntrue\r\n",
+                        # Check for existance of the file and open it
+                        self.OPEN_FOR_READ + b"\r\n",
+                        self.OPEN_FOR_READ + b"\r\n3\r\ntrue\r\n",
                         # Read a block
                         b"uart.write(0, file.read(2))\r\n",
                         b"uart.write(0, file.read(2))\r\n\x01\x02",
@@ -351,6 +1989,313 @@ class TestNodeMCU(object):
 
         assert s.finished
 
+    def unpack_sequence(self, files, response):
+        """Expected sequence for uploading and unpacking an archive."""
+        sequence = write_file_sequence("_nmcul.pak", pack_archive(files))
+        sequence += define_sequence(nodemcuload.UNPACK_ARCHIVE_LUA)
+        sequence += command(b"print(_nmunpack('_nmcul.pak', 256)); "
+                            b"_nmunpack = nil", response)
+        return sequence
+
+    def test_write_files(self):
+        """Files should be uploaded as an archive and unpacked."""
+        files = [("a.lua", b"print(1)"), ("b.txt", b"")]
+        s = MockSerial([b""] + self.unpack_sequence(files, b"2\r\n"))
+        n = NodeMCU(s)
+
+        n.write_files(files)
+
+        assert s.finished
+
+    def test_write_files_unpack_fails(self):
+        files = [("a.lua", b"print(1)")]
+        s = MockSerial([b""] + self.unpack_sequence(
+            files, b"_nmunpack:6: attempt to index a nil value\r\n"))
+        n = NodeMCU(s)
+
+        with pytest.raises(IOError):
+            n.write_files(files)
+
+        assert s.finished
+
+    def test_define(self):
+        """Helpers should only be defined once per session."""
+        s = MockSerial([b""] +
+                       command(b"function f() return 1 end"))
+        n = NodeMCU(s)
+
+        n.define("f", [b"function f()", b" return 1", b"end"])
+        n.define("f", [b"function f()", b" return 1", b"end"])
+
+        assert s.finished
+
+    def test_run_batch(self):
+        """Statements should be packed into lines and results demuxed."""
+        long = b"x = '" + b"x" * 240 + b"'"
+        s = MockSerial([b""] +
+                       command(b"a = 1; print(a); print(a + 1, 3)",
+                               b"1\r\n2\t3\r\n") +
+                       command(long) +
+                       command(b"print(nil)", b"nil\r\n"))
+        n = NodeMCU(s)
+
+        assert n.run_batch([b"a = 1", b"=a", b"=a + 1, 3", long,
+                            b"=nil"]) == [b"1", b"2\t3", b"nil"]
+        assert n.run_batch([]) == []
+
+        assert s.finished
+
+    @pytest.mark.parametrize("files,remove_source,current",
+                             [({}, False, False),
+                              ({"a.lua": 3}, False, False),
+                              ({"a.lc": 3}, False, False),
+                              ({"a.lua": 3, "a.lc": 3}, False, True),
+                              ({"b.lua": 3, "a.lc": 3}, True, False),
+                              ({"a.lch": 9, "a.lc": 3}, True, True)])
+    def test_compiled_is_current(self, monkeypatch, files, remove_source,
+                                 current):
+        n = NodeMCU(Mock())
+        monkeypatch.setattr(n, "list_files", Mock(return_value=files))
+        monkeypatch.setattr(n, "file_hash",
+                            Mock(return_value=(3, adler32(b"x=1"))))
+        monkeypatch.setattr(n, "read_file", Mock(
+            return_value="3 {}".format(adler32(b"x=1")).encode("ascii")))
+
+        assert n.compiled_is_current("a.lua", b"x=1",
+                                     remove_source) is current
+        assert n.compiled_is_current("a.lua", b"x=2", remove_source,
+                                     files) is False
+
+    def test_compiled_is_current_not_lua(self):
+        with pytest.raises(ValueError):
+            NodeMCU(Mock()).compiled_is_current("a.txt", b"", files={})
+
+    def test_compile_file(self):
+        s = MockSerial([b""] +
+                       command(b"file.remove('a.lc'); "
+                               b"print(pcall(node.compile, 'a.lua')); "
+                               b"print(file.list()['a.lc'])",
+                               b"true\r\n123\r\n") +
+                       command(b"file.remove('a.lch')"))
+        n = NodeMCU(s)
+
+        n.compile_file("a.lua")
+
+        assert s.finished
+
+    def test_compile_file_remove_source(self):
+        s = MockSerial([b""] +
+                       command(b"file.remove('a.lc'); "
+                               b"print(pcall(node.compile, 'a.lua')); "
+                               b"print(file.list()['a.lc'])",
+                               b"true\r\n123\r\n") +
+                       self.hash_sequence("a.lua", b"3\t0\t42\r\n") +
+                       write_file_sequence("a.lch", b"3 42") +
+                       command(b"file.remove('a.lua')"))
+        n = NodeMCU(s)
+
+        n.compile_file("a.lua", remove_source=True)
+
+        assert s.finished
+
+    def test_compile_file_error(self):
+        s = MockSerial([b""] +
+                       command(b"file.remove('a.lc'); "
+                               b"print(pcall(node.compile, 'a.lua')); "
+                               b"print(file.list()['a.lc'])",
+                               b"false\ta.lua:1: syntax error\r\n"
+                               b"nil\r\n"))
+        n = NodeMCU(s)
+
+        with pytest.raises(IOError):
+            n.compile_file("a.lua")
+
+        assert s.finished
+
+    def test_compile_file_no_bytecode(self):
+        s = MockSerial([b""] +
+                       command(b"file.remove('a.lc'); "
+                               b"print(pcall(node.compile, 'a.lua')); "
+                               b"print(file.list()['a.lc'])",
+                               b"true\r\nnil\r\n"))
+        n = NodeMCU(s)
+
+        with pytest.raises(IOError):
+            n.compile_file("a.lua")
+
+        assert s.finished
+
+    @pytest.mark.parametrize("current", [True, False])
+    def test_write_compiled(self, monkeypatch, current):
+        n = NodeMCU(Mock())
+        for name in ["write_file", "compile_file"]:
+            monkeypatch.setattr(n, name, Mock())
+        monkeypatch.setattr(n, "compiled_is_current",
+                            Mock(return_value=current))
+
+        assert n.write_compiled("a.lua", b"x=1", 32, True) is not current
+        n.compiled_is_current.assert_called_once_with("a.lua", b"x=1", True)
+        if not current:
+            n.write_file.assert_called_once_with("a.lua", b"x=1", 32, False,
+                                                 "escape", False, 0, None)
+            n.compile_file.assert_called_once_with("a.lua", True)
+        else:
+            assert not n.write_file.called
+            assert not n.compile_file.called
+
+    @pytest.mark.parametrize("filename", ["init.lua", "page.html"])
+    def test_write_compiled_bad_filename(self, filename):
+        s = MockSerial([b""])
+        n = NodeMCU(s)
+
+        with pytest.raises(ValueError):
+            n.write_compiled(filename, b"x=1", remove_source=True)
+
+        assert s.finished
+
+    def test_get_chip_id(self):
+        s = MockSerial([b""] + command(b"=node.chipid()", b"123456\r\n"))
+        n = NodeMCU(s)
+
+        assert n.get_chip_id() == 123456
+        assert n.get_chip_id() == 123456
+
+        assert s.finished
+
+    def hash_sequence(self, filename, response):
+        return define_sequence(nodemcuload.HASH_FILE_LUA) + command(
+            b"=_nmhash(" + lua_string(filename) + b")", response)
+
+    def test_file_hash(self):
+        s = MockSerial([b""] +
+                       self.hash_sequence("a.txt", b"3\t2\t12345\r\n") +
+                       command(b"=_nmhash('b.txt')", b"nil\r\n"))
+        n = NodeMCU(s)
+
+        assert n.file_hash("a.txt") == (3, 0x23039)
+        with pytest.raises(IOError):
+            n.file_hash("b.txt")
+
+        assert s.finished
+
+    def test_get_inventory(self):
+        s = MockSerial([b""] +
+                       define_sequence(nodemcuload.HASH_FILE_LUA) +
+                       define_sequence(nodemcuload.INVENTORY_LUA) +
+                       command(b"_nminv()",
+                               b"1\t5\t4\t123\t4096\t4\t0\t40\r\n"
+                               b"42\t21000\t100\t200\t300\r\n"
+                               b"2\r\n"
+                               b"5\r\na.lua3\t65520\t99\r\n"
+                               b"3\r\nb\r\n0\t0\t1\r\n") +
+                       command(b"_nminv()",
+                               b"1\t5\t4\t123\t4096\t4\t0\t40\r\n"
+                               b"42\t20000\t300\t0\t300\r\n"
+                               b"0\r\n"))
+        n = NodeMCU(s)
+
+        assert n.get_inventory() == {
+            "version": "1.5.4",
+            "info": [1, 5, 4, 123, 4096, 4, 0, 40],
+            "chip_id": 42,
+            "heap": 21000,
+            "fs_remaining": 100,
+            "fs_used": 200,
+            "fs_total": 300,
+            "files": {"a.lua": {"size": 3, "hash": 0xFFF00063},
+                      # Newlines in filenames should survive
+                      "b\r\n": {"size": 0, "hash": 1}},
+        }
+        assert n.get_chip_id() == 42
+
+        # Helpers are only defined once
+        assert n.get_inventory()["files"] == {}
+
+        assert s.finished
+
+    def test_measure_link(self, fake_time):
+        s = MockSerial([b""] +
+                       command(b"=0", b"0\r\n") * 2 +
+                       command(b"=#'xxxx'", b"4\r\n") * 2)
+        write = s.write
+
+        def slow_write(data):
+            # 0.5 s per command plus 0.25 s per character
+            fake_time.now += 0.5 + 0.25 * len(data)
+            return write(data)
+        s.write = slow_write
+        n = NodeMCU(s)
+
+        latency, char_rate = n.measure_link(size=4, repeats=2)
+        assert latency == pytest.approx(0.5 + 0.25 * 4)
+        assert char_rate == pytest.approx(4 / (0.25 * 6))
+
+        assert s.finished
+
+    def read_sequence(self, filename, data):
+        """Expected sequence for reading a file in a single block."""
+        name = lua_string(filename)
+        return (command(b"file.close(); print(file.list()[" + name + b"]); "
+                        b"print(file.open(" + name + b", 'r'))",
+                        str(len(data)).encode("ascii") + b"\r\ntrue\r\n") +
+                command("uart.write(0, file.read({}))".format(
+                    len(data)).encode("ascii"), data) +
+                command(b"file.close()"))
+
+    def test_read_file_cached(self, tmpdir):
+        """Unchanged files should only be read once."""
+        cache = FileCache(str(tmpdir))
+        hash_response = "3\t{}\t{}\r\n".format(
+            adler32(b"foo") >> 16, adler32(b"foo") & 0xFFFF).encode("ascii")
+        s = MockSerial([b""] +
+                       self.hash_sequence("a.txt", hash_response) +
+                       command(b"=node.chipid()", b"42\r\n") +
+                       self.read_sequence("a.txt", b"foo") +
+                       command(b"=_nmhash('a.txt')", hash_response))
+        n = NodeMCU(s)
+
+        assert n.read_file("a.txt", cache=cache) == b"foo"
+        assert n.read_file("a.txt", cache=cache) == b"foo"
+
+        assert s.finished
+
+    def test_read_file_cached_changed(self, tmpdir):
+        """If the file changes mid-read, don't cache it."""
+        cache = FileCache(str(tmpdir))
+        hash_response = "3\t{}\t{}\r\n".format(
+            adler32(b"foo") >> 16, adler32(b"foo") & 0xFFFF).encode("ascii")
+        s = MockSerial([b""] +
+                       self.hash_sequence("a.txt", hash_response) +
+                       command(b"=node.chipid()", b"42\r\n") +
+                       self.read_sequence("a.txt", b"bar"))
+        n = NodeMCU(s)
+
+        with pytest.raises(IOError):
+            n.read_file("a.txt", cache=cache)
+
+        assert s.finished
+        assert cache.get((42, "a.txt", 3, adler32(b"foo"))) is None
+
+    def test_restart_forgets_definitions(self, monkeypatch):
+        n = NodeMCU(Mock())
+        monkeypatch.setattr(n, "send_command", Mock())
+        monkeypatch.setattr(n, "read_line", Mock())
+        n.define("f", [b"function f() end"])
+        n.restart()
+        n.define("f", [b"function f() end"])
+        assert n.send_command.call_count == 3
+
+    def test_pull(self, monkeypatch):
+        n = NodeMCU(Mock())
+        monkeypatch.setattr(n, "list_files",
+                            Mock(return_value={"b": 1, "a": 2}))
+        monkeypatch.setattr(n, "read_file",
+                            Mock(side_effect=lambda f, b, c: f * 2))
+
+        assert list(n.pull()) == [("a", "aa"), ("b", "bb")]
+        assert list(n.pull(["b"], 32, "cache")) == [("b", "bb")]
+        n.read_file.assert_called_with("b", 32, "cache")
+
     """Lua snippet used to count the number of files in flash."""
     COUNT_FILES_SNIPPET = (b"do"
                            b"    local cnt = 0;"
@@ -405,12 +2350,14 @@ class TestNodeMCU(object):
         assert s.finished
 
     def test_remove_file_no_file(self):
-        """Make sure a file which doesn't exist doesn't get removed."""
+        """Removing a file which doesn't exist is an error."""
 
         s = MockSerial([b"",
-                        # Check file existance
-                        b"=file.list()['test.txt']\r\n",
-                        b"=file.list()['test.txt']\r\nnil\r\n"])
+                        # Check file existance (and remove it if it exists)
+                        b"print(file.list()['test.txt']); "
+                        b"file.remove('test.txt')\r\n",
+                        b"print(file.list()['test.txt']); "
+                        b"file.remove('test.txt')\r\nnil\r\n"])
         n = NodeMCU(s)
 
         with pytest.raises(IOError):
@@ -422,12 +2369,11 @@ class TestNodeMCU(object):
         """Remove file should work."""
 
         s = MockSerial([b"",
-                        # Check file existance
-                        b"=file.list()['test.txt']\r\n",
-                        b"=file.list()['test.txt']\r\n123\r\n",
-                        # Remove file
+                        # Check file existance and remove it
+                        b"print(file.list()['test.txt']); "
                         b"file.remove('test.txt')\r\n",
-                        b"file.remove('test.txt')\r\n"])
+                        b"print(file.list()['test.txt']); "
+                        b"file.remove('test.txt')\r\n123\r\n"])
         n = NodeMCU(s)
 
         n.remove_file("test.txt")
@@ -582,6 +2528,8 @@ class TestCLI(object):
                               # Missing argument
                               "--write",
                               "--read",
+                              "--pack",
+                              "--watch",
                               "--delete",
                               "--move",
                               "--move old.txt",
@@ -589,14 +2537,21 @@ class TestCLI(object):
                               # Too many arguments
                               "--write foo bar",
                               "--read foo bar",
+                              "--pack foo bar",
                               "--list foo",
                               "--delete foo bar",
                               "--move foo bar baz",
                               "--format foo",
                               "--dofile foo bar",
                               "--restart foo",
+                              # Only one follow-up action when watching
+                              "--watch d --then-restart --then-dofile a",
                               # Baudrate not an integer...
-                              "--baudrate abc"])
+                              "--baudrate abc",
+                              # Raw file data may contain XON/XOFF
+                              "--xonxoff --read foo",
+                              "--xonxoff --pull foo",
+                              "--xonxoff --inventory"])
     def test_bad_arguments(self, args, serial_ports, serial):
         """Make sure various obvious bad arguments make the parser crash."""
         with pytest.raises(SystemExit):
@@ -616,9 +2571,19 @@ class TestCLI(object):
     def test_manual_port_overrides(self, serial_ports, serial,
                                    mock_format_response):
         """Specifying a port should override the default one."""
+        from serial.tools import list_ports
         main("--port /dev/null --format".split())
         serial.assert_called_once_with("/dev/null", 9600, timeout=2.0)
 
+        # Enumerating ports is slow and shouldn't be done unnecessarily
+        assert not list_ports.comports.called
+
+    def test_help_skips_port_enumeration(self, serial_ports, capsys):
+        import serial.tools.list_ports
+        with pytest.raises(SystemExit):
+            main(["--help"])
+        assert not serial.tools.list_ports.comports.called
+
     def test_sensible_port(self, serial_ports, serial, mock_format_response):
         """If several ports are available, select /dev/ttyUSB* by preference.
         """
@@ -630,6 +2595,22 @@ class TestCLI(object):
         main("--baudrate 115200 --format".split())
         serial.assert_called_once_with("/dev/ttyUSB5", 115200, timeout=2.0)
 
+    def test_flow_control(self, serial_ports, serial, mock_format_response,
+                          monkeypatch):
+        calls = []
+        original_init = NodeMCU.__init__
+
+        def init(self, *args, **kwargs):
+            calls.append((args, kwargs))
+            original_init(self, *args, **kwargs)
+        monkeypatch.setattr(NodeMCU, "__init__", init)
+
+        main("--rtscts --xonxoff --pace 16 --format".split())
+        serial.assert_called_once_with("/dev/ttyUSB5", 9600, timeout=2.0,
+                                       rtscts=True, xonxoff=True)
+        assert calls == [((serial.return_value, ),
+                          {"max_outstanding": 16, "max_retries": 0})]
+
     @pytest.mark.parametrize("version", [(0, 0), (1, 3), (2, 0), (2, 5)])
     def test_bad_version(self, serial_ports, serial, monkeypatch, version):
         """Incompatible versions should fail."""
@@ -651,7 +2632,359 @@ class TestCLI(object):
         write_file = Mock()
         monkeypatch.setattr(NodeMCU, "write_file", write_file)
         assert main("--write foo.txt".split()) == 0
-        write_file.assert_called_once_with("foo.txt", b"foo")
+        write_file.assert_called_once_with("foo.txt", b"foo",
+                                           heap_aware=False,
+                                           encoding="escape",
+                                           compress=False,
+                                           write_buffer=0,
+                                           flush_interval=None)
+
+    def test_pack(self, serial_ports, serial, monkeypatch,
+                  mock_version_response, tmpdir):
+        """The directory should be passed through as a list of files."""
+        tmpdir.join("init.lua").write(b"dofile('x')", mode="wb")
+        write_files = Mock()
+        monkeypatch.setattr(NodeMCU, "write_files", write_files)
+        assert main(["--pack", str(tmpdir)]) == 0
+        write_files.assert_called_once_with([("init.lua", b"dofile('x')")],
+                                            heap_aware=False,
+                                            encoding="escape",
+                                            compress=False,
+                                            write_buffer=0,
+                                            flush_interval=None)
+
+    def test_write_heap_aware(self, serial_ports, serial, monkeypatch,
+                              mock_version_response):
+        import sys
+        stdin = Mock(read=Mock(return_value=b"foo"))
+        stdin.buffer = stdin
+        monkeypatch.setattr(sys, "stdin", stdin)
+
+        write_file = Mock()
+        monkeypatch.setattr(NodeMCU, "write_file", write_file)
+        assert main("--heap-aware --write foo.txt".split()) == 0
+        write_file.assert_called_once_with("foo.txt", b"foo",
+                                           heap_aware=True,
+                                           encoding="escape",
+                                           compress=False,
+                                           write_buffer=0,
+                                           flush_interval=None)
+
+    def test_write_encoding(self, serial_ports, serial, monkeypatch,
+                            mock_version_response):
+        import sys
+        stdin = Mock(read=Mock(return_value=b"foo"))
+        stdin.buffer = stdin
+        monkeypatch.setattr(sys, "stdin", stdin)
+
+        write_file = Mock()
+        monkeypatch.setattr(NodeMCU, "write_file", write_file)
+        assert main("--encoding auto --write foo.txt".split()) == 0
+        write_file.assert_called_once_with("foo.txt", b"foo",
+                                           heap_aware=False,
+                                           encoding="auto",
+                                           compress=False,
+                                           write_buffer=0,
+                                           flush_interval=None)
+
+    def test_write_compress(self, serial_ports, serial, monkeypatch,
+                            mock_version_response):
+        import sys
+        stdin = Mock(read=Mock(return_value=b"foo"))
+        stdin.buffer = stdin
+        monkeypatch.setattr(sys, "stdin", stdin)
+
+        write_file = Mock()
+        monkeypatch.setattr(NodeMCU, "write_file", write_file)
+        assert main("--compress --write foo.txt".split()) == 0
+        write_file.assert_called_once_with("foo.txt", b"foo",
+                                           heap_aware=False,
+                                           encoding="escape",
+                                           compress=True,
+                                           write_buffer=0,
+                                           flush_interval=None)
+
+    def test_write_buffer(self, serial_ports, serial, monkeypatch,
+                          mock_version_response):
+        import sys
+        stdin = Mock(read=Mock(return_value=b"foo"))
+        stdin.buffer = stdin
+        monkeypatch.setattr(sys, "stdin", stdin)
+
+        write_file = Mock()
+        monkeypatch.setattr(NodeMCU, "write_file", write_file)
+        assert main("--write-buffer 1024 --flush-interval 4 "
+                    "--write foo.txt".split()) == 0
+        write_file.assert_called_once_with("foo.txt", b"foo",
+                                           heap_aware=False,
+                                           encoding="escape",
+                                           compress=False,
+                                           write_buffer=1024,
+                                           flush_interval=4)
+
+    def test_monitor(self, serial_ports, serial, monkeypatch,
+                     mock_version_response):
+        import sys
+        monitor = MagicMock()
+        monkeypatch.setattr(nodemcuload, "ConsoleMonitor", monitor)
+        monkeypatch.setattr(nodemcuload, "time",
+                            Mock(sleep=Mock(side_effect=KeyboardInterrupt)))
+        stdout = Mock()
+        monkeypatch.setattr(sys, "stdout", stdout)
+
+        assert main("--monitor".split()) == 0
+
+        assert monitor.return_value.__exit__.called
+        output = monitor.call_args[0][1]
+        output(b"hello")
+        stdout.buffer.write.assert_called_once_with(b"hello")
+        assert stdout.buffer.flush.called
+
+    @pytest.mark.parametrize("then", [[], ["--then-dofile", "a.lua"],
+                                      ["--then-restart"]])
+    def test_watch(self, serial_ports, serial, monkeypatch,
+                   mock_version_response, tmpdir, fake_time, capsys, then):
+        tmpdir.join("a.lua").write(b"x = 1", mode="wb")
+        tmpdir.join("b.txt").write(b"b", mode="wb")
+
+        watcher = Mock()
+        watcher.return_value.poll.side_effect = [
+            [],
+            ["a.lua"],
+            ["a.lua", "b.txt", "deleted.txt"],
+            KeyboardInterrupt,
+        ]
+        monkeypatch.setattr(nodemcuload, "DirectoryWatcher", watcher)
+        for name in ["write_file", "write_files", "restart"]:
+            monkeypatch.setattr(NodeMCU, name, Mock())
+        monkeypatch.setattr(NodeMCU, "dofile", Mock(return_value=b"ok\n"))
+
+        assert main(["--watch", str(tmpdir), "--debounce", "0.5",
+                     "--minify"] + then) == 0
+
+        watcher.assert_called_once_with(str(tmpdir), 0.5)
+        assert fake_time.sleeps == [0.1]
+        NodeMCU.write_file.assert_called_once_with("a.lua", b"x=1",
+                                                   heap_aware=False,
+                                                   encoding="escape",
+                                                   compress=False,
+                                                   write_buffer=0,
+                                                   flush_interval=None)
+        NodeMCU.write_files.assert_called_once_with(
+            [("a.lua", b"x=1"), ("b.txt", b"b")], heap_aware=False,
+            encoding="escape",
+            compress=False,
+            write_buffer=0,
+            flush_interval=None)
+
+        out, err = capsys.readouterr()
+        assert "Wrote a.lua (3 bytes) in 0.0 s.\n" in err
+        assert "Wrote a.lua, b.txt (4 bytes) in 0.0 s.\n" in err
+        if "--then-dofile" in then:
+            assert NodeMCU.dofile.call_count == 2
+        else:
+            assert not NodeMCU.dofile.called
+        assert NodeMCU.restart.call_count == (
+            2 if "--then-restart" in then else 0)
+
+    def test_watch_errors(self, serial_ports, serial, monkeypatch,
+                          mock_version_response, tmpdir, fake_time, capsys):
+        """Batches of deleted files should be skipped and failed writes
+        reported without ending the session."""
+        tmpdir.join("a.lua").write(b"x=1", mode="wb")
+
+        watcher = Mock()
+        watcher.return_value.poll.side_effect = [
+            ["deleted.txt"],
+            ["a.lua"],
+            ["a.lua"],
+            KeyboardInterrupt,
+        ]
+        monkeypatch.setattr(nodemcuload, "DirectoryWatcher", watcher)
+        monkeypatch.setattr(NodeMCU, "write_file",
+                            Mock(side_effect=[IOError("Write failed!"),
+                                              None]))
+        monkeypatch.setattr(NodeMCU, "dofile", Mock(return_value=b""))
+
+        assert main(["--watch", str(tmpdir),
+                     "--then-dofile", "a.lua"]) == 0
+
+        assert NodeMCU.write_file.call_count == 2
+        assert NodeMCU.dofile.call_count == 1
+        out, err = capsys.readouterr()
+        assert err == ("Failed to write a.lua: Write failed!\n"
+                       "Wrote a.lua (3 bytes) in 0.0 s.\n")
+
+    def test_watch_compile(self, serial_ports, serial, monkeypatch,
+                           mock_version_response, tmpdir, fake_time):
+        """With --compile even single files go via _pack."""
+        tmpdir.join("a.lua").write(b"x = 1", mode="wb")
+        watcher = Mock()
+        watcher.return_value.poll.side_effect = [["a.lua"],
+                                                 KeyboardInterrupt]
+        monkeypatch.setattr(nodemcuload, "DirectoryWatcher", watcher)
+        pack = Mock()
+        monkeypatch.setattr(nodemcuload, "_pack", pack)
+
+        assert main(["--watch", str(tmpdir), "--compile"]) == 0
+        assert pack.call_args[0][2] == [("a.lua", b"x = 1")]
+
+    def test_compression_reported(self, serial_ports, serial, monkeypatch,
+                                  mock_version_response, capsys, fake_time):
+        import sys
+        stdin = Mock(read=Mock(return_value=b"a" * 1000))
+        stdin.buffer = stdin
+        monkeypatch.setattr(sys, "stdin", stdin)
+
+        def write_file(self, filename, data, **kwargs):
+            self.bytes_written += len(data)
+            self.bytes_sent += 250
+            self.write_time += 2.0
+            return True
+        monkeypatch.setattr(NodeMCU, "write_file", write_file)
+        assert main("--compress --write a.txt".split()) == 0
+        out, err = capsys.readouterr()
+        assert err == "Compressed 1000 -> 250 bytes (4.00x), 500 B/s.\n"
+
+        # Not reported without --compress
+        assert main("--write a.txt".split()) == 0
+        out, err = capsys.readouterr()
+        assert err == ""
+
+    def test_retries_reported(self, serial_ports, serial, monkeypatch,
+                              mock_version_response, capsys):
+        def format(self):
+            self.overruns = 1
+            self.retries = 2
+        monkeypatch.setattr(NodeMCU, "format", format)
+        assert main("--retries 3 --format".split()) == 0
+
+        out, err = capsys.readouterr()
+        assert err == ("Detected 1 corrupted command echo (overrun?).\n"
+                       "Recovered from 2 failed blocks.\n")
+
+    def test_write_minify(self, serial_ports, serial, monkeypatch,
+                          mock_version_response, capsys, tmpdir):
+        """Lua files should be minified, other files left alone."""
+        import sys
+
+        stdin = Mock(read=Mock(return_value=b"x = 1 -- one"))
+        stdin.buffer = stdin
+        monkeypatch.setattr(sys, "stdin", stdin)
+
+        write_file = Mock()
+        monkeypatch.setattr(NodeMCU, "write_file", write_file)
+        assert main("--minify --write foo.lua".split()) == 0
+        write_file.assert_called_once_with("foo.lua", b"x=1",
+                                           heap_aware=False,
+                                           encoding="escape",
+                                           compress=False,
+                                           write_buffer=0,
+                                           flush_interval=None)
+        assert main(["--minify", "--cache", str(tmpdir),
+                     "--write", "foo.txt"]) == 0
+        write_file.assert_called_with("foo.txt", b"x = 1 -- one",
+                                      heap_aware=False,
+                                      encoding="escape",
+                                      compress=False,
+                                      write_buffer=0,
+                                      flush_interval=None)
+
+        out, err = capsys.readouterr()
+        assert err == "foo.lua: 12 -> 3 bytes (9 saved).\n"
+
+    def test_pack_minify(self, serial_ports, serial, monkeypatch,
+                         mock_version_response, tmpdir):
+        tmpdir.join("init.lua").write(b"dofile ( 'x' )", mode="wb")
+        write_files = Mock()
+        monkeypatch.setattr(NodeMCU, "write_files", write_files)
+        assert main(["--minify", "--pack", str(tmpdir)]) == 0
+        write_files.assert_called_once_with([("init.lua", b"dofile('x')")],
+                                            heap_aware=False,
+                                            encoding="escape",
+                                            compress=False,
+                                            write_buffer=0,
+                                            flush_interval=None)
+
+    def test_write_compile(self, serial_ports, serial, monkeypatch,
+                           mock_version_response):
+        import sys
+
+        stdin = Mock(read=Mock(return_value=b"x=1"))
+        stdin.buffer = stdin
+        monkeypatch.setattr(sys, "stdin", stdin)
+
+        write_compiled = Mock()
+        monkeypatch.setattr(NodeMCU, "write_compiled", write_compiled)
+        assert main("--compile --remove-source --write a.lua".split()) == 0
+        write_compiled.assert_called_once_with("a.lua", b"x=1",
+                                               remove_source=True,
+                                               heap_aware=False,
+                                               encoding="escape",
+                                               compress=False,
+                                               write_buffer=0,
+                                               flush_interval=None)
+
+    @pytest.mark.parametrize("filename", ["init.lua", "page.html"])
+    def test_write_compile_not_compilable(self, serial_ports, serial,
+                                          monkeypatch, mock_version_response,
+                                          filename):
+        """Like --pack, --write should leave init.lua and non-Lua files
+        uncompiled (and their source in place)."""
+        import sys
+
+        stdin = Mock(read=Mock(return_value=b"x=1"))
+        stdin.buffer = stdin
+        monkeypatch.setattr(sys, "stdin", stdin)
+
+        write_file = Mock()
+        write_compiled = Mock()
+        monkeypatch.setattr(NodeMCU, "write_file", write_file)
+        monkeypatch.setattr(NodeMCU, "write_compiled", write_compiled)
+        assert main(["--compile", "--remove-source",
+                     "--write", filename]) == 0
+        assert write_file.call_args[0] == (filename, b"x=1")
+        assert not write_compiled.called
+
+    def test_pack_compile(self, serial_ports, serial, monkeypatch,
+                          mock_version_response, tmpdir):
+        """Only changed Lua files (other than init.lua) should be compiled
+        and only changed files uploaded."""
+        for name in ["init.lua", "new.lua", "old.lua", "x.txt"]:
+            tmpdir.join(name).write(name.encode("ascii"), mode="wb")
+
+        existing = {"old.lua": 7, "old.lc": 10}
+        monkeypatch.setattr(NodeMCU, "list_files",
+                            Mock(return_value=existing))
+        monkeypatch.setattr(NodeMCU, "compiled_is_current",
+                            lambda self, f, d, r, e: f == "old.lua")
+        write_files = Mock()
+        monkeypatch.setattr(NodeMCU, "write_files", write_files)
+        compile_file = Mock()
+        monkeypatch.setattr(NodeMCU, "compile_file", compile_file)
+
+        assert main(["--compile", "--pack", str(tmpdir)]) == 0
+        write_files.assert_called_once_with([("init.lua", b"init.lua"),
+                                             ("new.lua", b"new.lua"),
+                                             ("x.txt", b"x.txt")],
+                                            heap_aware=False,
+                                            encoding="escape",
+                                            compress=False,
+                                            write_buffer=0,
+                                            flush_interval=None)
+        compile_file.assert_called_once_with("new.lua", False)
+
+    def test_pack_compile_nothing_changed(self, serial_ports, serial,
+                                          monkeypatch, mock_version_response,
+                                          tmpdir):
+        tmpdir.join("a.lua").write(b"x", mode="wb")
+        monkeypatch.setattr(NodeMCU, "list_files", Mock(return_value={}))
+        monkeypatch.setattr(NodeMCU, "compiled_is_current",
+                            Mock(return_value=True))
+        write_files = Mock()
+        monkeypatch.setattr(NodeMCU, "write_files", write_files)
+        assert main(["--compile", "--pack", str(tmpdir)]) == 0
+        assert not write_files.called
 
     def test_read(self, serial_ports, serial, monkeypatch,
                   mock_version_response, capfd):
@@ -659,11 +2992,265 @@ class TestCLI(object):
         read_file = Mock(return_value=b"foo")
         monkeypatch.setattr(NodeMCU, "read_file", read_file)
         assert main("--read foo.txt".split()) == 0
-        read_file.assert_called_once_with("foo.txt")
+        read_file.assert_called_once_with("foo.txt", cache=None,
+                                          heap_aware=False)
 
         out, err = capfd.readouterr()
         assert out == "foo"  # XXX: capfd always gives a string...
 
+    def test_read_cache(self, serial_ports, serial, monkeypatch,
+                        mock_version_response, tmpdir):
+        read_file = Mock(return_value=b"foo")
+        monkeypatch.setattr(NodeMCU, "read_file", read_file)
+        assert main(["--cache", str(tmpdir), "--cache-size", "1000",
+                     "--read", "foo.txt"]) == 0
+        cache = read_file.call_args[1]["cache"]
+        assert cache.directory == str(tmpdir)
+        assert cache.max_bytes == 1000
+
+    @pytest.fixture
+    def mock_pull(self, monkeypatch):
+        """When used, devices contain a file named after the port they were
+        opened with."""
+        def pull(self, cache=None):
+            yield ("{}.txt".format(self.serial.port), b"hi")
+
+        def open_transport(port, baudrate, **kwargs):
+            return MagicMock(port=port.replace("/", ""))
+
+        monkeypatch.setattr(NodeMCU, "pull", pull)
+        monkeypatch.setattr(nodemcuload, "open_transport", open_transport)
+
+    def test_pull_directory(self, serial_ports, mock_pull,
+                            mock_version_response, tmpdir, capsys):
+        assert main(["--pull", str(tmpdir)]) == 0
+        assert tmpdir.join("devttyUSB5.txt").read(mode="rb") == b"hi"
+
+        out, err = capsys.readouterr()
+        assert err == "/dev/ttyUSB5: 1 file, 2 bytes.\n"
+
+    def test_pull_several(self, serial_ports, mock_pull,
+                          mock_version_response, tmpdir, capsys):
+        assert main(["--port", "/dev/a", "--port", "/dev/b",
+                     "--pull", str(tmpdir)]) == 0
+        assert tmpdir.join("dev_a", "deva.txt").check()
+        assert tmpdir.join("dev_b", "devb.txt").check()
+
+        out, err = capsys.readouterr()
+        assert err == ("/dev/a: 1 file, 2 bytes.\n"
+                       "/dev/b: 1 file, 2 bytes.\n")
+
+    @pytest.mark.parametrize("filename", ["backup.tar", "backup.tar.gz"])
+    def test_pull_tar(self, serial_ports, mock_pull, mock_version_response,
+                      tmpdir, filename):
+        import tarfile
+        filename = str(tmpdir.join(filename))
+        assert main(["--pull", filename]) == 0
+        with tarfile.open(filename) as tar:
+            assert tar.getnames() == ["devttyUSB5.txt"]
+
+    def test_pull_stdout(self, serial_ports, mock_pull,
+                         mock_version_response, monkeypatch):
+        import io
+        import sys
+        import tarfile
+        stdout = Mock(buffer=io.BytesIO())
+        monkeypatch.setattr(sys, "stdout", stdout)
+        assert main(["--pull", "-"]) == 0
+        stdout.buffer.seek(0)
+        with tarfile.open(fileobj=stdout.buffer) as tar:
+            assert tar.getnames() == ["devttyUSB5.txt"]
+
+    def test_pull_bad_version(self, serial_ports, mock_pull, monkeypatch,
+                              tmpdir):
+        """Devices opened so far should be closed on failure."""
+        monkeypatch.setattr(NodeMCU, "get_version",
+                            Mock(return_value=(0, 9)))
+        exit = Mock()
+        monkeypatch.setattr(NodeMCU, "__exit__", exit)
+        with pytest.raises(ValueError):
+            main(["--pull", str(tmpdir.join("x.tar"))])
+        assert exit.call_count == 1
+
+    @pytest.fixture
+    def mock_inventory(self, monkeypatch):
+        """When used, devices report a chip ID and file based on the port they
+        were opened with."""
+        self.heap = 1000
+
+        def get_inventory(self_):
+            port = self_.serial.port
+            return {"version": "1.5.4", "info": [1, 5, 4],
+                    "chip_id": len(port), "heap": self.heap,
+                    "fs_remaining": 1, "fs_used": 2, "fs_total": 3,
+                    "files": {port: {"size": 4, "hash": 5}}}
+
+        def open_transport(port, baudrate, **kwargs):
+            return MagicMock(port=port)
+
+        monkeypatch.setattr(NodeMCU, "get_inventory", get_inventory)
+        monkeypatch.setattr(nodemcuload, "open_transport", open_transport)
+
+    def test_inventory_json(self, no_serial_ports, mock_inventory,
+                            mock_version_response, capsys):
+        import json
+        assert main(["--port", "a", "--port", "bb", "--inventory"]) == 0
+        out, err = capsys.readouterr()
+        scan = json.loads(out)
+        assert sorted(scan) == ["1", "2"]
+        assert scan["1"]["port"] == "a"
+        assert scan["2"]["port"] == "bb"
+        assert scan["2"]["files"] == {"bb": {"size": 4, "hash": 5}}
+
+    def test_inventory_csv(self, no_serial_ports, mock_inventory,
+                           mock_version_response, capsys, monkeypatch):
+        monkeypatch.setattr(NodeMCU, "get_inventory",
+                            Mock(return_value={
+                                "version": "1.5.4", "chip_id": 7, "heap": 8,
+                                "fs_remaining": 1, "fs_used": 2,
+                                "fs_total": 3, "files": {}}))
+        assert main(["--port", "a", "--inventory",
+                     "--inventory-format", "csv"]) == 0
+        out, err = capsys.readouterr()
+        assert out.splitlines() == [
+            "device,port,version,heap,fs_total,fs_used,fs_remaining,"
+            "filename,size,hash",
+            "7,a,1.5.4,8,3,2,1,,,",
+        ]
+
+        # One row per file
+        NodeMCU.get_inventory.return_value["files"] = {
+            "x": {"size": 1, "hash": 2}, "y": {"size": 3, "hash": 4}}
+        assert main(["--port", "a", "--inventory",
+                     "--inventory-format", "csv"]) == 0
+        out, err = capsys.readouterr()
+        assert out.splitlines()[1:] == [
+            "7,a,1.5.4,8,3,2,1,x,1,2",
+            "7,a,1.5.4,8,3,2,1,y,3,4",
+        ]
+
+    def test_inventory_snapshot(self, no_serial_ports, mock_inventory,
+                                mock_version_response, capsys, tmpdir):
+        import json
+        snapshot = str(tmpdir.join("fleet.json"))
+
+        # The first scan is reported in full
+        assert main(["--port", "a", "--inventory",
+                     "--snapshot", snapshot]) == 0
+        out, err = capsys.readouterr()
+        assert sorted(json.loads(out)) == ["1"]
+        with open(snapshot) as f:
+            assert sorted(json.load(f)) == ["1"]
+
+        # Subsequent scans report only changes (ignoring the heap)
+        self.heap = 2000
+        assert main(["--port", "a", "--port", "bb", "--inventory",
+                     "--snapshot", snapshot]) == 0
+        out, err = capsys.readouterr()
+        changes = json.loads(out)
+        assert len(changes) == 1
+        assert changes[0]["device"] == "2"
+        assert changes[0]["field"] is None
+        assert changes[0]["old"] is None
+        assert changes[0]["new"]["port"] == "bb"
+        with open(snapshot) as f:
+            assert sorted(json.load(f)) == ["1", "2"]
+
+        # Nothing changed
+        assert main(["--port", "bb", "--inventory", "--snapshot", snapshot,
+                     "--inventory-format", "csv"]) == 0
+        out, err = capsys.readouterr()
+        assert out.splitlines() == ["device,field,old,new"]
+
+        # Devices are tracked by chip ID, even when moved between ports
+        with open(snapshot, "w") as f:
+            json.dump({"2": {"port": "c", "files": {}}}, f)
+        assert main(["--port", "bb", "--inventory", "--snapshot", snapshot,
+                     "--inventory-format", "csv"]) == 0
+        out, err = capsys.readouterr()
+        lines = out.splitlines()
+        assert lines[0] == "device,field,old,new"
+        assert '2,files/bb,,"{""hash"": 5, ""size"": 4}"' in lines
+        assert "2,port,c,bb" in lines
+
+    @pytest.fixture
+    def manifest(self, tmpdir):
+        import json
+        tmpdir.join("a.lua").write(b"a=1", mode="wb")
+        tmpdir.join("b.lua").write(b"b", mode="wb")
+        filename = str(tmpdir.join("deploy.json"))
+        with open(filename, "w") as f:
+            json.dump({"/dev/a": ["a.lua", "b.lua"], "/dev/b": ["b.lua"]}, f)
+        return filename
+
+    def test_deploy(self, serial_ports, mock_version_response, monkeypatch,
+                    manifest, capsys):
+        from serial.tools import list_ports
+        monkeypatch.setattr(nodemcuload, "open_transport",
+                            lambda port, baudrate, **kwargs: MagicMock())
+        monkeypatch.setattr(NodeMCU, "measure_link",
+                            Mock(return_value=(0.5, 1e9)))
+        write_file = Mock()
+        monkeypatch.setattr(NodeMCU, "write_file", write_file)
+
+        assert main(["--deploy", manifest, "--workers", "1", "--minify",
+                     "--compress"]) == 0
+        assert sorted(c[0][:2] for c in write_file.call_args_list) == [
+            ("a.lua", b"a=1"), ("b.lua", b"b"), ("b.lua", b"b")]
+        assert write_file.call_args[1]["compress"] is True
+        # The ports come from the manifest
+        assert not list_ports.comports.called
+
+        out, err = capsys.readouterr()
+        assert ("/dev/a: 2 files, 4 bytes in 0.0 s "
+                "(estimated 3.0 s, worker 0).\n") in err
+        assert ("/dev/b: 1 file, 1 byte in 0.0 s "
+                "(estimated 1.5 s, worker 0).\n") in err
+        assert "Critical path estimated 4.5 s, took 0.0 s.\n" in err
+
+        # Any ports given are ignored
+        write_file.reset_mock()
+        assert main(["--port", "/dev/x", "--port", "/dev/y",
+                     "--deploy", manifest]) == 0
+        assert write_file.call_count == 3
+
+    @pytest.mark.parametrize("stats", [False, True])
+    def test_profile(self, serial_ports, serial, mock_format_response,
+                     capsys, tmpdir, stats):
+        filename = str(tmpdir.join("out.pstats"))
+        assert main(["--format", "--profile"] +
+                    ([filename] if stats else [])) == 0
+        out, err = capsys.readouterr()
+        assert "Wall time" in err
+        assert tmpdir.join("out.pstats").check() == stats
+
+    @pytest.mark.parametrize("args",
+                             ["--port a --port b --list",
+                              "--port a --port b --record x --pull y",
+                              "--port a --port b --replay x --pull y",
+                              "--record x --deploy y",
+                              "--compile --deploy y",
+                              "--remove-source --deploy y"])
+    def test_several_ports_bad(self, no_serial_ports, serial, args):
+        with pytest.raises(SystemExit):
+            main(args.split())
+
+    @pytest.mark.parametrize("args",
+                             ["--port a --record x --pull y",
+                              "--replay x --pull y",
+                              "--port a --record x --inventory",
+                              "--replay x --inventory"])
+    def test_record_replay_bad(self, no_serial_ports, serial, args, tmpdir,
+                               capsys):
+        """Pull and inventory don't support recording or replaying, so
+        should be rejected rather than silently doing nothing."""
+        with tmpdir.as_cwd():
+            with pytest.raises(SystemExit):
+                main(args.split())
+            assert tmpdir.listdir() == []
+        out, err = capsys.readouterr()
+        assert "cannot be used with --pull or --inventory" in err
+
     def test_list(self, serial_ports, serial, monkeypatch,
                   mock_version_response, capsys):
         """File listings should be formatted nicely."""
@@ -746,3 +3333,25 @@ class TestCLI(object):
         monkeypatch.setattr(NodeMCU, "restart", restart)
         assert main("--restart".split()) == 0
         restart.assert_called_once_with()
+
+    def test_record_and_replay(self, no_serial_ports, monkeypatch, tmpdir):
+        """A recorded session should be replayable without a port."""
+        import serial
+        port = MockSerial([b"",
+                           b"=node.info()\r\n",
+                           b"=node.info()\r\n1\t5\t1234\t4321\r\n",
+                           b"file.format()\r\n",
+                           b"file.format()\r\n"])
+        port.__exit__ = Mock(return_value=None)
+        monkeypatch.setattr(serial, "Serial", Mock(return_value=port))
+
+        transcript = str(tmpdir.join("session.rec"))
+        assert main(["--port", "/dev/null", "--record", transcript,
+                     "--format"]) == 0
+        assert port.finished
+
+        serial.Serial.reset_mock()
+        assert main(["--replay", transcript, "--replay-scale", "0",
+                     "--format"]) == 0
+        assert not serial.Serial.called
+        assert not serial.tools.list_ports.comports.called